@@ -0,0 +1,129 @@
+"""
+Windowed aggregation of parsed dsmr values (MQTT_AGGREGATE = True)
+
+With a low MQTT_MAXRATE, most telegrams are not published. In aggregation mode
+every telegram is parsed and folded into running accumulators (count, sum, min, max)
+per OBIS reference, as declared in dsmr.aggregate. When a field is published, the
+statistics of its window are added to the MQTT message and its window starts again:
+  p_consumed      last value (as without aggregation)
+  p_consumed_avg  mean of all telegrams in window
+  p_consumed_max  max of all telegrams in window
+  p_consumed_min  min of all telegrams in window
+
+Memory is constant per meter; nothing is kept per telegram.
+
+        This program is free software: you can redistribute it and/or modify
+        it under the terms of the GNU General Public License as published by
+        the Free Software Foundation, either version 3 of the License, or
+        (at your option) any later version.
+
+        This program is distributed in the hope that it will be useful,
+        but WITHOUT ANY WARRANTY; without even the implied warranty of
+        MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+        GNU General Public License for more details.
+
+        You should have received a copy of the GNU General Public License
+        along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import dsmr50 as dsmr
+
+# Logging
+import __main__
+import logging
+import os
+script = os.path.basename(__main__.__file__)
+script = os.path.splitext(script)[0]
+logger = logging.getLogger(script + "." + __name__)
+
+# Supported statistics; "last" is the value itself
+STATISTICS = ("min", "max", "avg")
+
+# Accumulator fields
+COUNT = 0
+SUM = 1
+MIN = 2
+MAX = 3
+
+
+class WindowAggregator:
+  """
+    Running min/max/avg of numeric values of one meter, between publishes
+  """
+
+  def __init__(self, plan, aggregate=dsmr.aggregate):
+    """
+    Args:
+      :param P1_plan.ParsePlan plan: compiled dsmr definition; provides topic, tag & datatype
+      :param dict aggregate: OBIS reference:[statistics]; see dsmr50.py
+    """
+    # (index, topic, tag, statistics)
+    self.__fields = []
+    for index, statistics in aggregate.items():
+      element = plan.elements.get(index)
+      unknown = [s for s in statistics if s not in STATISTICS]
+      if element is None:
+        logger.warning(f"Aggregated entry {index} is not in dsmr definition")
+      elif element.groups is not None or element.cast is str:
+        logger.warning(f"Aggregated entry {index} is not a single number")
+      elif unknown:
+        logger.warning(f"Unknown statistics {unknown} for aggregated entry {index}")
+      else:
+        self.__fields.append((index, element.topic, element.tag, tuple(statistics)))
+
+    self.__window = {}
+
+  def add(self, values):
+    """
+      Fold parsed values of a telegram into the window
+
+    Args:
+      :param dict values: OBIS reference:value
+
+    Returns:
+      None
+    """
+    window = self.__window
+    for index, _topic, _tag, _statistics in self.__fields:
+      value = values.get(index)
+      if value is None:
+        continue
+
+      acc = window.get(index)
+      if acc is None:
+        window[index] = [1, value, value, value]
+        continue
+
+      acc[COUNT] += 1
+      acc[SUM] += value
+      if value < acc[MIN]:
+        acc[MIN] = value
+      elif value > acc[MAX]:
+        acc[MAX] = value
+
+  def emit(self, messages):
+    """
+      Add statistics of window to the fields in messages; a new window starts for these fields
+
+    Args:
+      :param dict messages: topic:{tag:value}
+
+    Returns:
+      None
+    """
+    for index, topic, tag, statistics in self.__fields:
+      message = messages.get(topic)
+      if message is None or tag not in message:
+        continue
+
+      acc = self.__window.pop(index, None)
+      if acc is None:
+        continue
+
+      for statistic in statistics:
+        if statistic == "avg":
+          message[tag + "_avg"] = round(acc[SUM] / acc[COUNT], 3)
+        elif statistic == "max":
+          message[tag + "_max"] = acc[MAX]
+        else:
+          message[tag + "_min"] = acc[MIN]
@@ -0,0 +1,128 @@
+"""
+Batched publishing (MQTT_BATCH_SIZE or MQTT_BATCH_SECONDS > 0)
+
+The MQTT messages of MQTT_BATCH_SIZE telegrams, or of the telegrams of MQTT_BATCH_SECONDS,
+are published as one message per topic, in a columnar layout: a list of values per field and
+a list of timestamps, eg
+  el = {"p_consumed":[866.0,900.0,912.0],"serial":["33363137","33363137","33363137"],
+        "timestamp":[1638734941,1638734942,1638734943]}
+A field which is not in every message (MQTT_DELTA, schedules per field) is null in the rows
+in which it is missing; a topic has rows only for the telegrams in which it was published.
+
+With MQTT_MAXRATE = 3600, every telegram is in a batch: full resolution, with a fraction of
+the MQTT messages (and per message overhead at the broker).
+
+        This program is free software: you can redistribute it and/or modify
+        it under the terms of the GNU General Public License as published by
+        the Free Software Foundation, either version 3 of the License, or
+        (at your option) any later version.
+
+        This program is distributed in the hope that it will be useful,
+        but WITHOUT ANY WARRANTY; without even the implied warranty of
+        MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+        GNU General Public License for more details.
+
+        You should have received a copy of the GNU General Public License
+        along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Logging
+import __main__
+import logging
+import os
+script = os.path.basename(__main__.__file__)
+script = os.path.splitext(script)[0]
+logger = logging.getLogger(script + "." + __name__)
+
+
+class TelegramBatch:
+  """
+    Columnar MQTT messages of the telegrams of one meter, since the last batch
+  """
+
+  def __init__(self, size=0, seconds=0):
+    """
+    Args:
+      :param int size: max telegrams per batch; 0 is no limit
+      :param int seconds: max seconds between first & last telegram of a batch; 0 is no limit
+    """
+    self.__size = size
+    self.__seconds = seconds
+
+    # topic:{tag:[values]}; every list has a value per row of the topic
+    self.__columns = {}
+
+    # Number of telegrams in batch
+    self.rows = 0
+
+    # Epoch (timestamp of messages), telegram complete & telegram parsed of first telegram
+    self.ts = None
+    self.received = None
+    self.parsed = None
+
+  def add(self, messages, ts, received, parsed):
+    """
+      Add MQTT messages of a telegram
+
+    Args:
+      :param dict messages: topic:{tag:value}
+      :param int ts: epoch; timestamp of messages
+      :param float received: epoch; telegram complete
+      :param float parsed: epoch; telegram parsed
+
+    Returns:
+      None
+    """
+    if not self.rows:
+      self.ts = ts
+      self.received = received
+      self.parsed = parsed
+
+    for topic, message in messages.items():
+      # There is always a timestamp; topics without other fields are skipped
+      if len(message) <= 1:
+        continue
+
+      columns = self.__columns.get(topic)
+      if columns is None:
+        columns = self.__columns[topic] = {"timestamp": []}
+      rows = len(columns["timestamp"])
+
+      for tag, value in message.items():
+        column = columns.get(tag)
+        if column is None:
+          # Field is new in this batch; null in previous rows
+          column = columns[tag] = [None] * rows
+        column.append(value)
+
+      # Fields missing in this message
+      rows += 1
+      for column in columns.values():
+        if len(column) < rows:
+          column.append(None)
+
+    self.rows += 1
+
+  def due(self, ts):
+    """
+    Args:
+      :param int ts: epoch; now, or timestamp of last added telegram
+
+    Returns:
+      :rtype: bool: batch is full or its time is up
+    """
+    if not self.rows:
+      return False
+    return bool((self.__size and self.rows >= self.__size) or (self.__seconds and ts - self.ts >= self.__seconds))
+
+  def pop(self):
+    """
+      Take the batch & start a new one
+
+    Returns:
+      :rtype: dict: topic:{tag:[values]}, including "timestamp":[epoch]
+    """
+    columns = self.__columns
+    self.__columns = {}
+    self.rows = 0
+    return columns
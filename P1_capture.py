@@ -0,0 +1,301 @@
+"""
+  Capture raw dsmr telegrams to rotating, compressed segment files
+
+  Replaces "tail -f /dev/ttyUSB0 > dsmr.raw"; runs continuously next to the parser.
+
+  Files in CAPTURE_DIR:
+    dsmr-20240204-171638.raw.gz   raw telegrams; a gzip member per block of telegrams
+    dsmr-20240204-171638.idx      index; per telegram: meter timestamp, offset of gzip member,
+                                  offset & length of the telegram in the decompressed member
+
+  Telegrams rejected by the framer (CRC error, truncated) are captured as well, flagged in the
+  index (REJECTED bit of the length), to diagnose a misbehaving meter. They are not extracted
+  unless asked for (--rejected); an extract without them can be replayed as is.
+
+  The reader only appends a telegram to an in-memory queue; compression and
+  file I/O are done in the recorder thread. When the queue is full (disk too slow),
+  telegrams are not captured (counted), but the live path is never delayed.
+  The oldest segments are deleted when the capture exceeds CAPTURE_MAX_BYTES;
+  segments are rotated every CAPTURE_SEGMENT_SECONDS or at 10% of CAPTURE_MAX_BYTES.
+
+  A gzip file with multiple members is a valid gzip file (zcat works), while a time range
+  can be extracted by decompressing only the members that contain the range:
+    python3 P1_capture.py capture "2024-02-04 17:00:00" "2024-02-04 17:05:00" > dsmr.raw
+    python3 P1_capture.py --rejected capture "2024-02-04 17:00:00" "2024-02-04 17:05:00" > rejected.raw
+
+  The extracted file can be replayed as SIMULATORFILE.
+
+        This program is free software: you can redistribute it and/or modify
+        it under the terms of the GNU General Public License as published by
+        the Free Software Foundation, either version 3 of the License, or
+        (at your option) any later version.
+
+        This program is distributed in the hope that it will be useful,
+        but WITHOUT ANY WARRANTY; without even the implied warranty of
+        MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+        GNU General Public License for more details.
+
+        You should have received a copy of the GNU General Public License
+        along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import threading
+import collections
+import datetime
+import struct
+import glob
+import time
+import zlib
+import sys
+
+# Logging
+import __main__
+import logging
+import os
+script = os.path.basename(__main__.__file__)
+script = os.path.splitext(script)[0]
+logger = logging.getLogger(script + "." + __name__)
+
+# Telegrams per gzip member; a member is the unit of (de)compression
+BLOCK_TELEGRAMS = 60
+
+# Max number of telegrams waiting for the recorder thread
+QUEUE_SIZE = 600
+
+# Index record: meter timestamp, member offset, offset in member, length
+INDEX_RECORD = struct.Struct("<qQII")
+
+# Flag in length of index record: telegram rejected by framer (CRC error, truncated)
+REJECTED = 0x80000000
+
+
+class CaptureRecorder(threading.Thread):
+  """
+    Write raw telegrams to compressed segments with an index
+  """
+
+  def __init__(self, stopper, directory, segment_seconds=3600, max_bytes=500 * 1024 * 1024):
+    """
+    Args:
+      :param threading.Event() stopper: stops thread; queued telegrams are written first
+      :param str directory: capture directory
+      :param int segment_seconds: start a new segment after this number of seconds
+      :param int max_bytes: max disk usage of all segments; oldest segments are deleted
+    """
+    logger.debug(">>")
+    super().__init__()
+    self.__stopper = stopper
+    self.__directory = directory
+    self.__segment_seconds = segment_seconds
+    self.__max_bytes = max_bytes
+
+    # Also start a new segment when segment exceeds part of max disk usage
+    self.__segment_bytes = max_bytes // 10
+
+    self.__queue = collections.deque()
+    self.__trigger = threading.Event()
+
+    # Current segment & block
+    self.__gz = None
+    self.__idx = None
+    self.__segment_start = 0
+    self.__block = bytearray()
+    self.__block_index = []
+
+    # Statistics
+    self.captured = 0
+    self.rejected = 0
+    self.dropped = 0
+
+    os.makedirs(directory, exist_ok=True)
+
+  def __del__(self):
+    logger.debug(">>")
+
+  def record(self, frame, meter_ts, rejected=False):
+    """
+      Queue telegram for capture; called by reader, never blocks
+
+    Args:
+      :param bytes frame: raw telegram
+      :param int meter_ts: meter timestamp (epoch); None if unknown
+      :param bool rejected: telegram rejected by framer (CRC error, truncated)
+
+    Returns:
+      None
+    """
+    if len(self.__queue) >= QUEUE_SIZE:
+      self.dropped += 1
+      return
+
+    self.__queue.append((frame, meter_ts or int(time.time()), rejected))
+    self.__trigger.set()
+
+  def __open_segment(self, ts):
+    name = time.strftime("dsmr-%Y%m%d-%H%M%S", time.localtime(ts))
+    path = os.path.join(self.__directory, name)
+    self.__gz = open(path + ".raw.gz", 'ab')
+    self.__idx = open(path + ".idx", 'ab')
+    self.__segment_start = ts
+    logger.debug(f"Capture segment {path}")
+
+  def __close_segment(self):
+    self.__flush_block()
+    if self.__gz is not None:
+      self.__gz.close()
+      self.__idx.close()
+      self.__gz = None
+      self.__idx = None
+    self.__cleanup()
+
+  def __flush_block(self):
+    """
+      Compress block as one gzip member and write index records
+
+    Returns:
+      None
+    """
+    if not self.__block_index:
+      return
+
+    member_offset = self.__gz.tell()
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    self.__gz.write(compressor.compress(self.__block) + compressor.flush())
+    self.__idx.write(b''.join(INDEX_RECORD.pack(ts, member_offset, offset, length)
+                              for ts, offset, length in self.__block_index))
+    self.__gz.flush()
+    self.__idx.flush()
+
+    self.__block.clear()
+    self.__block_index.clear()
+
+  def __cleanup(self):
+    """
+      Delete oldest segments till disk usage is below max
+
+    Returns:
+      None
+    """
+    segments = sorted(glob.glob(os.path.join(self.__directory, "dsmr-*.raw.gz")))
+    sizes = [sum(_size(path) for path in (s, s[:-7] + ".idx")) for s in segments]
+    total = sum(sizes)
+    for segment, size in zip(segments, sizes):
+      if total <= self.__max_bytes:
+        break
+      logger.info(f"Capture exceeds {self.__max_bytes} bytes; delete {segment}")
+      for path in (segment, segment[:-7] + ".idx"):
+        try:
+          os.remove(path)
+        except FileNotFoundError:
+          pass
+        except OSError as e:
+          logger.warning(f"Cannot delete {path}; {e}")
+      total -= size
+
+  def __write(self, frame, ts, rejected):
+    if (self.__gz is None or ts - self.__segment_start >= self.__segment_seconds or
+       self.__gz.tell() >= self.__segment_bytes):
+      self.__close_segment()
+      self.__open_segment(ts)
+
+    self.__block_index.append((ts, len(self.__block), len(frame) | (REJECTED if rejected else 0)))
+    self.__block += frame
+    if rejected:
+      self.rejected += 1
+    else:
+      self.captured += 1
+
+    if len(self.__block_index) >= BLOCK_TELEGRAMS:
+      self.__flush_block()
+
+  def run(self):
+    logger.debug(">>")
+    try:
+      while not (self.__stopper.is_set() and not self.__queue):
+        self.__trigger.wait(timeout=1)
+        self.__trigger.clear()
+        while self.__queue:
+          self.__write(*self.__queue.popleft())
+
+    except Exception as e:
+      logger.error(f"Exception: {e}")
+
+    finally:
+      if self.__gz is not None:
+        self.__close_segment()
+
+    logger.info(f"Capture: telegrams = {self.captured}; rejected = {self.rejected}; dropped = {self.dropped}")
+    logger.debug("<<")
+
+
+def _size(path):
+  # Size of file; 0 if missing (eg index never written)
+  try:
+    return os.path.getsize(path)
+  except OSError:
+    return 0
+
+
+def extract(directory, t_from, t_to, rejected=False):
+  """
+    Extract captured telegrams within time range; only the gzip members within range are decompressed
+
+  Args:
+    :param str directory: capture directory
+    :param int t_from: epoch (inclusive)
+    :param int t_to: epoch (inclusive)
+    :param bool rejected: extract only the telegrams rejected by the framer (CRC error, truncated)
+
+  Returns:
+    generator of raw telegrams (bytes)
+  """
+  for index_file in sorted(glob.glob(os.path.join(directory, "dsmr-*.idx"))):
+    with open(index_file, 'rb') as f:
+      index = [INDEX_RECORD.unpack_from(record) for record in iter(lambda: f.read(INDEX_RECORD.size), b'')]
+
+    # Skip segments outside range without opening the data
+    selected = [record for record in index if t_from <= record[0] <= t_to and bool(record[3] & REJECTED) == rejected]
+    if not selected:
+      continue
+
+    with open(index_file[:-4] + ".raw.gz", 'rb') as gz:
+      member_offset = None
+      member = b''
+      for _ts, offset, inner_offset, length in selected:
+        length &= ~REJECTED
+        if offset != member_offset:
+          gz.seek(offset)
+          decompressor = zlib.decompressobj(31)
+          member = b''
+          while not decompressor.eof:
+            chunk = gz.read(65536)
+            if not chunk:
+              break
+            member += decompressor.decompress(chunk)
+          member_offset = offset
+        yield member[inner_offset:inner_offset + length]
+
+
+def _epoch(value):
+  """
+  Args:
+    :param str value: epoch or local time "YYYY-mm-dd HH:MM:SS"
+
+  Returns:
+    :rtype: int
+  """
+  if value.isdigit():
+    return int(value)
+  return int(datetime.datetime.strptime(value, "%Y-%m-%d %H:%M:%S").timestamp())
+
+
+if __name__ == '__main__':
+  arguments = [argument for argument in sys.argv[1:] if argument != "--rejected"]
+  if len(arguments) != 3:
+    print(f"Usage: python3 {sys.argv[0]} [--rejected] <capture dir> <from> <to> > dsmr.raw\n"
+          f"  <from>, <to>: epoch or \"YYYY-mm-dd HH:MM:SS\" (local time)\n"
+          f"  --rejected: telegrams rejected by the framer (CRC error, truncated) instead of valid telegrams")
+    sys.exit(1)
+
+  for telegram in extract(arguments[0], _epoch(arguments[1]), _epoch(arguments[2]), "--rejected" in sys.argv):
+    sys.stdout.buffer.write(telegram)
@@ -0,0 +1,149 @@
+"""
+  Hand over dsmr telegrams from serial reader to parser
+
+  Bounded, lock protected FIFO of telegram slots. The reader never waits for the
+  parser: when all slots are in use, the overflow policy decides which telegram
+  is dropped. Dropped telegrams are counted.
+
+  Overflow policies:
+  - "drop_oldest": discard the oldest queued telegram (default; parser continues with most recent data)
+  - "drop_newest": discard the telegram that is offered
+  - "block": reader waits till a slot is free (simulation only; all telegrams are parsed)
+
+        This program is free software: you can redistribute it and/or modify
+        it under the terms of the GNU General Public License as published by
+        the Free Software Foundation, either version 3 of the License, or
+        (at your option) any later version.
+
+        This program is distributed in the hope that it will be useful,
+        but WITHOUT ANY WARRANTY; without even the implied warranty of
+        MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+        GNU General Public License for more details.
+
+        You should have received a copy of the GNU General Public License
+        along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import threading
+import collections
+import time
+
+# Logging
+import __main__
+import logging
+import os
+script = os.path.basename(__main__.__file__)
+script = os.path.splitext(script)[0]
+logger = logging.getLogger(script + "." + __name__)
+
+DROP_OLDEST = "drop_oldest"
+DROP_NEWEST = "drop_newest"
+BLOCK = "block"
+
+
+class Telegram:
+  """
+    One dsmr telegram, as read from serial
+  """
+
+  def __init__(self, counter, lines, prefix=None, received=None, ts=None):
+    """
+    Args:
+      :param int counter: sequence number of telegram, assigned by reader
+      :param list lines: telegram lines (str), without CR LF
+      :param str prefix: MQTT topic prefix of the meter; None is MQTT_TOPIC_PREFIX
+      :param float received: epoch (ms resolution) when telegram was complete; None is now
+      :param float ts: epoch of telegram in MQTT messages & schedules; replayed timestamp in simulation,
+                       None is received
+    """
+    self.counter = counter
+    self.lines = lines
+    self.prefix = prefix
+    self.received = time.time() if received is None else received
+    self.ts = self.received if ts is None else ts
+
+
+class TelegramChannel:
+  """
+    Bounded FIFO between one (or more) readers and the parser
+  """
+
+  def __init__(self, size=8, overflow=DROP_OLDEST):
+    """
+    Args:
+      :param int size: number of telegram slots
+      :param str overflow: overflow policy; DROP_OLDEST, DROP_NEWEST or BLOCK
+    """
+    assert size > 0, "Telegram channel size should be > 0"
+    assert overflow in (DROP_OLDEST, DROP_NEWEST, BLOCK), f"Unknown overflow policy {overflow}"
+
+    self.__slots = collections.deque()
+    self.__size = size
+    self.__overflow = overflow
+    self.__lock = threading.Lock()
+    self.__not_empty = threading.Condition(self.__lock)
+    self.__not_full = threading.Condition(self.__lock)
+
+    # Statistics
+    self.put_count = 0
+    self.get_count = 0
+    self.dropped = 0
+    self.high_water = 0
+
+  def put(self, telegram, timeout=None):
+    """
+      Offer telegram to parser; does not block, unless overflow policy is BLOCK
+
+    Args:
+      :param Telegram telegram:
+      :param float timeout: only for BLOCK; max time to wait for a free slot
+
+    Returns:
+      :rtype: bool: False if telegram has been dropped (or BLOCK timeout expired; telegram not queued)
+    """
+    with self.__lock:
+      if len(self.__slots) >= self.__size:
+        if self.__overflow == DROP_OLDEST:
+          self.__slots.popleft()
+          self.dropped += 1
+        elif self.__overflow == DROP_NEWEST:
+          self.dropped += 1
+          return False
+        elif not self.__not_full.wait_for(lambda: len(self.__slots) < self.__size, timeout):
+          return False
+
+      self.__slots.append(telegram)
+      self.put_count += 1
+      self.high_water = max(self.high_water, len(self.__slots))
+      self.__not_empty.notify()
+    return True
+
+  def get(self, timeout=None):
+    """
+      Take oldest telegram
+
+    Args:
+      :param float timeout: max time to wait for a telegram
+
+    Returns:
+      :rtype: Telegram: or None after timeout
+    """
+    with self.__lock:
+      if not self.__not_empty.wait_for(lambda: self.__slots, timeout):
+        return None
+
+      telegram = self.__slots.popleft()
+      self.get_count += 1
+      self.__not_full.notify()
+    return telegram
+
+  def __len__(self):
+    return len(self.__slots)
+
+  def statistics(self):
+    """
+    Returns:
+      :rtype: str
+    """
+    return (f"telegrams in = {self.put_count}; out = {self.get_count}; dropped = {self.dropped}; "
+            f"max queued = {self.high_water}/{self.__size}")
@@ -0,0 +1,438 @@
+#!/usr/bin/python3
+
+"""
+ DESCRIPTION
+   Offline bulk converter of raw dsmr telegram files (eg months of "tail -f /dev/ttyUSB0 > dsmr.raw",
+   or telegrams extracted with P1_capture.py) to InfluxDB line protocol, CSV or Parquet.
+
+   Files are memory mapped and split in chunks on telegram boundaries ("\\n/"). Chunks are
+   framed (CRC checked) and parsed in a process pool, with the same dsmr50.py definitions
+   and parse plan as dsmr-mqtt.py. Every chunk is returned as columns (NumPy arrays) per
+   MQTT topic, and written as it arrives, in file order.
+
+   Rows are timestamped with the meter timestamp (0-0:1.0.0); telegrams without valid
+   timestamp are skipped. A gas sample is only written once, at its capture time (0-1:24.2.1).
+
+ USAGE
+   python3 P1_convert.py -f lp dsmr.raw > dsmr.lp
+   python3 P1_convert.py -f csv -o dsmr dsmr-*.raw              --> dsmr.el.csv, dsmr.gas.csv, ...
+   python3 P1_convert.py -f parquet -o dsmr -j 4 dsmr.raw       --> dsmr.el.parquet, ... (requires pyarrow)
+
+   Line protocol follows telegraf-dsmr.conf (as P1_influx.py): topics el & gas, measurement "dsmr", tag "serial",
+   epoch seconds (influx write --precision s). Other topics with --topics, eg --topics el gas system.
+
+        This program is free software: you can redistribute it and/or modify
+        it under the terms of the GNU General Public License as published by
+        the Free Software Foundation, either version 3 of the License, or
+        (at your option) any later version.
+
+        This program is distributed in the hope that it will be useful,
+        but WITHOUT ANY WARRANTY; without even the implied warranty of
+        MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+        GNU General Public License for more details.
+
+        You should have received a copy of the GNU General Public License
+        along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import csv
+import multiprocessing
+import mmap
+import math
+import time
+import sys
+import os
+
+import numpy
+
+import P1_framer as framer
+import P1_plan as plan
+import P1_encode as encode
+
+# Chunk size of raw files, per worker task
+CHUNK_SIZE = 8 * 1024 * 1024
+
+# Topics of line protocol, as telegraf-dsmr.conf
+LP_TOPICS = ("el", "gas")
+
+# Parse plan of worker process
+_plan = None
+
+
+def _init_worker():
+  global _plan
+  _plan = plan.ParsePlan()
+
+
+def split(filename, chunk_size=CHUNK_SIZE):
+  """
+    Split raw file in chunks on telegram boundaries
+
+  Args:
+    :param str filename: raw dsmr file
+    :param int chunk_size: approximate size of a chunk
+
+  Returns:
+    list of (filename, start, end)
+  """
+  size = os.path.getsize(filename)
+  if size == 0:
+    return []
+
+  chunks = []
+  with open(filename, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+    start = 0
+    while start < size:
+      end = mm.find(b"\n/", min(start + chunk_size, size))
+      end = size if end < 0 else end + 1
+      chunks.append((filename, start, end))
+      start = end
+  return chunks
+
+
+def convert_chunk(chunk):
+  """
+    Frame & parse telegrams of a chunk; runs in worker process
+
+  Args:
+    :param tuple chunk: (filename, start, end)
+
+  Returns:
+    :rtype: dict, dict: topic:{"timestamp" or tag:numpy array}, statistics
+  """
+  filename, start, end = chunk
+  with open(filename, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+    frames = framer.TelegramFramer(max_size=16384).feed(mm[start:end])
+
+  gas = _plan.elements.get(plan.GAS)
+  gas_ts = None
+  rows = {}
+  skipped = 0
+
+  for frame in frames:
+    lines = framer.telegram_lines(frame)
+    ts = framer.meter_time(lines)
+    if ts is None:
+      skipped += 1
+      continue
+
+    messages, _values = _plan.parse(lines, ts)
+
+    # Gas sample once, at capture time
+    if gas is not None and gas.topic in messages:
+      capture_ts = framer.meter_time(lines, plan.GAS)
+      if capture_ts is not None:
+        if capture_ts == gas_ts:
+          del messages[gas.topic]
+        else:
+          gas_ts = capture_ts
+          messages[gas.topic]["timestamp"] = capture_ts
+
+    for topic, message in messages.items():
+      rows.setdefault(topic, []).append(message)
+
+  return _columns(rows), {"telegrams": len(frames), "skipped": skipped}
+
+
+def _columns(rows):
+  """
+    Convert rows (dictionaries) to columns per topic; numbers as float64 (NaN if missing), others as object
+
+  Args:
+    :param dict rows: topic:[{tag:value}]
+
+  Returns:
+    :rtype: dict: topic:{tag:numpy array}
+  """
+  columns = {}
+  for topic, messages in rows.items():
+    tags = {}
+    for message in messages:
+      for tag, value in message.items():
+        if tag not in tags or tags[tag] is float:
+          tags[tag] = str if isinstance(value, str) else float
+
+    columns[topic] = {}
+    for tag, kind in tags.items():
+      if tag == "timestamp":
+        columns[topic][tag] = numpy.fromiter((m[tag] for m in messages), dtype=numpy.int64, count=len(messages))
+      elif kind is float:
+        columns[topic][tag] = numpy.fromiter((m.get(tag, math.nan) for m in messages),
+                                             dtype=numpy.float64, count=len(messages))
+      else:
+        columns[topic][tag] = numpy.array([m.get(tag) for m in messages], dtype=object)
+  return columns
+
+
+def fields(elements):
+  """
+  Args:
+    :param dict elements: OBIS reference:P1_plan._Element
+
+  Returns:
+    :rtype: dict: topic:{tag:datatype}, "timestamp" first, in order of dsmr definition
+  """
+  topics = {}
+  for element in elements.values():
+    if element.groups is None:
+      tags = [(element.tag, element.cast)]
+    else:
+      tags = [(tag, cast) for _position, tag, cast, _factor in element.groups]
+    topics.setdefault(element.topic, {"timestamp": int}).update(tags)
+  return topics
+
+
+def _unique_samples(columns, topic, last_ts=None):
+  """
+    Remove rows with same timestamp as previous row, eg a gas sample at the boundary of two chunks
+
+  Args:
+    :param dict columns: topic:{tag:numpy array}; modified in place
+    :param str topic:
+    :param int last_ts: timestamp of last row of previous chunk; None if none
+
+  Returns:
+    :rtype: int: timestamp of last row, for the next chunk
+  """
+  if topic not in columns:
+    return last_ts
+
+  timestamps = columns[topic]["timestamp"]
+  keep = numpy.ones(len(timestamps), dtype=bool)
+  keep[1:] = timestamps[1:] != timestamps[:-1]
+  if last_ts is not None and len(timestamps):
+    keep[0] = timestamps[0] != last_ts
+  for tag, values in columns[topic].items():
+    columns[topic][tag] = values[keep]
+  return int(timestamps[-1]) if len(timestamps) else last_ts
+
+
+class LineProtocolWriter:
+  """
+    InfluxDB line protocol, one line per topic per telegram
+  """
+
+  def __init__(self, out, integers, measurement="dsmr"):
+    """
+    Args:
+      :param out: text file
+      :param set integers: (topic, tag) of integer fields
+      :param str measurement: influxdb measurement
+    """
+    self.__out = out
+    self.__integers = integers
+    self.__measurement = encode.escape(measurement, encode.TAG_ESCAPE)
+
+  def write(self, columns):
+    """
+    Args:
+      :param dict columns: topic:{tag:numpy array}
+
+    Returns:
+      :rtype: int: number of lines
+    """
+    nroflines = 0
+    for topic, tags in columns.items():
+      # Lists are much faster to iterate than numpy arrays
+      names = list(tags)
+      data = [tags[tag].tolist() for tag in names]
+
+      for row in zip(*data):
+        line = encode.line_protocol(self.__measurement, topic, dict(zip(names, row)), self.__integers)
+        if line is not None:
+          self.__out.write(line + "\n")
+          nroflines += 1
+    return nroflines
+
+  def close(self):
+    self.__out.flush()
+
+
+class CsvWriter:
+  """
+    One CSV file per topic: <output>.<topic>.csv; a column per field of the dsmr definition
+  """
+
+  def __init__(self, output, integers, topics):
+    """
+    Args:
+      :param str output: file name prefix
+      :param set integers: (topic, tag) of integer fields
+      :param dict topics: topic:{tag:datatype}; see fields()
+    """
+    self.__output = output
+    self.__integers = integers
+    self.__topics = topics
+
+    # topic:(file, csv writer)
+    self.__files = {}
+
+  def write(self, columns):
+    """
+    Args:
+      :param dict columns: topic:{tag:numpy array}
+
+    Returns:
+      :rtype: int: number of rows
+    """
+    nrofrows = 0
+    for topic, tags in columns.items():
+      if topic not in self.__files:
+        f = open(f"{self.__output}.{topic}.csv", 'w', newline='')
+        self.__files[topic] = (f, csv.writer(f))
+        self.__files[topic][1].writerow(self.__topics[topic])
+      writer = self.__files[topic][1]
+
+      length = len(tags["timestamp"])
+      data = []
+      for tag in self.__topics[topic]:
+        if tag not in tags:
+          data.append([""] * length)
+          continue
+        values = tags[tag].tolist()
+        if tags[tag].dtype == numpy.float64:
+          integer = (topic, tag) in self.__integers
+          values = ["" if math.isnan(v) else (int(v) if integer else v) for v in values]
+        data.append(values)
+
+      writer.writerows(zip(*data))
+      nrofrows += length
+    return nrofrows
+
+  def close(self):
+    for f, _writer in self.__files.values():
+      f.close()
+
+
+class ParquetWriter:
+  """
+    One Parquet file per topic: <output>.<topic>.parquet, a row group per chunk; requires pyarrow
+  """
+
+  def __init__(self, output, integers, topics):
+    """
+    Args:
+      :param str output: file name prefix
+      :param set integers: (topic, tag) of integer fields
+      :param dict topics: topic:{tag:datatype}; see fields()
+    """
+    try:
+      import pyarrow
+      import pyarrow.parquet
+    except ImportError:
+      sys.exit("Parquet output requires pyarrow (pip3 install pyarrow)")
+    self.__pyarrow = pyarrow
+    self.__output = output
+
+    # topic:schema; a column per field of the dsmr definition
+    self.__schemas = {}
+    for topic, tags in topics.items():
+      types = []
+      for tag, cast in tags.items():
+        if cast is str:
+          types.append((tag, pyarrow.string()))
+        elif tag == "timestamp" or (topic, tag) in integers:
+          types.append((tag, pyarrow.int64()))
+        else:
+          types.append((tag, pyarrow.float64()))
+      self.__schemas[topic] = pyarrow.schema(types)
+
+    # topic:pyarrow.parquet.ParquetWriter
+    self.__writers = {}
+
+  def write(self, columns):
+    """
+    Args:
+      :param dict columns: topic:{tag:numpy array}
+
+    Returns:
+      :rtype: int: number of rows
+    """
+    pyarrow = self.__pyarrow
+
+    nrofrows = 0
+    for topic, tags in columns.items():
+      schema = self.__schemas[topic]
+      if topic not in self.__writers:
+        self.__writers[topic] = pyarrow.parquet.ParquetWriter(f"{self.__output}.{topic}.parquet", schema)
+
+      length = len(tags["timestamp"])
+      arrays = []
+      for field in schema:
+        values = tags.get(field.name)
+        if values is None:
+          arrays.append(pyarrow.nulls(length, field.type))
+        elif values.dtype == numpy.float64:
+          arrays.append(pyarrow.array(values, mask=numpy.isnan(values)).cast(field.type))
+        else:
+          arrays.append(pyarrow.array(values, type=field.type))
+      self.__writers[topic].write_table(pyarrow.Table.from_arrays(arrays, schema=schema))
+      nrofrows += length
+    return nrofrows
+
+  def close(self):
+    for writer in self.__writers.values():
+      writer.close()
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Convert raw dsmr telegram files")
+  parser.add_argument("files", nargs="+", help="raw dsmr files")
+  parser.add_argument("-f", "--format", choices=["lp", "csv", "parquet"], default="lp",
+                      help="InfluxDB line protocol, CSV or Parquet")
+  parser.add_argument("-o", "--output", help="output file (lp; default stdout) or file name prefix (csv, parquet)")
+  parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="number of worker processes")
+  parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="bytes per chunk")
+  parser.add_argument("--measurement", default="dsmr", help="InfluxDB measurement (lp)")
+  parser.add_argument("--topics", nargs="+",
+                      help=f"MQTT topics which are written; default {' '.join(LP_TOPICS)} (lp) or all topics")
+  args = parser.parse_args()
+
+  if args.format != "lp" and args.output is None:
+    parser.error(f"--output is required for {args.format}")
+
+  elements = plan.ParsePlan().elements
+  gas = elements.get(plan.GAS)
+  topics = args.topics or (LP_TOPICS if args.format == "lp" else None)
+
+  out = None
+  if args.format == "lp":
+    # Field types as written by telegraf (telegraf-dsmr.conf) & P1_influx.py
+    integers = encode.integer_fields(elements, encode.TELEGRAF_INTEGERS)
+    out = sys.stdout if args.output is None else open(args.output, 'w')
+    writer = LineProtocolWriter(out, integers, args.measurement)
+  elif args.format == "csv":
+    writer = CsvWriter(args.output, encode.integer_fields(elements), fields(elements))
+  else:
+    writer = ParquetWriter(args.output, encode.integer_fields(elements), fields(elements))
+
+  t_start = time.perf_counter()
+  chunks = [chunk for filename in args.files for chunk in split(filename, args.chunk_size)]
+  telegrams = skipped = nrofrows = 0
+  gas_ts = None
+
+  # Chunks are returned in file order & written as they arrive; the archive is never in memory as a whole
+  with multiprocessing.get_context("fork").Pool(args.jobs, initializer=_init_worker) as pool:
+    for columns, statistics in pool.imap(convert_chunk, chunks, chunksize=1):
+      if gas is not None:
+        gas_ts = _unique_samples(columns, gas.topic, gas_ts)
+      if topics is not None:
+        columns = {topic: tags for topic, tags in columns.items() if topic in topics}
+
+      nrofrows += writer.write(columns)
+      telegrams += statistics["telegrams"]
+      skipped += statistics["skipped"]
+
+  writer.close()
+  if out is not None and out is not sys.stdout:
+    out.close()
+  t_end = time.perf_counter()
+
+  print(f"{telegrams} telegrams ({skipped} without timestamp) in {len(chunks)} chunks; {nrofrows} rows; "
+        f"{t_end - t_start:.2f}s ({telegrams / max(t_end - t_start, 1e-9):.0f} telegrams/s, {args.jobs} jobs)",
+        file=sys.stderr)
+
+
+if __name__ == '__main__':
+  main()
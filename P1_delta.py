@@ -0,0 +1,120 @@
+"""
+Change-only publishing (MQTT_DELTA = True)
+
+Most fields of a telegram (power failures, voltage sags, serial, version, tariff)
+hardly ever change. In delta mode a field is only published when it differs from the
+last published value by more than its deadband (dsmr.deadband); fields without
+deadband are published when they change. The timestamp is always published; a topic
+without changed fields is not published at all.
+
+A full message (keyframe) is published every MQTT_KEYFRAME_INTERVAL seconds and
+after a (re)connect to the MQTT broker, so a consumer that starts late or missed
+messages has all fields within one keyframe interval.
+
+        This program is free software: you can redistribute it and/or modify
+        it under the terms of the GNU General Public License as published by
+        the Free Software Foundation, either version 3 of the License, or
+        (at your option) any later version.
+
+        This program is distributed in the hope that it will be useful,
+        but WITHOUT ANY WARRANTY; without even the implied warranty of
+        MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+        GNU General Public License for more details.
+
+        You should have received a copy of the GNU General Public License
+        along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import dsmr50 as dsmr
+
+# Logging
+import __main__
+import logging
+import os
+script = os.path.basename(__main__.__file__)
+script = os.path.splitext(script)[0]
+logger = logging.getLogger(script + "." + __name__)
+
+
+class DeltaFilter:
+  """
+    Remove unchanged fields from the messages of one meter
+  """
+
+  def __init__(self, plan, deadband=dsmr.deadband, keyframe_interval=300):
+    """
+    Args:
+      :param P1_plan.ParsePlan plan: compiled dsmr definition; provides topic & tag
+      :param dict deadband: OBIS reference:deadband; see dsmr50.py
+      :param int keyframe_interval: seconds between full messages
+    """
+    self.__keyframe_interval = keyframe_interval
+
+    # (topic, tag):deadband
+    self.__deadband = {}
+    for index, value in deadband.items():
+      element = plan.elements.get(index)
+      if element is None:
+        logger.warning(f"Deadband entry {index} is not in dsmr definition")
+      elif element.groups is not None or element.cast is str:
+        logger.warning(f"Deadband entry {index} is not a single number")
+      else:
+        self.__deadband[(element.topic, element.tag)] = value
+
+    # topic:{tag:last published value}
+    self.__published = {}
+    self.__keyframe_ts = None
+
+    # Statistics
+    self.keyframes = 0
+    self.fields = 0
+    self.suppressed = 0
+
+  def keyframe(self):
+    """
+      Publish all fields of next telegram, eg after a reconnect to the MQTT broker
+
+    Returns:
+      None
+    """
+    self.__keyframe_ts = None
+
+  def filter(self, messages, ts):
+    """
+      Remove fields which did not change (beyond deadband) since they were published
+
+    Args:
+      :param dict messages: topic:{tag:value}; modified in place
+      :param int ts: epoch
+
+    Returns:
+      :rtype: bool: True if messages are a keyframe (not filtered)
+    """
+    keyframe = self.__keyframe_ts is None or ts - self.__keyframe_ts >= self.__keyframe_interval
+    if keyframe:
+      self.__keyframe_ts = ts
+      self.keyframes += 1
+
+    deadband = self.__deadband
+    for topic, message in messages.items():
+      published = self.__published.setdefault(topic, {})
+
+      for tag in [tag for tag in message if tag != "timestamp"]:
+        value = message[tag]
+        self.fields += 1
+
+        if not keyframe and tag in published:
+          last = published[tag]
+          if isinstance(value, str) or isinstance(last, str):
+            changed = value != last
+          else:
+            changed = abs(value - last) > deadband.get((topic, tag), 0)
+
+          if not changed:
+            del message[tag]
+            self.suppressed += 1
+            continue
+
+        published[tag] = value
+
+    return keyframe
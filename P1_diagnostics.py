@@ -0,0 +1,202 @@
+"""
+  Internal pipeline metrics, published every DIAGNOSTICS_INTERVAL seconds on <MQTT_TOPIC_PREFIX>/diagnostics
+
+  Per stage of the pipeline a histogram of durations is collected; histograms are reset after
+  every diagnostics message, so percentiles are of the last interval:
+    read      first byte of telegram read till telegram complete (P1 transmission & USB latency)
+    frame     framing & CRC check of a telegram
+    parse     parse telegram to MQTT messages
+    encode    encode MQTT messages of a telegram, all formats (P1_encode.py)
+    publish   hand over MQTT messages of a telegram to the MQTT client
+
+  Counters are cumulative since start; they are read from their source (framer, channel,
+  sinks, MQTT client) when the diagnostics message is composed, eg
+    {"channel":{"dropped":0,"high_water":1},"mqtt":{"connect_count":1,"published_count":2214,"queue_depth":0},
+     "parser":{"gaps":0,"skipped":0,"telegrams":1107},"serial":{"crc_errors":0,...},
+     "stages":{"parse":{"avg":0.147,"max":0.402,"n":60,"p50":0.2,"p99":0.5},...},"timestamp":1638734909}
+  Durations are in ms. Cost per telegram is a few perf_counter() calls & integer increments.
+
+        This program is free software: you can redistribute it and/or modify
+        it under the terms of the GNU General Public License as published by
+        the Free Software Foundation, either version 3 of the License, or
+        (at your option) any later version.
+
+        This program is distributed in the hope that it will be useful,
+        but WITHOUT ANY WARRANTY; without even the implied warranty of
+        MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+        GNU General Public License for more details.
+
+        You should have received a copy of the GNU General Public License
+        along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import threading
+import json
+import time
+
+import P1_framer as framer
+import P1_latency as latency
+
+# Logging
+import __main__
+import logging
+import os
+script = os.path.basename(__main__.__file__)
+script = os.path.splitext(script)[0]
+logger = logging.getLogger(script + "." + __name__)
+
+# Stages
+READ = "read"
+FRAME = "frame"
+PARSE = "parse"
+ENCODE = "encode"
+PUBLISH = "publish"
+
+# Upper bounds of histogram buckets [ms]; stages take microseconds (parse) up to a second (read)
+BUCKETS = (0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000)
+
+# Statistics of a framer
+FRAMER_COUNTERS = ("telegrams", "crc_errors", "truncated", "discarded_bytes")
+
+
+class Diagnostics:
+  """
+    Stage histograms & counters of the pipeline
+  """
+
+  def __init__(self):
+    self.stages = {name: latency.LatencyHistogram(BUCKETS) for name in (READ, FRAME, PARSE, ENCODE, PUBLISH)}
+
+    # name:count; counted by parser
+    self.counters = {}
+
+    # name:(source, attributes); counters read from source when message is composed
+    self.__sources = {}
+
+    # stages are added from reader, parser & sink threads
+    self.__lock = threading.Lock()
+
+  def add(self, stage, seconds):
+    """
+    Args:
+      :param str stage: READ, FRAME, PARSE, ENCODE or PUBLISH
+      :param float seconds: duration, eg difference of time.perf_counter()
+
+    Returns:
+      None
+    """
+    with self.__lock:
+      self.stages[stage].add(seconds * 1000)
+
+  def count(self, name, n=1):
+    """
+    Args:
+      :param str name: counter, eg "skipped"
+      :param int n: increment
+
+    Returns:
+      None
+    """
+    self.counters[name] = self.counters.get(name, 0) + n
+
+  def register(self, name, source, attributes):
+    """
+      Report counters of a source; a source with the same name is replaced
+
+    Args:
+      :param str name: key in diagnostics message, eg "channel"
+      :param source: object with counters, eg P1_channel.TelegramChannel
+      :param tuple attributes: attribute names; callable attributes are called without arguments
+
+    Returns:
+      None
+    """
+    self.__sources[name] = (source, attributes)
+
+  def message(self, ts=None):
+    """
+      Compose diagnostics message & reset stage histograms
+
+    Args:
+      :param int ts: epoch; None is now
+
+    Returns:
+      :rtype: dict
+    """
+    message = {"parser": dict(self.counters)}
+    for name, (source, attributes) in list(self.__sources.items()):
+      values = {}
+      for attribute in attributes:
+        value = getattr(source, attribute, None)
+        values[attribute] = value() if callable(value) else value
+      message[name] = values
+
+    with self.__lock:
+      stages, self.stages = self.stages, {name: latency.LatencyHistogram(BUCKETS) for name in self.stages}
+
+    message["stages"] = {name: _summary(histogram) for name, histogram in stages.items() if histogram.count}
+    message["timestamp"] = int(time.time()) if ts is None else ts
+    return message
+
+  def encode(self, ts=None):
+    """
+    Returns:
+      :rtype: str: diagnostics message as json; sorted keys, no whitespace (as MQTT messages)
+    """
+    return json.dumps(self.message(ts), sort_keys=True, separators=(',', ':'))
+
+
+def _summary(histogram):
+  return {"n": histogram.count,
+          "avg": round(histogram.sum / histogram.count, 3),
+          "p50": round(histogram.percentile(50), 3),
+          "p99": round(histogram.percentile(99), 3),
+          "max": round(histogram.max, 3)}
+
+
+# Diagnostics of this process; shared by readers, parser & sinks
+pipeline = Diagnostics()
+
+
+class TimedFramer(framer.TelegramFramer):
+  """
+    Framer which adds the read & frame stages of every telegram to the diagnostics
+  """
+
+  def __init__(self, name, diagnostics=None, max_size=8192):
+    """
+    Args:
+      :param str name: key of framer counters in diagnostics message, eg "serial"
+      :param Diagnostics diagnostics: None is pipeline
+      :param int max_size: max size in bytes of a telegram
+    """
+    super().__init__(max_size)
+    self.__diagnostics = pipeline if diagnostics is None else diagnostics
+    self.__diagnostics.register(name, self, FRAMER_COUNTERS)
+
+    # perf_counter() of first read of current telegram & time spent in framer for current telegram
+    self.__first = None
+    self.__framing = 0.0
+
+  def feed(self, data):
+    started = time.perf_counter()
+
+    # No incomplete telegram in buffer; data starts a new telegram
+    if not len(self):
+      self.__first = started
+      self.__framing = 0.0
+
+    frames = super().feed(data)
+    done = time.perf_counter()
+    self.__framing += done - started
+
+    if frames:
+      for _frame in frames:
+        self.__diagnostics.add(READ, done - self.__first)
+        self.__diagnostics.add(FRAME, self.__framing / len(frames))
+
+      # Remaining data started in this read
+      self.__first = started
+      self.__framing = 0.0
+
+    return frames
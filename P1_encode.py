@@ -0,0 +1,738 @@
+"""
+  Encoding of parsed telegrams (MQTT messages per topic) for the sinks (P1_sinks.py)
+
+  A telegram is encoded once per format and the result is shared by all sinks of that format:
+    json  MQTT json message per topic: {"p_consumed":866.0,...,"timestamp":1638734909}
+    lp    InfluxDB line protocol per topic, as written by telegraf (telegraf-dsmr.conf):
+          measurement "dsmr", tag "serial", epoch seconds
+
+  Compact binary formats of the MQTT messages (MQTT_FORMAT); same keys & values as json:
+    msgpack   MessagePack map per topic
+    cbor      CBOR map per topic (RFC 8949)
+    protobuf  protobuf message per topic; integer field ids instead of tags, see ProtobufSchema
+  Floats are encoded as float32 when that is lossless (eg 866.0, 16230132.0), otherwise as float64.
+  The format, and the protobuf schema, are advertised (retained) on <prefix>/metadata; see metadata().
+
+  The encoded payload is a list of (topic, data); topic is without MQTT topic prefix.
+  Topics without fields (only a timestamp) are not encoded.
+
+  json is byte-identical to json.dumps(message, sort_keys=True, separators=(',', ':')), but a
+  message is not sorted & encoded key by key: per topic and set of keys, a format string with the
+  sorted keys is compiled once. When orjson is installed, it is used instead; its output is
+  checked for the few cases in which it differs (very large & small floats, NaN, non-ASCII) and those
+  messages are encoded without orjson.
+
+        This program is free software: you can redistribute it and/or modify
+        it under the terms of the GNU General Public License as published by
+        the Free Software Foundation, either version 3 of the License, or
+        (at your option) any later version.
+
+        This program is distributed in the hope that it will be useful,
+        but WITHOUT ANY WARRANTY; without even the implied warranty of
+        MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+        GNU General Public License for more details.
+
+        You should have received a copy of the GNU General Public License
+        along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import operator
+import struct
+import json
+import math
+import re
+
+try:
+  import orjson
+except ImportError:
+  orjson = None
+
+import P1_framer as framer
+import dsmr50 as dsmr
+
+# Logging
+import __main__
+import logging
+import os
+script = os.path.basename(__main__.__file__)
+script = os.path.splitext(script)[0]
+logger = logging.getLogger(script + "." + __name__)
+
+# Formats
+JSON = "json"
+LP = "lp"
+MSGPACK = "msgpack"
+CBOR = "cbor"
+PROTOBUF = "protobuf"
+
+# Formats of MQTT messages (MQTT_FORMAT); content type advertised on metadata topic
+CONTENT_TYPES = {
+  JSON: "application/json",
+  MSGPACK: "application/msgpack",
+  CBOR: "application/cbor",
+  PROTOBUF: "application/x-protobuf",
+}
+
+# Influxdb tag (as in telegraf-dsmr.conf); other keys are fields
+INFLUX_TAGS = ("serial",)
+
+# Fields converted to "uint" in telegraf-dsmr.conf
+TELEGRAF_INTEGERS = ("V1", "V2", "V3", "V1_sags", "V2_sags", "V3_sags", "V1_swells", "V2_swells", "V3_swells",
+                     "el_consumed", "el_returned", "p_consumed", "p_generated", "long_power_failures",
+                     "power_failures", "gas_consumed")
+
+# Max number of compiled json formats per encoder; in delta mode (MQTT_DELTA) the keys of a message vary
+MAX_TEMPLATES = 256
+
+# Exponent of a float in orjson output, eg 1e16; lookbehind is faster than [0-9]e
+_EXPONENT = re.compile(rb'e(?<=[0-9]e)')
+
+# Characters escaped in line protocol
+TAG_ESCAPE = "\\, ="
+FIELD_ESCAPE = "\\\""
+
+
+def escape(value, characters):
+  """
+  Args:
+    :param str value:
+    :param str characters: characters to escape with a backslash
+
+  Returns:
+    :rtype: str
+  """
+  for character in characters:
+    value = value.replace(character, "\\" + character)
+  return value
+
+
+def integer_fields(elements, names=None):
+  """
+  Args:
+    :param dict elements: OBIS reference:P1_plan._Element
+    :param tuple names: tags which are written as integer, eg TELEGRAF_INTEGERS (line protocol: the field
+                        types of telegraf-dsmr.conf; other fields are float, as written by telegraf);
+                        None is all fields of int datatype
+
+  Returns:
+    :rtype: set: (topic, tag) of fields written as integer
+  """
+  integers = set()
+  for element in elements.values():
+    if element.groups is None:
+      fields = [(element.tag, element.cast)]
+    else:
+      fields = [(tag, cast) for _position, tag, cast, _factor in element.groups]
+
+    for tag, cast in fields:
+      integer = cast in (int, framer.dsmr_timestamp) if names is None else tag in names
+      if integer:
+        integers.add((element.topic, tag))
+  return integers
+
+
+def line_protocol(measurement, topic, message, integers):
+  """
+  Args:
+    :param str measurement: influxdb measurement, escaped
+    :param str topic: MQTT topic (without prefix)
+    :param dict message: {tag:value}, including "timestamp" (epoch)
+    :param set integers: (topic, tag) of integer fields
+
+  Returns:
+    :rtype: str: line protocol, without newline; None if message has no fields
+  """
+  tags = []
+  fields = []
+  for tag, value in message.items():
+    if tag == "timestamp" or value is None:
+      continue
+    if tag in INFLUX_TAGS:
+      tags.append(f",{tag}={escape(str(value), TAG_ESCAPE)}")
+    elif isinstance(value, str):
+      fields.append(f'{tag}="{escape(value, FIELD_ESCAPE)}"')
+    elif isinstance(value, float) and math.isnan(value):
+      continue
+    elif (topic, tag) in integers:
+      fields.append(f"{tag}={int(value)}i")
+    else:
+      fields.append(f"{tag}={float(value)!r}")
+
+  if not fields:
+    return None
+  return f"{measurement}{''.join(tags)} {','.join(fields)} {message['timestamp']}"
+
+
+def _orjson_differs(data):
+  """
+  Args:
+    :param bytes data: output of orjson
+
+  Returns:
+    :rtype: bool: True if json.dumps might differ; non-ASCII & DEL characters (json escapes them),
+                  floats >= 1e16 or < 1e-4 (json uses an exponent), NaN & Infinity (orjson: null)
+  """
+  return (not data.isascii() or b"\x7f" in data or b"null" in data or b"0.0000" in data or
+          _EXPONENT.search(data) is not None)
+
+
+class _JsonTemplate:
+  """
+    Compiled json format of a message with a fixed set of keys
+  """
+
+  def __init__(self, message):
+    """
+    Args:
+      :param dict message: {tag:value}; keys & types of values are compiled
+    """
+    keys = sorted(message)
+    self.types = tuple(type(message[key]) for key in keys)
+
+    # Values in sorted order of keys
+    self.values = operator.itemgetter(*keys) if len(keys) > 1 else lambda m: tuple(m[key] for key in keys)
+
+    # Strings are escaped (json) before formatting; float & int are formatted by repr(), as json does
+    self.strings = tuple(i for i, t in enumerate(self.types) if t is str)
+    self.floats = float in self.types
+
+    # None if a value is not a float, int or str (eg bool, None); such messages are encoded by json
+    if all(t in (float, int, str) for t in self.types):
+      self.format = "{" + ",".join(json.dumps(key).replace("%", "%%") + ":" + ("%s" if t is str else "%r")
+                                   for key, t in zip(keys, self.types)) + "}"
+    else:
+      self.format = None
+
+  def encode(self, message):
+    """
+    Returns:
+      :rtype: str: json; None if types of values differ from compiled message, or a float is NaN or infinite
+    """
+    values = self.values(message)
+    if self.format is None or tuple(map(type, values)) != self.types:
+      return None
+
+    if self.strings:
+      values = list(values)
+      for i in self.strings:
+        values[i] = json.encoder.encode_basestring_ascii(values[i])
+      values = tuple(values)
+
+    data = self.format % values
+    if self.floats and ("nan" in data or "inf" in data):
+      return None
+    return data
+
+
+class JsonEncoder:
+  """
+    MQTT json messages; sorted keys, no whitespace
+  """
+
+  def __init__(self, fast=True):
+    """
+    Args:
+      :param bool fast: use orjson when installed
+    """
+    self.__orjson = orjson if fast else None
+
+    # (topic, keys in order of message):_JsonTemplate
+    self.__templates = {}
+
+  def dumps(self, topic, message):
+    """
+    Args:
+      :param str topic: MQTT topic (without prefix)
+      :param dict message: {tag:value}
+
+    Returns:
+      :rtype: str: as json.dumps(message, sort_keys=True, separators=(',', ':'))
+    """
+    if self.__orjson is not None:
+      try:
+        data = self.__orjson.dumps(message, option=self.__orjson.OPT_SORT_KEYS)
+        if not _orjson_differs(data):
+          return data.decode()
+      except TypeError:
+        # eg integers of more than 64 bits
+        pass
+
+    key = (topic, tuple(message))
+    template = self.__templates.get(key)
+    if template is None:
+      if len(self.__templates) >= MAX_TEMPLATES:
+        self.__templates.clear()
+      template = self.__templates[key] = _JsonTemplate(message)
+
+    data = template.encode(message)
+    if data is None:
+      data = json.dumps(message, sort_keys=True, separators=(',', ':'))
+    return data
+
+  def encode(self, prefix, messages):
+    """
+    Args:
+      :param str prefix: MQTT topic prefix (meter)
+      :param dict messages: topic:{tag:value}
+
+    Returns:
+      :rtype: list: (topic, json string)
+    """
+    # There is always a timestamp key:value in the dictionary (len = 1)
+    # If there are no other key-value pairs, the topic is skipped
+    return [(topic, self.dumps(topic, message)) for topic, message in messages.items() if len(message) > 1]
+
+
+class LineEncoder:
+  """
+    InfluxDB line protocol
+  """
+
+  def __init__(self, integers, measurement="dsmr"):
+    """
+    Args:
+      :param set integers: (topic, tag) of integer fields; see integer_fields()
+      :param str measurement: influxdb measurement
+    """
+    self.__integers = integers
+    self.__measurement = escape(measurement, TAG_ESCAPE)
+
+    # Last value of tags per (prefix, topic); in delta mode (MQTT_DELTA) unchanged tags are not in the message
+    self.__tags = {}
+
+  def encode(self, prefix, messages):
+    """
+    Args:
+      :param str prefix: MQTT topic prefix (meter)
+      :param dict messages: topic:{tag:value}; not modified
+
+    Returns:
+      :rtype: list: (topic, line)
+    """
+    lines = []
+    for topic, message in messages.items():
+      tags = self.__tags.setdefault((prefix, topic), {})
+      for tag in INFLUX_TAGS:
+        if tag in message:
+          tags[tag] = message[tag]
+        elif tag in tags:
+          message = {**message, tag: tags[tag]}
+
+      line = line_protocol(self.__measurement, topic, message, self.__integers)
+      if line is not None:
+        lines.append((topic, line))
+    return lines
+
+
+_FLOAT32 = struct.Struct(">f")
+_FLOAT64 = struct.Struct(">d")
+_UINT16 = struct.Struct(">H")
+_UINT32 = struct.Struct(">I")
+_UINT64 = struct.Struct(">Q")
+_INT16 = struct.Struct(">h")
+_INT32 = struct.Struct(">i")
+_INT64 = struct.Struct(">q")
+
+
+def _float32(value):
+  """
+  Returns:
+    :rtype: bytes: big-endian float32; None if value cannot be represented as float32 without loss
+  """
+  try:
+    data = _FLOAT32.pack(value)
+  except OverflowError:
+    return None
+  return data if _FLOAT32.unpack(data)[0] == value else None
+
+
+def _msgpack_head(small, size, prefixes):
+  # Header of str & map: fixstr/fixmap, or type byte & 8/16/32-bit size
+  if size < small:
+    return bytes((prefixes[0] | size,))
+  if size <= 0xFF and prefixes[1] is not None:
+    return bytes((prefixes[1], size))
+  if size <= 0xFFFF:
+    return bytes((prefixes[2],)) + _UINT16.pack(size)
+  return bytes((prefixes[3],)) + _UINT32.pack(size)
+
+
+def msgpack_value(value):
+  """
+  Args:
+    :param value: str, int, float, bool, None or list of these (batches, P1_batch.py)
+
+  Returns:
+    :rtype: bytes: MessagePack
+  """
+  if isinstance(value, str):
+    data = value.encode()
+    return _msgpack_head(32, len(data), (0xA0, 0xD9, 0xDA, 0xDB)) + data
+  if value is None:
+    return b"\xc0"
+  if value is True:
+    return b"\xc3"
+  if value is False:
+    return b"\xc2"
+  if isinstance(value, int):
+    if 0 <= value <= 0x7F:
+      return bytes((value,))
+    if -32 <= value < 0:
+      return bytes((value & 0xFF,))
+    if value > 0:
+      if value <= 0xFF:
+        return bytes((0xCC, value))
+      if value <= 0xFFFF:
+        return b"\xcd" + _UINT16.pack(value)
+      if value <= 0xFFFFFFFF:
+        return b"\xce" + _UINT32.pack(value)
+      return b"\xcf" + _UINT64.pack(value)
+    if value >= -0x80:
+      return bytes((0xD0, value & 0xFF))
+    if value >= -0x8000:
+      return b"\xd1" + _INT16.pack(value)
+    if value >= -0x80000000:
+      return b"\xd2" + _INT32.pack(value)
+    return b"\xd3" + _INT64.pack(value)
+  if isinstance(value, list):
+    return _msgpack_head(16, len(value), (0x90, None, 0xDC, 0xDD)) + b"".join(map(msgpack_value, value))
+  data = _float32(value)
+  if data is not None:
+    return b"\xca" + data
+  return b"\xcb" + _FLOAT64.pack(value)
+
+
+def msgpack_map(size):
+  """
+  Returns:
+    :rtype: bytes: MessagePack header of map with size items
+  """
+  return _msgpack_head(16, size, (0x80, None, 0xDE, 0xDF))
+
+
+def _cbor_head(major, argument):
+  # Initial byte (major type & additional information) and argument
+  major <<= 5
+  if argument < 24:
+    return bytes((major | argument,))
+  if argument <= 0xFF:
+    return bytes((major | 24, argument))
+  if argument <= 0xFFFF:
+    return bytes((major | 25,)) + _UINT16.pack(argument)
+  if argument <= 0xFFFFFFFF:
+    return bytes((major | 26,)) + _UINT32.pack(argument)
+  return bytes((major | 27,)) + _UINT64.pack(argument)
+
+
+def cbor_value(value):
+  """
+  Args:
+    :param value: str, int, float, bool, None or list of these (batches, P1_batch.py)
+
+  Returns:
+    :rtype: bytes: CBOR
+  """
+  if isinstance(value, str):
+    data = value.encode()
+    return _cbor_head(3, len(data)) + data
+  if value is None:
+    return b"\xf6"
+  if value is True:
+    return b"\xf5"
+  if value is False:
+    return b"\xf4"
+  if isinstance(value, int):
+    return _cbor_head(0, value) if value >= 0 else _cbor_head(1, -1 - value)
+  if isinstance(value, list):
+    return _cbor_head(4, len(value)) + b"".join(map(cbor_value, value))
+  data = _float32(value)
+  if data is not None:
+    return b"\xfa" + data
+  return b"\xfb" + _FLOAT64.pack(value)
+
+
+def cbor_map(size):
+  """
+  Returns:
+    :rtype: bytes: CBOR header of map with size items
+  """
+  return _cbor_head(5, size)
+
+
+class _MapEncoder:
+  """
+    MQTT message per topic as binary map; subclasses set the map header & value functions
+  """
+
+  map = None
+  value = None
+
+  def __init__(self):
+    # tag:encoded key
+    self.__keys = {}
+
+  def dumps(self, message):
+    """
+    Args:
+      :param dict message: {tag:value}
+
+    Returns:
+      :rtype: bytes
+    """
+    keys = self.__keys
+    value = self.value
+    parts = [self.map(len(message))]
+    for tag, data in message.items():
+      key = keys.get(tag)
+      if key is None:
+        key = keys[tag] = value(tag)
+      parts.append(key)
+      parts.append(value(data))
+    return b"".join(parts)
+
+  def encode(self, prefix, messages):
+    """
+    Args:
+      :param str prefix: MQTT topic prefix (meter)
+      :param dict messages: topic:{tag:value}
+
+    Returns:
+      :rtype: list: (topic, bytes)
+    """
+    # Topics with only a timestamp are skipped
+    return [(topic, self.dumps(message)) for topic, message in messages.items() if len(message) > 1]
+
+
+class MsgpackEncoder(_MapEncoder):
+  """
+    MessagePack map per topic
+  """
+  map = staticmethod(msgpack_map)
+  value = staticmethod(msgpack_value)
+
+
+class CborEncoder(_MapEncoder):
+  """
+    CBOR map per topic
+  """
+  map = staticmethod(cbor_map)
+  value = staticmethod(cbor_value)
+
+
+# Protobuf field types
+SINT64 = "sint64"
+DOUBLE = "double"
+STRING = "string"
+
+# Protobuf wire types
+_VARINT = 0
+_FIXED64 = 1
+_LENGTH = 2
+
+_PROTOBUF_WIRE_TYPES = {SINT64: _VARINT, DOUBLE: _FIXED64, STRING: _LENGTH}
+
+# Little-endian double (protobuf)
+_DOUBLE = struct.Struct("<d")
+
+# Field id of the timestamp in every message
+TIMESTAMP_ID = 1
+
+
+def varint(value):
+  """
+  Args:
+    :param int value: >= 0
+
+  Returns:
+    :rtype: bytes: protobuf base 128 varint
+  """
+  if value < 0x80:
+    return bytes((value,))
+  data = bytearray()
+  while value > 0x7F:
+    data.append((value & 0x7F) | 0x80)
+    value >>= 7
+  data.append(value)
+  return bytes(data)
+
+
+def _identifier(name):
+  # Valid protobuf message or field name, eg "V1_sags"
+  name = re.sub(r"[^a-zA-Z0-9_]", "_", name)
+  return name if name[:1].isalpha() else "f_" + name
+
+
+class ProtobufSchema:
+  """
+    Protobuf message per topic, with integer field ids derived from the dsmr definition
+
+    Field 1 is the timestamp; fields of the topic follow in order of dsmr50.py (definition; values of
+    multi-value entries in order of their tags), then the statistics of aggregated entries (aggregate).
+    Field ids change when fields are added to or removed from dsmr50.py; consumers decode with the schema
+    as advertised on the metadata topic.
+  """
+
+  def __init__(self, plan, aggregate=dsmr.aggregate):
+    """
+    Args:
+      :param P1_plan.ParsePlan plan: compiled dsmr definition; provides topic, tag & datatype
+      :param dict aggregate: OBIS reference:[statistics]; see dsmr50.py
+    """
+    # topic:{tag:(field id, type)}, in order of field id
+    self.topics = {}
+
+    for element in plan.elements.values():
+      if element.groups is None:
+        fields = [(element.tag, element.cast)]
+      else:
+        fields = [(tag, cast) for _position, tag, cast, _factor in element.groups]
+      for tag, cast in fields:
+        self.__add(element.topic, tag, _protobuf_type(cast))
+
+    for index, statistics in aggregate.items():
+      element = plan.elements.get(index)
+      if element is None or element.groups is not None or element.cast is str:
+        continue
+      for statistic in statistics:
+        self.__add(element.topic, f"{element.tag}_{statistic}",
+                   DOUBLE if statistic == "avg" else _protobuf_type(element.cast))
+
+  def __add(self, topic, tag, kind):
+    fields = self.topics.setdefault(topic, {"timestamp": (TIMESTAMP_ID, SINT64)})
+    if tag not in fields:
+      fields[tag] = (len(fields) + 1, kind)
+
+  def proto(self, package="dsmr"):
+    """
+    Returns:
+      :rtype: str: schema as .proto file (proto3); optional fields, as in delta mode (MQTT_DELTA)
+                   fields are not in every message
+    """
+    lines = ['syntax = "proto3";', "", f"package {package};"]
+    for topic, fields in self.topics.items():
+      lines.append("")
+      lines.append(f"message {_identifier(topic)} {{")
+      lines.extend(f"  optional {kind} {_identifier(tag)} = {field_id};" for tag, (field_id, kind) in fields.items())
+      lines.append("}")
+    return "\n".join(lines) + "\n"
+
+
+def _protobuf_type(cast):
+  if cast is str:
+    return STRING
+  if cast in (int, framer.dsmr_timestamp):
+    return SINT64
+  return DOUBLE
+
+
+class ProtobufEncoder:
+  """
+    Protobuf message per topic; see ProtobufSchema
+  """
+
+  def __init__(self, schema):
+    """
+    Args:
+      :param ProtobufSchema schema:
+    """
+    # topic:{tag:(encoded field key, type)}
+    self.__fields = {topic: {tag: (varint(field_id << 3 | _PROTOBUF_WIRE_TYPES[kind]), kind)
+                             for tag, (field_id, kind) in fields.items()}
+                     for topic, fields in schema.topics.items()}
+
+    # (topic, tag) not in schema; logged once
+    self.__unknown = set()
+
+  def dumps(self, topic, message):
+    """
+    Args:
+      :param str topic: MQTT topic (without prefix)
+      :param dict message: {tag:value}; fields not in schema and None values are skipped
+
+    Returns:
+      :rtype: bytes
+    """
+    fields = self.__fields.get(topic, {})
+    parts = []
+    for tag, value in message.items():
+      field = fields.get(tag)
+      if field is None or value is None:
+        if field is None and (topic, tag) not in self.__unknown:
+          self.__unknown.add((topic, tag))
+          logger.warning(f"Field {topic}/{tag} is not in protobuf schema; skipped")
+        continue
+
+      key, kind = field
+      try:
+        if kind is DOUBLE:
+          parts.append(key + _DOUBLE.pack(value))
+        elif kind is SINT64:
+          # zigzag encoding
+          value = int(value)
+          parts.append(key + varint(value << 1 if value >= 0 else (-value << 1) - 1))
+        else:
+          data = str(value).encode()
+          parts.append(key + varint(len(data)) + data)
+      except (ValueError, OverflowError, struct.error) as e:
+        logger.debug(f"Exception {e}; {topic}/{tag} = {value!r} skipped")
+    return b"".join(parts)
+
+  def encode(self, prefix, messages):
+    """
+    Args:
+      :param str prefix: MQTT topic prefix (meter)
+      :param dict messages: topic:{tag:value}
+
+    Returns:
+      :rtype: list: (topic, bytes)
+    """
+    return [(topic, self.dumps(topic, message)) for topic, message in messages.items() if len(message) > 1]
+
+
+def encoder(format, plan):
+  """
+  Args:
+    :param str format: JSON, LP, MSGPACK, CBOR or PROTOBUF
+    :param P1_plan.ParsePlan plan: compiled dsmr definition; provides datatypes
+
+  Returns:
+    encoder with encode(prefix, messages)
+  """
+  if format == JSON:
+    return JsonEncoder()
+  if format == LP:
+    return LineEncoder(integer_fields(plan.elements, TELEGRAF_INTEGERS))
+  if format == MSGPACK:
+    return MsgpackEncoder()
+  if format == CBOR:
+    return CborEncoder()
+  if format == PROTOBUF:
+    return ProtobufEncoder(ProtobufSchema(plan))
+  raise ValueError(f"Unknown format {format}")
+
+
+def metadata(format, plan, columnar=False):
+  """
+    Metadata of MQTT messages, so consumers can decode them; published (retained) on <prefix>/metadata, eg
+      {"content_type":"application/msgpack","format":"msgpack"}
+    protobuf adds the field ids & types per topic and the schema as .proto file:
+      {"content_type":"application/x-protobuf","fields":{"el":{"timestamp":[1,"sint64"],...}},
+       "format":"protobuf","proto":"syntax = \"proto3\";..."}
+    Batched MQTT messages (P1_batch.py) add "layout":"columnar"
+
+  Args:
+    :param str format: JSON, MSGPACK, CBOR or PROTOBUF
+    :param P1_plan.ParsePlan plan: compiled dsmr definition
+    :param bool columnar: MQTT messages are batches; tag:[values]
+
+  Returns:
+    :rtype: str: json
+  """
+  message = {"format": format, "content_type": CONTENT_TYPES[format]}
+  if columnar:
+    message["layout"] = "columnar"
+  if format == PROTOBUF:
+    schema = ProtobufSchema(plan)
+    message["fields"] = schema.topics
+    message["proto"] = schema.proto()
+  return json.dumps(message, sort_keys=True, separators=(',', ':'))
@@ -0,0 +1,311 @@
+"""
+Split a raw P1 byte stream into dsmr telegrams and validate the CRC16
+
+A dsmr telegram starts with "/" and ends with "!" followed by a 4 character
+hexadecimal CRC16 and CR LF:
+
+  /Ene5\\T210-D ESMR5.0
+  ...
+  0-1:24.2.1(211205210500W)(10142.194*m3)
+  !43A6
+
+The CRC16 (polynomial 0xA001, initial value 0) is calculated over all bytes from
+"/" up to and including "!". Older dsmr versions (< 4.0) do not send a CRC;
+these telegrams are accepted as is.
+
+Bytes are fed in bulk (whatever is available in the serial buffer) and
+complete telegrams are returned; incomplete data stays in a reusable buffer
+till the next feed.
+
+Helpers convert a telegram to lines and dsmr timestamps (YYMMDDhhmmssX) to epoch.
+
+Measure the framing cost per telegram:
+  python3 P1_framer.py test/dsmr.raw
+
+        This program is free software: you can redistribute it and/or modify
+        it under the terms of the GNU General Public License as published by
+        the Free Software Foundation, either version 3 of the License, or
+        (at your option) any later version.
+
+        This program is distributed in the hope that it will be useful,
+        but WITHOUT ANY WARRANTY; without even the implied warranty of
+        MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+        GNU General Public License for more details.
+
+        You should have received a copy of the GNU General Public License
+        along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import sys
+import time
+import functools
+import datetime
+
+# Logging
+import __main__
+import logging
+import os
+script = os.path.basename(__main__.__file__)
+script = os.path.splitext(script)[0]
+logger = logging.getLogger(script + "." + __name__)
+
+
+def _crc16_table():
+  """
+    Lookup table for CRC16/ARC (reflected polynomial 0xA001)
+
+  Returns:
+    list of 256 ints
+  """
+  table = []
+  for byte in range(256):
+    crc = byte
+    for _i in range(8):
+      if crc & 0x0001:
+        crc = (crc >> 1) ^ 0xA001
+      else:
+        crc >>= 1
+    table.append(crc)
+  return table
+
+
+CRC16_TABLE = _crc16_table()
+
+
+def crc16(data, crc=0):
+  """
+    Calculate CRC16 of data
+
+  Args:
+    :param bytes data: bytes, bytearray or memoryview
+    :param int crc: initial value (or intermediate value when calculating in parts)
+
+  Returns:
+    :rtype: int
+  """
+  table = CRC16_TABLE
+  for byte in data:
+    crc = (crc >> 8) ^ table[(crc ^ byte) & 0xFF]
+  return crc
+
+
+def telegram_lines(frame):
+  """
+    Convert a raw telegram to a list of lines, as used by the parser
+    Header line is included, CRC line ("!xxxx") is excluded
+
+  Args:
+    :param bytes frame: raw telegram, as returned by TelegramFramer.feed()
+
+  Returns:
+    :rtype: list
+  """
+  end = frame.rfind(b'!')
+  return frame[:end].decode('ascii', errors='replace').splitlines()
+
+
+# DST flag of dsmr timestamps: W(inter) = CET, S(ummer) = CEST
+# OBIS reference of meter timestamp
+METER_TIME = "0-0:1.0.0"
+
+TIMEZONES = {"W": datetime.timezone(datetime.timedelta(hours=1)),
+             "S": datetime.timezone(datetime.timedelta(hours=2))}
+
+
+# Same timestamps recur in every telegram (gas capture time, power failure log)
+@functools.lru_cache(maxsize=256)
+def dsmr_timestamp(value):
+  """
+    Convert dsmr timestamp to epoch
+
+  Args:
+    :param str value: YYMMDDhhmmssX, X = W or S, eg "211205210829W"
+
+  Returns:
+    :rtype: int: epoch seconds
+  """
+  tz = TIMEZONES.get(value[12:13], TIMEZONES["W"])
+  return int(datetime.datetime(2000 + int(value[0:2]), int(value[2:4]), int(value[4:6]),
+                               int(value[6:8]), int(value[8:10]), int(value[10:12]), tzinfo=tz).timestamp())
+
+
+def meter_time(lines, obis=METER_TIME):
+  """
+    Find meter timestamp (0-0:1.0.0) in telegram, or capture time of an M-Bus value (eg gas, 0-1:24.2.1)
+
+  Args:
+    :param list lines: telegram lines
+    :param str obis: OBIS reference of a line which starts with a timestamp
+
+  Returns:
+    :rtype: int: epoch seconds, None if telegram has no (valid) timestamp
+  """
+  start = len(obis) + 1
+  for line in lines:
+    if line.startswith(obis) and line[start - 1:start] == "(":
+      try:
+        return dsmr_timestamp(line[start:start + 13])
+      except ValueError:
+        return None
+  return None
+
+
+class TelegramFramer:
+  """
+    Find telegram boundaries in a byte stream and validate CRC
+  """
+
+  def __init__(self, max_size=8192):
+    """
+    Args:
+      :param int max_size: max size in bytes of a telegram; larger telegrams are discarded
+    """
+    self.__buffer = bytearray()
+    self.__max_size = max_size
+
+    # Called with the data of every rejected telegram (CRC error, truncated); eg P1_capture.CaptureRecorder
+    self.rejected = None
+
+    # Statistics
+    self.telegrams = 0
+    self.crc_errors = 0
+    self.truncated = 0
+    self.discarded_bytes = 0
+
+  def reset(self):
+    """
+      Drop buffered (incomplete) data, eg after reconnecting or reopening a port
+
+    Returns:
+      None
+    """
+    self.discarded_bytes += len(self.__buffer)
+    self.__buffer.clear()
+
+  def __len__(self):
+    # Buffered bytes of incomplete telegram
+    return len(self.__buffer)
+
+  def feed(self, data):
+    """
+      Add data to buffer and return complete and valid telegrams
+
+    Args:
+      :param bytes data: raw data as read from serial port (any size)
+
+    Returns:
+      list of bytes; each item is a complete telegram, including "!CRC\\r\\n"
+    """
+    buffer = self.__buffer
+    buffer += data
+    frames = []
+
+    while True:
+      start = buffer.find(b'/')
+      if start < 0:
+        self.discarded_bytes += len(buffer)
+        buffer.clear()
+        break
+
+      # Drop noise before start of telegram
+      if start > 0:
+        self.discarded_bytes += start
+        del buffer[:start]
+
+      end = buffer.find(b'!')
+
+      # A new telegram started before the current one was completed; drop the incomplete part
+      restart = buffer.find(b'\n/', 0, len(buffer) if end < 0 else end)
+      if restart >= 0:
+        self.__reject(buffer[:restart + 1])
+        self.truncated += 1
+        self.discarded_bytes += restart + 1
+        del buffer[:restart + 1]
+        continue
+
+      if end < 0:
+        if len(buffer) > self.__max_size:
+          logger.warning(f"Telegram exceeds {self.__max_size} bytes; discarded")
+          self.__reject(buffer)
+          self.truncated += 1
+          self.discarded_bytes += len(buffer)
+          buffer.clear()
+        break
+
+      # Wait till CRC line is complete
+      eol = buffer.find(b'\n', end)
+      if eol < 0:
+        # Corrupt trailer; restart search after the "!"
+        if len(buffer) - end > 8:
+          self.__reject(buffer[:end + 1])
+          self.truncated += 1
+          self.discarded_bytes += end + 1
+          del buffer[:end + 1]
+          continue
+        break
+
+      crc_field = bytes(buffer[end + 1:eol]).strip()
+      if crc_field:
+        try:
+          valid = int(crc_field, 16) == crc16(memoryview(buffer)[:end + 1])
+        except ValueError:
+          valid = False
+
+        if not valid:
+          logger.debug(f"CRC error; telegram CRC = {crc_field}")
+          self.__reject(buffer[:eol + 1])
+          self.crc_errors += 1
+          self.discarded_bytes += eol + 1
+          del buffer[:eol + 1]
+          continue
+
+      frames.append(bytes(buffer[:eol + 1]))
+      self.telegrams += 1
+      del buffer[:eol + 1]
+
+    return frames
+
+  def __reject(self, data):
+    if self.rejected is not None:
+      self.rejected(bytes(data))
+
+  def statistics(self):
+    """
+    Returns:
+      :rtype: str
+    """
+    return (f"telegrams = {self.telegrams}; CRC errors = {self.crc_errors}; "
+            f"truncated = {self.truncated}; discarded bytes = {self.discarded_bytes}")
+
+
+def main(filename, repeat=200):
+  """
+    Measure cost of framing per telegram; feed file in chunks of 1024 bytes
+
+  Args:
+    :param str filename: raw dsmr file (eg test/dsmr.raw)
+    :param int repeat: number of passes over file
+
+  Returns:
+    None
+  """
+  with open(filename, 'rb') as f:
+    data = f.read()
+
+  chunks = [data[i:i + 1024] for i in range(0, len(data), 1024)]
+  framer = TelegramFramer()
+
+  t_start = time.perf_counter()
+  for _i in range(repeat):
+    for chunk in chunks:
+      for frame in framer.feed(chunk):
+        telegram_lines(frame)
+  t_elapsed = time.perf_counter() - t_start
+
+  print(framer.statistics())
+  print(f"{t_elapsed * 1e6 / max(framer.telegrams, 1):.1f} us per telegram "
+        f"({framer.telegrams / t_elapsed:.0f} telegrams/s)")
+
+
+if __name__ == '__main__':
+  main(sys.argv[1] if len(sys.argv) > 1 else "test/dsmr.raw")
@@ -0,0 +1,373 @@
+"""
+  In-memory history of recent readings (HISTORY = True)
+
+  Every telegram is parsed and its numeric fields (dsmr.history) are stored in a
+  fixed-size ring buffer per meter: one column of timestamps and one column per field,
+  each a preallocated array of C doubles/int64s (8 bytes per sample). At most one sample
+  per HISTORY_RESOLUTION seconds is kept, for HISTORY_SECONDS; eg 24h at 1s resolution
+  is 675 kB per field. Memory does not grow after start.
+
+  Local automations (EV charger, heat pump) can query the history over HTTP, without
+  the MQTT broker; all replies are json:
+    /fields                                         meters & fields in history
+    /last?field=el/p_consumed                       {"timestamp": ts, "value": value}
+    /range?field=el/p_consumed&seconds=900          {"timestamps": [...], "values": [...]}
+    /stats?field=el/p_consumed&start=ts&end=ts      {"count": n, "min":, "max":, "avg":, "first":, "last":}
+
+  Optional query parameters: meter=<MQTT topic prefix> (default MQTT_TOPIC_PREFIX);
+  seconds=<N> (last N seconds) or start=<epoch> & end=<epoch> (inclusive).
+
+        This program is free software: you can redistribute it and/or modify
+        it under the terms of the GNU General Public License as published by
+        the Free Software Foundation, either version 3 of the License, or
+        (at your option) any later version.
+
+        This program is distributed in the hope that it will be useful,
+        but WITHOUT ANY WARRANTY; without even the implied warranty of
+        MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+        GNU General Public License for more details.
+
+        You should have received a copy of the GNU General Public License
+        along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import threading
+import http.server
+import urllib.parse
+import array
+import math
+import json
+
+import dsmr50 as dsmr
+
+# Logging
+import __main__
+import logging
+import os
+script = os.path.basename(__main__.__file__)
+script = os.path.splitext(script)[0]
+logger = logging.getLogger(script + "." + __name__)
+
+# Missing value; field not in telegram
+NAN = float("nan")
+
+
+class RingHistory:
+  """
+    Columnar ring buffer of the numeric fields of one meter
+  """
+
+  def __init__(self, fields, seconds=86400, resolution=1):
+    """
+    Args:
+      :param list fields: [(index, topic, tag)]; OBIS reference & MQTT topic/tag of stored fields
+      :param int seconds: history length
+      :param int resolution: min seconds between samples
+    """
+    self.__fields = fields
+    self.__resolution = resolution
+    self.capacity = max(1, seconds // resolution)
+
+    self.__timestamps = array.array('q', bytes(8 * self.capacity))
+    # "topic/tag":column
+    self.__columns = {f"{topic}/{tag}": array.array('d', [NAN]) * self.capacity for _index, topic, tag in fields}
+
+    # Position of next sample & number of samples
+    self.__head = 0
+    self.__count = 0
+
+    # Parser adds samples while HTTP server queries
+    self.__lock = threading.Lock()
+
+  def nbytes(self):
+    """
+    Returns:
+      :rtype: int: memory of all columns
+    """
+    return self.capacity * self.__timestamps.itemsize * (1 + len(self.__columns))
+
+  def fields(self):
+    """
+    Returns:
+      :rtype: list: "topic/tag" of all stored fields
+    """
+    return list(self.__columns)
+
+  def add(self, ts, values):
+    """
+      Store values of a telegram; skipped when last sample is less than resolution ago
+
+    Args:
+      :param int ts: epoch
+      :param dict values: OBIS reference:value
+
+    Returns:
+      :rtype: bool: True if stored
+    """
+    with self.__lock:
+      if self.__count:
+        last = self.__timestamps[(self.__head - 1) % self.capacity]
+        if ts - last < self.__resolution:
+          return False
+
+      head = self.__head
+      self.__timestamps[head] = ts
+      for index, topic, tag in self.__fields:
+        value = values.get(index)
+        self.__columns[f"{topic}/{tag}"][head] = NAN if value is None else value
+
+      self.__head = (head + 1) % self.capacity
+      self.__count = min(self.__count + 1, self.capacity)
+      return True
+
+  def __position(self, i):
+    # Position in arrays of i-th oldest sample
+    return (self.__head - self.__count + i) % self.capacity
+
+  def __bisect(self, ts):
+    # Number of samples with timestamp < ts; timestamps are ascending from oldest sample
+    lo, hi = 0, self.__count
+    while lo < hi:
+      mid = (lo + hi) // 2
+      if self.__timestamps[self.__position(mid)] < ts:
+        lo = mid + 1
+      else:
+        hi = mid
+    return lo
+
+  def __slice(self, column, start, end):
+    """
+      Samples between start and end (inclusive), oldest first; caller holds the lock
+
+    Args:
+      :param array.array column:
+      :param int start: epoch; None is oldest sample
+      :param int end: epoch; None is newest sample
+
+    Returns:
+      :rtype: array.array, array.array: timestamps, values
+    """
+    first = 0 if start is None else self.__bisect(start)
+    last = self.__count if end is None else self.__bisect(end + 1)
+    if first >= last:
+      return array.array('q'), array.array('d')
+
+    lo = self.__position(first)
+    hi = lo + last - first
+    if hi <= self.capacity:
+      return self.__timestamps[lo:hi], column[lo:hi]
+
+    # Wraps around end of arrays
+    hi -= self.capacity
+    return self.__timestamps[lo:] + self.__timestamps[:hi], column[lo:] + column[:hi]
+
+  def last(self, field):
+    """
+    Args:
+      :param str field: "topic/tag"
+
+    Returns:
+      :rtype: tuple: (timestamp, value) of newest sample which has this field; None if no sample
+    """
+    column = self.__columns[field]
+    with self.__lock:
+      for i in range(self.__count - 1, -1, -1):
+        position = self.__position(i)
+        if not math.isnan(column[position]):
+          return self.__timestamps[position], column[position]
+    return None
+
+  def range(self, field, start=None, end=None):
+    """
+    Args:
+      :param str field: "topic/tag"
+      :param int start: epoch; None is oldest sample
+      :param int end: epoch; None is newest sample
+
+    Returns:
+      :rtype: list, list: timestamps, values of samples between start and end (inclusive) which have this field
+    """
+    column = self.__columns[field]
+    with self.__lock:
+      timestamps, values = self.__slice(column, start, end)
+
+    samples = [(ts, value) for ts, value in zip(timestamps, values) if not math.isnan(value)]
+    return [ts for ts, _value in samples], [value for _ts, value in samples]
+
+  def stats(self, field, start=None, end=None):
+    """
+    Args:
+      :param str field: "topic/tag"
+      :param int start: epoch; None is oldest sample
+      :param int end: epoch; None is newest sample
+
+    Returns:
+      :rtype: dict: count, min, max, avg, first, last of samples between start and end (inclusive);
+                    statistics are None if there are no samples
+    """
+    _timestamps, values = self.range(field, start, end)
+    if not values:
+      return {"count": 0, "min": None, "max": None, "avg": None, "first": None, "last": None}
+
+    return {"count": len(values),
+            "min": min(values),
+            "max": max(values),
+            "avg": round(math.fsum(values) / len(values), 3),
+            "first": values[0],
+            "last": values[-1]}
+
+  def newest(self):
+    """
+    Returns:
+      :rtype: int: timestamp of newest sample; None if no sample
+    """
+    with self.__lock:
+      if not self.__count:
+        return None
+      return self.__timestamps[(self.__head - 1) % self.capacity]
+
+
+class HistoryStore:
+  """
+    Ring histories of all meters
+  """
+
+  def __init__(self, plan, history=dsmr.history, seconds=86400, resolution=1):
+    """
+    Args:
+      :param P1_plan.ParsePlan plan: compiled dsmr definition; provides topic, tag & datatype
+      :param list history: OBIS references of stored fields; see dsmr50.py
+      :param int seconds: history length
+      :param int resolution: min seconds between samples
+    """
+    assert seconds >= resolution > 0, f"History of {seconds}s at resolution {resolution}s"
+    self.__seconds = seconds
+    self.__resolution = resolution
+
+    # [(index, topic, tag)]
+    self.__fields = []
+    for index in history:
+      element = plan.elements.get(index)
+      if element is None:
+        logger.warning(f"History entry {index} is not in dsmr definition")
+      elif element.groups is not None or element.cast is str:
+        logger.warning(f"History entry {index} is not a single number")
+      else:
+        self.__fields.append((index, element.topic, element.tag))
+
+    # MQTT topic prefix:RingHistory
+    self.meters = {}
+
+  def add(self, prefix, ts, values):
+    """
+    Args:
+      :param str prefix: MQTT topic prefix (meter)
+      :param int ts: epoch
+      :param dict values: OBIS reference:value
+
+    Returns:
+      None
+    """
+    ring = self.meters.get(prefix)
+    if ring is None:
+      ring = self.meters[prefix] = RingHistory(self.__fields, self.__seconds, self.__resolution)
+      logger.info(f"History {prefix}: {len(self.__fields)} fields; {ring.capacity} samples; "
+                  f"{ring.nbytes() // 1024} kB")
+    ring.add(ts, values)
+
+
+class _QueryHandler(http.server.BaseHTTPRequestHandler):
+  """
+    Serves json replies from a HistoryStore; see module docstring
+  """
+
+  # Set by HistoryServer
+  store = None
+  default_meter = None
+
+  def log_message(self, format, *args):
+    logger.debug(f"{self.address_string()}: {format % args}")
+
+  def __reply(self, status, body):
+    data = json.dumps(body, separators=(',', ':')).encode()
+    self.send_response(status)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+  def do_GET(self):
+    url = urllib.parse.urlsplit(self.path)
+    query = {key: values[-1] for key, values in urllib.parse.parse_qs(url.query).items()}
+
+    if url.path == "/fields":
+      self.__reply(200, {prefix: ring.fields() for prefix, ring in list(self.store.meters.items())})
+      return
+
+    if url.path not in ("/last", "/range", "/stats"):
+      self.__reply(404, {"error": f"Unknown path {url.path}"})
+      return
+
+    ring = self.store.meters.get(query.get("meter", self.default_meter))
+    field = query.get("field")
+    if ring is None or field not in ring.fields():
+      self.__reply(404, {"error": f"Unknown meter or field {field}"})
+      return
+
+    if url.path == "/last":
+      sample = ring.last(field)
+      self.__reply(200, {"timestamp": sample[0], "value": sample[1]} if sample else {})
+      return
+
+    try:
+      if "seconds" in query:
+        newest = ring.newest()
+        start = None if newest is None else newest - int(query["seconds"]) + 1
+        end = None
+      else:
+        start = int(query["start"]) if "start" in query else None
+        end = int(query["end"]) if "end" in query else None
+    except ValueError as e:
+      self.__reply(400, {"error": str(e)})
+      return
+
+    if url.path == "/range":
+      timestamps, values = ring.range(field, start, end)
+      self.__reply(200, {"timestamps": timestamps, "values": values})
+    else:
+      self.__reply(200, ring.stats(field, start, end))
+
+
+class HistoryServer(threading.Thread):
+  """
+    HTTP server for queries of the history; one request at a time
+  """
+
+  def __init__(self, stopper, store, address="127.0.0.1", port=8081, default_meter="dsmr"):
+    """
+    Args:
+      :param threading.Event() stopper: stops thread
+      :param HistoryStore store:
+      :param str address: listen address; "0.0.0.0" for all interfaces
+      :param int port:
+      :param str default_meter: MQTT topic prefix of queries without meter
+    """
+    logger.debug(">>")
+    super().__init__()
+    self.__stopper = stopper
+
+    handler = type("QueryHandler", (_QueryHandler,), {"store": store, "default_meter": default_meter})
+    self.__server = http.server.HTTPServer((address, port), handler)
+    self.__server.timeout = 1
+
+  def __del__(self):
+    logger.debug(">>")
+
+  def run(self):
+    logger.debug(">>")
+    try:
+      while not self.__stopper.is_set():
+        self.__server.handle_request()
+    finally:
+      self.__server.server_close()
+    logger.debug("<<")
@@ -0,0 +1,233 @@
+"""
+  Write parsed telegrams directly to InfluxDB (INFLUX = True), in line protocol
+
+  Replaces dsmr-mqtt -> MQTT json -> telegraf (telegraf-dsmr.conf) -> InfluxDB, and writes
+  the same points: measurement "dsmr", tag "serial", the other keys as fields, timestamp in
+  seconds. The MQTT messages of INFLUX_TOPICS are written as they are published; fields which
+  telegraf-dsmr.conf converts to "uint" are written as integers, so existing databases keep
+  their field types. The writer is a sink (P1_sinks.py) of the line protocol format (P1_encode.py).
+
+  Points are batched (INFLUX_BATCH_SIZE points or INFLUX_FLUSH_INTERVAL seconds) and the body
+  is gzip compressed. When a write fails (network, InfluxDB down), the batch is spilled to
+  INFLUX_SPILL_DIR and retried with exponential backoff; spilled batches survive a restart.
+  The oldest spilled batches are deleted when INFLUX_SPILL_MAX_BYTES is exceeded. A batch
+  rejected by InfluxDB (HTTP 400, invalid line protocol) is dropped.
+
+  Test without InfluxDB with the stand-in server test/influx_server.py (prints received points).
+
+        This program is free software: you can redistribute it and/or modify
+        it under the terms of the GNU General Public License as published by
+        the Free Software Foundation, either version 3 of the License, or
+        (at your option) any later version.
+
+        This program is distributed in the hope that it will be useful,
+        but WITHOUT ANY WARRANTY; without even the implied warranty of
+        MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+        GNU General Public License for more details.
+
+        You should have received a copy of the GNU General Public License
+        along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import urllib.request
+import urllib.error
+import random
+import glob
+import gzip
+import time
+
+import P1_encode as encode
+import P1_sinks as sinks
+
+# Logging
+import __main__
+import logging
+import os
+script = os.path.basename(__main__.__file__)
+script = os.path.splitext(script)[0]
+logger = logging.getLogger(script + "." + __name__)
+
+# Max number of spilled batches written per flush, after InfluxDB is available again
+DRAIN_BATCHES = 10
+
+# Max seconds of a write; a batch is up to INFLUX_BATCH_SIZE points
+WRITE_TIMEOUT = 10
+
+
+class InfluxWriter(sinks.Sink):
+  """
+    Batch, compress & write points to InfluxDB; spill to disk when InfluxDB is not available
+  """
+
+  def __init__(self, url, token="", topics=None, batch_size=5000, flush_interval=10, spill_dir="influx-spill",
+               spill_max_bytes=100 * 1024 * 1024, max_backoff=300, queue_size=sinks.QUEUE_SIZE):
+    """
+    Args:
+      :param str url: write url, including database/bucket & precision=s
+      :param str token: InfluxDB v2 API token; "" if no authorization header is required
+      :param list topics: MQTT topics (without prefix) which are written; None is all topics
+      :param int batch_size: max points per write
+      :param int flush_interval: max seconds a point waits in a batch
+      :param str spill_dir: directory of batches which could not be written
+      :param int spill_max_bytes: max disk usage of spilled batches; oldest are deleted
+      :param int max_backoff: max seconds between retries
+      :param int queue_size: max number of telegrams waiting for the writer
+    """
+    logger.debug(">>")
+    super().__init__(f"influx:{url}", encode.LP, None, queue_size)
+    self.__url = url
+    self.__headers = {"Content-Type": "text/plain; charset=utf-8", "Content-Encoding": "gzip"}
+    if token:
+      self.__headers["Authorization"] = f"Token {token}"
+
+    self.__topics = None if topics is None else set(topics)
+    self.__batch_size = batch_size
+    self.__flush_interval = flush_interval
+    self.__spill_dir = spill_dir
+    self.__spill_max_bytes = spill_max_bytes
+    self.__max_backoff = max_backoff
+
+    # Batch & monotonic time at which it is written
+    self.__lines = []
+    self.__flush_ts = 0.0
+
+    # Seconds till next retry & monotonic time of next retry; 0 if last write succeeded
+    self.__backoff = 0
+    self.__retry = 0.0
+    self.__spill_seq = 0
+
+    # Statistics
+    self.points = 0
+    self.batches = 0
+    self.writes_failed = 0
+    self.spilled = 0
+    self.rejected = 0
+
+    os.makedirs(spill_dir, exist_ok=True)
+
+  def __del__(self):
+    logger.debug(">>")
+
+  def __post(self, body):
+    """
+    Args:
+      :param bytes body: gzip compressed line protocol
+
+    Returns:
+      :rtype: bool: False if write has to be retried
+    """
+    request = urllib.request.Request(self.__url, data=body, headers=self.__headers, method="POST")
+    try:
+      with urllib.request.urlopen(request, timeout=WRITE_TIMEOUT) as response:
+        response.read()
+      return True
+
+    except urllib.error.HTTPError as e:
+      if e.code in (400, 422):
+        # Invalid line protocol or field type conflict; retrying does not help
+        logger.error(f"InfluxDB rejected batch: {e.code} {e.read()[:200]}")
+        self.rejected += 1
+        return True
+      logger.warning(f"InfluxDB write failed: {e.code} {e.reason}")
+
+    except (urllib.error.URLError, OSError) as e:
+      logger.warning(f"InfluxDB write failed: {e}")
+
+    self.writes_failed += 1
+    return False
+
+  def __failed(self):
+    self.__backoff = min(max(1, 2 * self.__backoff), self.__max_backoff)
+    self.__retry = time.monotonic() + self.__backoff * random.uniform(1.0, 1.25)
+    logger.debug(f"Retry InfluxDB write in {self.__backoff}s")
+
+  def __spill(self, body):
+    self.__spill_seq += 1
+    path = os.path.join(self.__spill_dir, f"influx-{time.time_ns()}-{self.__spill_seq:06d}.lp.gz")
+    with open(path + ".tmp", 'wb') as f:
+      f.write(body)
+    os.replace(path + ".tmp", path)
+    self.spilled += 1
+
+    spills = self.__spills()
+    sizes = [os.path.getsize(spill) for spill in spills]
+    total = sum(sizes)
+    for spill, size in zip(spills, sizes):
+      if total <= self.__spill_max_bytes:
+        break
+      logger.warning(f"InfluxDB spill exceeds {self.__spill_max_bytes} bytes; delete {spill}")
+      os.remove(spill)
+      total -= size
+
+  def __spills(self):
+    # Oldest first
+    return sorted(glob.glob(os.path.join(self.__spill_dir, "influx-*.lp.gz")))
+
+  def __flush(self, lines):
+    """
+      Write batch; spill it when InfluxDB is not available
+
+    Args:
+      :param list lines: line protocol
+
+    Returns:
+      None
+    """
+    body = gzip.compress(("\n".join(lines) + "\n").encode(), compresslevel=6)
+    self.points += len(lines)
+    self.batches += 1
+
+    if self.__backoff and time.monotonic() < self.__retry:
+      self.__spill(body)
+    elif self.__post(body):
+      self.__backoff = 0
+    else:
+      self.__spill(body)
+      self.__failed()
+
+  def __drain(self):
+    """
+      Write spilled batches, oldest first, when InfluxDB is (probably) available
+
+    Returns:
+      None
+    """
+    if self.__backoff and time.monotonic() < self.__retry:
+      return
+
+    for spill in self.__spills()[:DRAIN_BATCHES]:
+      with open(spill, 'rb') as f:
+        body = f.read()
+
+      if not self.__post(body):
+        self.__failed()
+        return
+
+      os.remove(spill)
+      self.__backoff = 0
+      logger.debug(f"Spilled batch {spill} written")
+
+  def send(self, record):
+    if not self.__lines:
+      self.__flush_ts = time.monotonic() + self.__flush_interval
+
+    self.__lines += [line for topic, line in record.payload if self.__topics is None or topic in self.__topics]
+    if len(self.__lines) >= self.__batch_size:
+      lines, self.__lines = self.__lines, []
+      self.__flush(lines)
+
+  def idle(self):
+    if self.__lines and time.monotonic() >= self.__flush_ts:
+      lines, self.__lines = self.__lines, []
+      self.__flush(lines)
+
+    self.__drain()
+
+  def close(self):
+    if self.__lines:
+      lines, self.__lines = self.__lines, []
+      self.__flush(lines)
+
+    logger.info(f"InfluxDB: points = {self.points}; batches = {self.batches}; failed writes = {self.writes_failed}; "
+                f"spilled = {self.spilled}; rejected = {self.rejected}; waiting in spill = {len(self.__spills())}")
+
@@ -0,0 +1,205 @@
+"""
+End-to-end latency of telegrams, from meter to MQTT broker
+
+Per telegram the pipeline records (epoch, ms resolution):
+  meter      meter timestamp (0-0:1.0.0); resolution 1s, includes offset of meter clock
+  received   telegram complete & CRC checked (serial/network reader)
+  parsed     parsed & handed over to MQTT client
+  acked      MQTT broker acknowledged the message (qos=1) or message was sent (qos=0)
+
+The intervals between these points are collected in histograms:
+  meter_to_received     P1 transmission; meter sends a telegram every second
+  received_to_parsed    wait in telegram channel + parse
+  parsed_to_acked       MQTT client queue, network & broker
+  received_to_acked     end-to-end within dsmr-mqtt
+
+        This program is free software: you can redistribute it and/or modify
+        it under the terms of the GNU General Public License as published by
+        the Free Software Foundation, either version 3 of the License, or
+        (at your option) any later version.
+
+        This program is distributed in the hope that it will be useful,
+        but WITHOUT ANY WARRANTY; without even the implied warranty of
+        MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+        GNU General Public License for more details.
+
+        You should have received a copy of the GNU General Public License
+        along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import threading
+import collections
+import bisect
+import time
+
+# Logging
+import __main__
+import logging
+import os
+script = os.path.basename(__main__.__file__)
+script = os.path.splitext(script)[0]
+logger = logging.getLogger(script + "." + __name__)
+
+# Upper bounds of histogram buckets [ms]; last bucket is unbounded
+BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000, 60000)
+
+# Histograms
+METER_TO_RECEIVED = "meter_to_received"
+RECEIVED_TO_PARSED = "received_to_parsed"
+PARSED_TO_ACKED = "parsed_to_acked"
+RECEIVED_TO_ACKED = "received_to_acked"
+
+# Max number of published messages waiting for acknowledge; oldest are forgotten
+MAX_PENDING = 10000
+
+
+class LatencyHistogram:
+  """
+    Histogram of latencies with fixed buckets
+  """
+
+  def __init__(self, buckets=BUCKETS):
+    """
+    Args:
+      :param tuple buckets: upper bounds of buckets in ms
+    """
+    self.buckets = buckets
+    self.counts = [0] * (len(buckets) + 1)
+    self.count = 0
+    self.sum = 0.0
+    self.max = 0.0
+
+  def add(self, ms):
+    """
+    Args:
+      :param float ms: latency in ms
+
+    Returns:
+      None
+    """
+    self.counts[bisect.bisect_left(self.buckets, ms)] += 1
+    self.count += 1
+    self.sum += ms
+    if ms > self.max:
+      self.max = ms
+
+  def percentile(self, p):
+    """
+    Args:
+      :param float p: percentile [0..100]
+
+    Returns:
+      :rtype: float: upper bound of bucket [ms] which contains the percentile; max if unbounded
+    """
+    if self.count == 0:
+      return 0.0
+
+    rank = self.count * p / 100
+    cumulative = 0
+    for i, count in enumerate(self.counts):
+      cumulative += count
+      if cumulative >= rank and count:
+        return float(self.buckets[i]) if i < len(self.buckets) else self.max
+    return self.max
+
+  def __str__(self):
+    if self.count == 0:
+      return "n = 0"
+    return (f"n = {self.count}; avg = {self.sum / self.count:.1f}ms; p50 <= {self.percentile(50):.0f}ms; "
+            f"p99 <= {self.percentile(99):.0f}ms; max = {self.max:.1f}ms")
+
+
+class LatencyTracer:
+  """
+    Collect latency histograms of telegrams & published MQTT messages
+  """
+
+  def __init__(self):
+    self.histograms = {name: LatencyHistogram()
+                       for name in (METER_TO_RECEIVED, RECEIVED_TO_PARSED, PARSED_TO_ACKED, RECEIVED_TO_ACKED)}
+
+    # mid:(received, parsed) of published messages waiting for acknowledge
+    self.__pending = collections.OrderedDict()
+
+    # mid:acked; acknowledges which arrive before publish() has returned (eg qos=0)
+    self.__early = collections.OrderedDict()
+
+    # acknowledges are received in MQTT network thread
+    self.__lock = threading.Lock()
+
+  def parsed(self, meter_ts, received, parsed):
+    """
+    Args:
+      :param int meter_ts: meter timestamp (epoch); None if unknown
+      :param float received: epoch; telegram complete
+      :param float parsed: epoch; telegram parsed
+
+    Returns:
+      None
+    """
+    with self.__lock:
+      if meter_ts is not None:
+        self.histograms[METER_TO_RECEIVED].add((received - meter_ts) * 1000)
+      self.histograms[RECEIVED_TO_PARSED].add((parsed - received) * 1000)
+
+  def published(self, mid, received, parsed):
+    """
+      Register published MQTT message; latency is added when broker acknowledges
+
+    Args:
+      :param int mid: MQTT message id; None if publish failed
+      :param float received: epoch; telegram complete
+      :param float parsed: epoch; telegram parsed
+
+    Returns:
+      None
+    """
+    if mid is None:
+      return
+
+    with self.__lock:
+      # mid is reused after 65535 messages; ignore acknowledges of older messages
+      acked = self.__early.pop(mid, None)
+      if acked is not None and acked >= parsed:
+        self.__add_acked(received, parsed, acked)
+        return
+
+      if len(self.__pending) >= MAX_PENDING:
+        self.__pending.popitem(last=False)
+      self.__pending[mid] = (received, parsed)
+
+  def __add_acked(self, received, parsed, acked):
+    self.histograms[PARSED_TO_ACKED].add((acked - parsed) * 1000)
+    self.histograms[RECEIVED_TO_ACKED].add((acked - received) * 1000)
+
+  def acked(self, mid):
+    """
+      Callback of MQTT client; called in MQTT network thread
+
+    Args:
+      :param int mid: MQTT message id
+
+    Returns:
+      None
+    """
+    acked = time.time()
+    with self.__lock:
+      timestamps = self.__pending.pop(mid, None)
+      if timestamps is None:
+        if len(self.__early) >= MAX_PENDING:
+          self.__early.popitem(last=False)
+        self.__early[mid] = acked
+        return
+
+      self.__add_acked(*timestamps, acked)
+
+  def log(self):
+    """
+      Log all histograms
+
+    Returns:
+      None
+    """
+    with self.__lock:
+      for name, histogram in self.histograms.items():
+        logger.info(f"Latency {name}: {histogram}")
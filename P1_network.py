@@ -0,0 +1,303 @@
+"""
+  Read dsmr telegrams from network P1 dongles (Wi-Fi/Ethernet P1 readers, ser2net)
+
+  These devices expose the raw P1 telegram stream on a TCP port.
+  All connections are non-blocking and multiplexed on one selectors loop, so one
+  thread can serve hundreds of meters. A connection that fails, is closed or stays
+  silent (NETWORK_TIMEOUT) is reconnected with exponential backoff.
+  Host names are resolved (IPv4 & IPv6) in a separate thread, so a slow DNS server does
+  not stall the other connections; after a failed connection the next address is tried,
+  and when all addresses failed, the host name is resolved again.
+
+  Telegrams are routed by meter; the equipment identifier (0-0:96.1.1), truncated
+  as the "serial" tag in dsmr50.py, is appended to MQTT_TOPIC_PREFIX:
+    dsmr/33363137/el
+
+  Test with local socket servers replaying test/dsmr.raw:
+    python3 test/p1-server.py --ports 2001-2100
+
+        This program is free software: you can redistribute it and/or modify
+        it under the terms of the GNU General Public License as published by
+        the Free Software Foundation, either version 3 of the License, or
+        (at your option) any later version.
+
+        This program is distributed in the hope that it will be useful,
+        but WITHOUT ANY WARRANTY; without even the implied warranty of
+        MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+        GNU General Public License for more details.
+
+        You should have received a copy of the GNU General Public License
+        along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import threading
+import selectors
+import socket
+import errno
+import random
+import time
+import re
+
+import config as cfg
+import dsmr50 as dsmr
+import P1_framer as framer
+import P1_channel as channel
+import P1_diagnostics as diagnostics
+
+# Logging
+import __main__
+import logging
+import os
+script = os.path.basename(__main__.__file__)
+script = os.path.splitext(script)[0]
+logger = logging.getLogger(script + "." + __name__)
+
+# Equipment identifier, used to route telegrams per meter
+METER_ID = "0-0:96.1.1"
+
+
+def meter_serial(lines):
+  """
+    Equipment identifier of meter, truncated as defined in dsmr50.py ("serial" tag)
+
+  Args:
+    :param list lines: telegram lines
+
+  Returns:
+    :rtype: str: None if telegram has no equipment identifier
+  """
+  for line in lines:
+    if line.startswith(METER_ID + "("):
+      try:
+        return re.match(dsmr.definition[METER_ID][dsmr.REGEX], line).group(1)
+      except (KeyError, AttributeError):
+        return line[len(METER_ID) + 1:-1]
+  return None
+
+
+class _Connection:
+  """
+    State per network P1 endpoint
+  """
+
+  def __init__(self, host, port):
+    self.host = host
+    self.port = port
+    self.name = f"{host}:{port}"
+    self.sock = None
+    self.connected = False
+
+    # Resolved addresses [(family, type, proto, canonname, sockaddr)]; None till resolved
+    self.addresses = None
+    self.resolver = None
+    self.resolve_error = None
+    self.framer = diagnostics.TimedFramer(f"p1:{self.name}")
+    self.counter = 0
+
+    # Meter serial & MQTT topic prefix; known after first telegram
+    self.serial = None
+    self.prefix = None
+
+    self.last_rx = 0
+    self.retry_at = 0
+    self.backoff = 1
+    self.reconnects = 0
+
+
+class TaskReadNetwork(threading.Thread):
+  """
+    Read many network P1 streams in one thread
+  """
+
+  def __init__(self, telegrams, stopper, endpoints, on_meter=None):
+    """
+
+    Args:
+      :param P1_channel.TelegramChannel() telegrams: hands over telegrams to parser
+      :param threading.Event() stopper: stops thread
+      :param list endpoints: list of (host, port)
+      :param on_meter: called with the MQTT topic prefix of a newly found meter; eg hadiscovery.Discovery.add_prefix
+    """
+    logger.debug(">>")
+    super().__init__()
+    self.__telegrams = telegrams
+    self.__stopper = stopper
+    self.__on_meter = on_meter
+    self.__selector = selectors.DefaultSelector()
+    self.__connections = [_Connection(host, port) for host, port in endpoints]
+    self.__timeout = cfg.NETWORK_TIMEOUT
+
+    logger.info(f"Network P1: {len(self.__connections)} endpoints")
+
+  def __del__(self):
+    logger.debug(">>")
+
+  @staticmethod
+  def __resolve(c):
+    """
+      Resolve host name; runs in a separate thread, as getaddrinfo() blocks
+
+    Args:
+      :param _Connection c:
+
+    Returns:
+      None
+    """
+    try:
+      c.addresses = socket.getaddrinfo(c.host, c.port, type=socket.SOCK_STREAM)
+    except OSError as e:
+      c.resolve_error = e
+
+  def __connect(self, c):
+    """
+      Start non-blocking connect; completion is signalled by selector (EVENT_WRITE)
+      When the host name is not resolved yet, start resolving; connect is retried by the selector loop
+
+    Args:
+      :param _Connection c:
+
+    Returns:
+      None
+    """
+    if c.resolver is not None:
+      if c.resolver.is_alive():
+        return
+      c.resolver = None
+      if c.addresses is None:
+        self.__disconnect(c, f"cannot resolve {c.host}; {c.resolve_error}")
+        return
+    elif c.addresses is None:
+      c.resolve_error = None
+      c.resolver = threading.Thread(target=self.__resolve, args=(c,), name=f"resolve {c.host}", daemon=True)
+      c.resolver.start()
+      return
+
+    family, socktype, proto, _canonname, address = c.addresses[0]
+    try:
+      c.sock = socket.socket(family, socktype, proto)
+      c.sock.setblocking(False)
+      rc = c.sock.connect_ex(address)
+      if rc not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+        raise OSError(rc, os.strerror(rc))
+      self.__selector.register(c.sock, selectors.EVENT_WRITE, c)
+      c.connected = False
+      c.last_rx = time.monotonic()
+    except OSError as e:
+      self.__disconnect(c, e)
+
+  def __disconnect(self, c, reason):
+    """
+      Close connection and schedule reconnect with exponential backoff (+ jitter)
+
+    Args:
+      :param _Connection c:
+      :param reason: logged
+
+    Returns:
+      None
+    """
+    logger.warning(f"P1 {c.name}: {reason}; reconnect in {c.backoff}s")
+    if c.sock is not None:
+      try:
+        self.__selector.unregister(c.sock)
+      except (KeyError, ValueError):
+        pass
+      c.sock.close()
+      c.sock = None
+
+    # Next reconnect tries the next address; resolve again when all addresses are tried
+    if c.addresses is not None and not c.connected:
+      c.addresses = c.addresses[1:] or None
+
+    c.connected = False
+    c.framer.reset()
+    c.reconnects += 1
+    c.retry_at = time.monotonic() + c.backoff * random.uniform(1.0, 1.2)
+    c.backoff = min(c.backoff * 2, 60)
+
+  def __on_event(self, c, mask):
+    """
+    Args:
+      :param _Connection c:
+      :param int mask: selector events
+
+    Returns:
+      None
+    """
+    if not c.connected:
+      rc = c.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+      if rc != 0:
+        self.__disconnect(c, os.strerror(rc))
+        return
+
+      c.connected = True
+      self.__selector.modify(c.sock, selectors.EVENT_READ, c)
+      logger.info(f"P1 {c.name}: connected")
+      return
+
+    try:
+      data = c.sock.recv(65536)
+    except (BlockingIOError, InterruptedError):
+      return
+    except OSError as e:
+      self.__disconnect(c, e)
+      return
+
+    if not data:
+      self.__disconnect(c, "connection closed by peer")
+      return
+
+    c.last_rx = time.monotonic()
+    for frame in c.framer.feed(data):
+      c.counter += 1
+      c.backoff = 1
+      lines = framer.telegram_lines(frame)
+
+      serial = meter_serial(lines) or c.name.replace(":", "_")
+      if serial != c.serial:
+        c.serial = serial
+        c.prefix = cfg.MQTT_TOPIC_PREFIX + "/" + serial
+        logger.info(f"P1 {c.name}: meter {serial}; MQTT topic prefix {c.prefix}")
+        if self.__on_meter is not None:
+          self.__on_meter(c.prefix)
+
+      self.__telegrams.put(channel.Telegram(c.counter, lines, c.prefix))
+
+  def __read_network(self):
+    logger.debug(">>")
+
+    for c in self.__connections:
+      self.__connect(c)
+
+    while not self.__stopper.is_set():
+      for key, mask in self.__selector.select(timeout=1):
+        self.__on_event(key.data, mask)
+
+      # Reconnect failed and silent connections; connect when host name is resolved
+      now = time.monotonic()
+      for c in self.__connections:
+        if c.sock is None:
+          if now >= c.retry_at or c.resolver is not None:
+            self.__connect(c)
+        elif now - c.last_rx > self.__timeout:
+          self.__disconnect(c, f"no data received for {self.__timeout}s")
+
+    logger.debug("<<")
+
+  def run(self):
+    logger.debug(">>")
+    try:
+      self.__read_network()
+
+    except Exception as e:
+      logger.error(f"Exception: {e}")
+
+    finally:
+      for c in self.__connections:
+        logger.info(f"P1 {c.name} ({c.serial}): reconnects = {c.reconnects}; {c.framer.statistics()}")
+        if c.sock is not None:
+          c.sock.close()
+      self.__selector.close()
+      self.__stopper.set()
+
+    logger.debug("<<")
@@ -18,12 +18,21 @@
 """
 
 import threading
-import copy
-import re
 import time
-import json
 import config as cfg
 import dsmr50 as dsmr
+import P1_plan as plan
+import P1_aggregate as aggregate
+import P1_delta as delta
+import P1_schedule as schedule
+import P1_latency as latency
+import P1_history as history
+import P1_sinks as sinks
+import P1_encode as encode
+import P1_batch as batch
+import P1_prometheus as prometheus
+import P1_framer as framer
+import P1_diagnostics as diagnostics
 
 # Logging
 import __main__
@@ -38,157 +47,341 @@ class ParseTelegrams(threading.Thread):
   """
   """
 
-  def __init__(self, trigger, stopper, mqtt, telegram):
+  def __init__(self, telegrams, stopper, mqtt, clock=time, extra_sinks=()):
     """
     Args:
-      :param threading.Event() trigger: signals that new telegram is available
+      :param P1_channel.TelegramChannel() telegrams: telegrams handed over by serial reader
       :param threading.Event() stopper: stops thread
       :param mqtt.mqttclient() mqtt: reference to mqtt worker
-      :param list() telegram: dsmr telegram
+      :param clock: provides time(); time module or P1_replay.VirtualClock() in simulation; timestamp of diagnostics
+      :param list extra_sinks: [P1_sinks.Sink]; sinks next to MQTT, eg P1_influx.InfluxWriter; started & stopped by parser
     """
     logger.debug(">>")
     super().__init__()
-    self.__trigger = trigger
+    self.__telegrams = telegrams
     self.__stopper = stopper
-    self.__telegram = telegram
     self.__mqtt = mqtt
-    self.__prev_ts = 0
+    self.__clock = clock
+
+    # dsmr definition, compiled once
+    self.__plan = plan.ParsePlan(dsmr.definition, dsmr.derived)
+
+    # Publish schedules of topics & fields, per MQTT topic prefix (meter)
+    self.__schedules = {}
+
+    # Aggregation windows, per MQTT topic prefix (meter); None if telegrams between MQTT messages are skipped
+    self.__windows = {} if cfg.MQTT_AGGREGATE else None
+
+    # Change-only filters, per MQTT topic prefix (meter); None if all fields are published
+    self.__deltas = {} if cfg.MQTT_DELTA else None
+    self.__connect_count = None
+
+    # Recent readings of all meters, queried by P1_history.HistoryServer; None if not kept
+    if cfg.HISTORY:
+      self.history = history.HistoryStore(self.__plan, dsmr.history, cfg.HISTORY_SECONDS, cfg.HISTORY_RESOLUTION)
+    else:
+      self.history = None
+
+    # Capture time of last published gas sample, per MQTT topic prefix (meter)
+    self.__gas_ts = {}
+
+    # Latency from meter to MQTT broker
+    self.__latency = latency.LatencyTracer()
+    self.__mqtt.set_publish_callback(self.__latency.acked)
+
+    # Latest values of all meters, scraped from P1_prometheus.MetricsServer; None if not exported
+    if cfg.PROMETHEUS:
+      self.metrics = prometheus.MetricsExporter(self.__plan, dsmr.definition, self.__latency, mqtt.connect_count)
+    else:
+      self.metrics = None
+
+    # Sinks of MQTT messages; MQTT broker is always a sink
+    mqtt_sink = sinks.MqttSink(mqtt, self.__latency.published, format=cfg.MQTT_FORMAT)
+
+    # Batched publishing, per MQTT topic prefix (meter); None if every telegram is published
+    # Batches are published to the MQTT broker only; other sinks receive every telegram
+    if cfg.MQTT_BATCH_SIZE or cfg.MQTT_BATCH_SECONDS:
+      self.__batches = {}
+      self.__batch_sinks = sinks.FanOut(self.__plan, [mqtt_sink])
+      self.__sinks = sinks.FanOut(self.__plan, extra_sinks)
+    else:
+      self.__batches = None
+      self.__batch_sinks = None
+      self.__sinks = sinks.FanOut(self.__plan, [mqtt_sink] + list(extra_sinks))
+
+    # Format of MQTT messages, published (retained) on <prefix>/metadata before the first message of a meter;
+    # None for json messages per telegram (default), which consumers decode without metadata
+    if cfg.MQTT_FORMAT != encode.JSON or self.__batches is not None:
+      self.__metadata = encode.metadata(cfg.MQTT_FORMAT, self.__plan, columnar=self.__batches is not None)
+    else:
+      self.__metadata = None
+    self.__advertised = set()
+
+    # Pipeline metrics, published on MQTT_TOPIC_PREFIX/diagnostics
+    self.__diagnostics = diagnostics.pipeline
+    self.__diagnostics.register("channel", telegrams, ("dropped", "high_water"))
+    self.__diagnostics.register("mqtt", mqtt, ("connect_count", "published_count", "queue_depth"))
+
+    # Last telegram counter, per MQTT topic prefix (meter); to count telegrams lost between reader & parser
+    self.__counters = {}
 
     assert cfg.MQTT_MAXRATE > 0, "MQTT_MAXRATE outside range 1.3600"
     assert cfg.MQTT_MAXRATE <= 3600, "MQTT_MAXRATE outside range 1.3600"
-    self.__min_ts_interval = int(3600 / cfg.MQTT_MAXRATE)
 
-    # Count number of topics which will always be included in MQTT json
-    # timestamp key:value topic
-    self.__nroftopics = 1
+    if cfg.MQTT_FORMAT != encode.JSON and cfg.HA_DISCOVERY:
+      logger.warning(f"MQTT_FORMAT = {cfg.MQTT_FORMAT}; Home Assistant discovery requires json")
+    if self.__batches is not None and cfg.HA_DISCOVERY:
+      logger.warning("MQTT messages are batched; Home Assistant discovery requires a message per telegram")
 
-    logger.debug(f"NROF = {self.__nroftopics}")
+    assert cfg.MQTT_BATCH_SIZE >= 0, "MQTT_BATCH_SIZE < 0"
+    assert cfg.MQTT_BATCH_SECONDS >= 0, "MQTT_BATCH_SECONDS < 0"
+    # Columnar layout (lists of values) requires a format with lists
+    batch_formats = (encode.JSON, encode.MSGPACK, encode.CBOR)
+    assert self.__batches is None or cfg.MQTT_FORMAT in batch_formats, f"MQTT_FORMAT {cfg.MQTT_FORMAT} cannot be batched"
 
   def __del__(self):
     logger.debug(">>")
 
-  def __publish_telegram(self, listofjsondicts):
-    # publish the dictionaries per topic
-    for d in listofjsondicts:
-      topic = d["topic"]
+  def __filter_unchanged(self, messages, ts, prefix):
+    """
+      Remove fields that did not change since last MQTT message of this meter
+      All fields are kept in a keyframe; after a reconnect to the broker, the next message is a keyframe
 
-      # remove topic key:value pair, otherwise it will be packed in the mqtt json
-      d.pop("topic")
+    Args:
+      :param dict messages: topic:{tag:value}
+      :param int ts: epoch
+      :param str prefix: MQTT topic prefix
+
+    Returns:
+      None
+    """
+    connect_count = self.__mqtt.connect_count()
+    if connect_count != self.__connect_count:
+      self.__connect_count = connect_count
+      for delta_filter in self.__deltas.values():
+        delta_filter.keyframe()
+
+    delta_filter = self.__deltas.get(prefix)
+    if delta_filter is None:
+      delta_filter = self.__deltas[prefix] = delta.DeltaFilter(self.__plan, dsmr.deadband,
+                                                               cfg.MQTT_KEYFRAME_INTERVAL)
+    delta_filter.filter(messages, ts)
+
+  def __unchanged_gas(self, telegram, messages, prefix):
+    """
+      The gas meter (M-Bus) sends a new sample every 5 minutes; the capture time is in the telegram
+      Remove the gas topic when the sample has already been published
 
-      # There is always a timestamp key:value and a database:influxdb in the dictionary (len = 2)
-      # If there are no other key-value pairs, skip publishing to MQTT
-      if len(d) > self.__nroftopics:
-        topic = cfg.MQTT_TOPIC_PREFIX + "/" + topic
+    Args:
+      :param list telegram:
+      :param dict messages: topic:{tag:value}
+      :param str prefix: MQTT topic prefix
 
-        # make resilient against double forward slashes in topic
-        topic = topic.replace('//', '/')
-        message = json.dumps(d, sort_keys=True, separators=(',', ':'))
-        self.__mqtt.do_publish(topic, message, retain=False)
-    return
+    Returns:
+      :rtype: int: capture time of gas sample (epoch); None if no gas sample
+    """
+    element = self.__plan.elements.get(plan.GAS)
+    if element is None or element.topic not in messages:
+      return None
 
-  def __decode_telegram_element(self, index, element, ts, listofjsondicts):
-    # logger.debug(f">> index={index};  element={element}")
+    capture_ts = framer.meter_time(telegram, plan.GAS)
+    if capture_ts is not None and capture_ts == self.__gas_ts.get(prefix):
+      logger.debug(f"Gas sample of {capture_ts} is already published")
+      del messages[element.topic]
+    return capture_ts
 
-    try:
-      # Extract result from telegram element, based on dsmr definition
-      # Cast result to type defined in dsmr50
-      # .....this is normally "dangerous", as you can define any python function....but it is hardcoded
-      # in dsmr50.py file, which should be read-only for regular users
-      cast = dsmr.definition[index][dsmr.DATATYPE]
-      dsmr_data = re.match(dsmr.definition[index][dsmr.REGEX], element).group(1)
-
-      # multiplication factor for data, eg to convert kW to W
-      multiply = dsmr.definition[index][dsmr.MULTIPLICATION]
-
-      # dict & json pair
-      # tag:data
-      # If type is string, there is no multiplication factor
-      if cast != "str":
-        data = eval(cast)(dsmr_data) * eval(cast)(multiply)
-      else:
-        data = eval(cast)(dsmr_data)
-        # logger.debug(f"CAST = {}")
-
-      # dict & json pair
-      # tag:data
-      tag = str(dsmr.definition[index][dsmr.MQTT_TAG])
-
-      # MQTT topic
-      topic = str(dsmr.definition[index][dsmr.MQTT_TOPIC])
-
-      # If topic does not exist yet, create & initialize dictionary for this topic;
-      # Add tag:data pairs; which will be converted to mqtt json later on.
-      # Add dictionary to list
-      if not any(dictionary['topic'] == topic for dictionary in listofjsondicts):
-
-        dict_element = {"topic": topic, "timestamp": ts}
-        listofjsondicts.append(dict_element)
-
-      for dictionary in listofjsondicts:
-        if dictionary['topic'] == topic:
-            dictionary[tag] = data
-
-    except Exception as e:
-      logger.debug(f"Exception {e}")
-      pass
-
-  def __decode_telegrams(self, telegram):
+  def __decode_telegrams(self, telegram, prefix, received, ts):
     """
     Args:
       :param list telegram:
+      :param str prefix: MQTT topic prefix
+      :param float received: epoch; telegram complete
+      :param int ts: epoch; timestamp of MQTT messages & schedules (replayed timestamp in simulation)
 
     Returns:
 
     """
     logger.debug(f">>")
 
-    # list of dictionaries of mqtt messages which will be converted to json format
-    listofjsondicts = list()
+    # Parse telegram when a topic or field of this meter is due to be published
+    # (or always, when aggregating, keeping history or exporting metrics), otherwise skip it
+    publish_schedule = self.__schedules.get(prefix)
+    if publish_schedule is None:
+      publish_schedule = self.__schedules[prefix] = schedule.PublishSchedule(self.__plan, cfg.MQTT_MAXRATE,
+                                                                             cfg.MQTT_TOPIC_RATE, dsmr.schedule)
+    publish = publish_schedule.due(ts)
+
+    if publish or self.__windows is not None or self.history is not None or self.metrics is not None:
+      # dictionaries of mqtt messages per topic, which will be converted to json format
+      started = time.perf_counter()
+      messages, values = self.__plan.parse(telegram, ts)
+      self.__diagnostics.add(diagnostics.PARSE, time.perf_counter() - started)
+
+    if self.metrics is not None:
+      self.metrics.update(prefix, messages, received)
+
+    if self.history is not None:
+      self.history.add(prefix, ts, values)
+
+    if self.__windows is not None:
+      # Aggregation: every telegram is added to the window of this meter
+      window = self.__windows.get(prefix)
+      if window is None:
+        window = self.__windows[prefix] = aggregate.WindowAggregator(self.__plan, dsmr.aggregate)
+      window.add(values)
+
+    if publish:
+      # Select before removing an unchanged gas sample: its schedule restarts as if it was published,
+      # otherwise the gas topic stays due and every telegram is parsed
+      publish_schedule.select(messages, ts)
+
+      gas_ts = self.__unchanged_gas(telegram, messages, prefix) if cfg.MQTT_GAS_NEW_SAMPLES_ONLY else None
+
+      if self.__windows is not None:
+        window.emit(messages)
+
+      if self.__deltas is not None:
+        self.__filter_unchanged(messages, ts, prefix)
+
+      # Gas sample is published; remember capture time
+      gas = self.__plan.elements.get(plan.GAS)
+      if gas_ts is not None and gas.tag in messages.get(gas.topic, {}):
+        self.__gas_ts[prefix] = gas_ts
+
+      logger.debug(f"DICT = {messages}")
+
+      parsed = time.time()
+      # In simulation, meter timestamps are from the past
+      self.__latency.parsed(framer.meter_time(telegram) if cfg.PRODUCTION else None, received, parsed)
+      if self.__metadata is not None and prefix not in self.__advertised:
+        self.__advertised.add(prefix)
+        self.__mqtt.do_publish(sinks.mqtt_topic(prefix, "metadata"), self.__metadata, retain=True)
+      self.__sinks.publish(prefix, messages, ts, received, parsed)
+
+      if self.__batches is not None:
+        self.__batch(prefix, messages, ts, received, parsed)
+    else:
+      self.__diagnostics.count("skipped")
+      logger.debug(f"Telegram is skipped; no topic is due")
+    return
 
-    # epoch time stamp
-    ts = int(time.time())
+  def __batch(self, prefix, messages, ts, received, parsed):
+    """
+      Add MQTT messages to the batch of this meter; publish the batch when it is full or its time is up
 
-    # Calculate time in seconds between between previous mqtt transmission and current
-    # If time between previous mqtt message and now is large enough, send
-    # mqtt message and store current timestamp
-    if (ts - self.__prev_ts) > self.__min_ts_interval:
-      self.__prev_ts = ts
+    Args:
+      :param str prefix: MQTT topic prefix
+      :param dict messages: topic:{tag:value}
+      :param int ts: epoch
+      :param float received: epoch; telegram complete
+      :param float parsed: epoch; telegram parsed
 
-      for element in telegram:
-        try:
-          # Extract the identifier (eg "1-0:1.8.1") of the element
-          # and use this as index for dsmr.definition
-          index = re.match(r"(\d{0,3}-\d{0,3}:\d{0,3}\.\d{0,3}\.\d{0,3}).*", element).group(1)
-          self.__decode_telegram_element(index, element, ts, listofjsondicts)
+    Returns:
+      None
+    """
+    telegram_batch = self.__batches.get(prefix)
+    if telegram_batch is None:
+      telegram_batch = self.__batches[prefix] = batch.TelegramBatch(cfg.MQTT_BATCH_SIZE, cfg.MQTT_BATCH_SECONDS)
 
-        except Exception as e:
-          logger.debug(f"Exception {e}")
-          # To handle empty lines or lines not matching dsmr definitions (checksum, header, empty line)
-          pass
+    # Time of current batch is up; this telegram starts the next batch
+    if telegram_batch.due(ts):
+      self.__publish_batch(prefix, telegram_batch)
 
-      logger.debug(f"DICT = {listofjsondicts}")
+    telegram_batch.add(messages, ts, received, parsed)
+    if telegram_batch.due(ts):
+      self.__publish_batch(prefix, telegram_batch)
 
-      self.__publish_telegram(listofjsondicts)
-    else:
-      logger.debug(f"Telegram is skipped; time elapsed since last MQTT message = {(ts - self.__prev_ts)}")
-    return
+  def __publish_batch(self, prefix, telegram_batch):
+    # Latency of a batch is the latency of its first telegram
+    ts, received, parsed = telegram_batch.ts, telegram_batch.received, telegram_batch.parsed
+    self.__batch_sinks.publish(prefix, telegram_batch.pop(), ts, received, parsed)
+    self.__diagnostics.count("batches")
 
-  def run(self):
-    logger.debug(">>")
+  def __flush_batches(self, ts=None):
+    """
+      Publish batches whose time is up (no telegrams, eg meter disconnected)
 
-    while not self.__stopper.is_set():
-      # block till event is set, but implement timeout to allow stopper
-      self.__trigger.wait(timeout=1)
-      if self.__trigger.is_set():
-        # Make copy of the telegram, for further parsing
-        telegram = copy.deepcopy(self.__telegram)
+    Args:
+      :param int ts: epoch; timestamp of last telegram, or now; None publishes all batches
 
-        # Clear telegram list for next capture by ReadSerial class
-        self.__telegram.clear()
+    Returns:
+      None
+    """
+    for prefix, telegram_batch in self.__batches.items():
+      if telegram_batch.rows and (ts is None or telegram_batch.due(ts)):
+        self.__publish_batch(prefix, telegram_batch)
 
-        # Clear trigger, serial can continue
-        self.__trigger.clear()
+  def __count_gaps(self, counter, prefix):
+    """
+      Readers number telegrams; a gap in the numbers is telegrams dropped by the channel (or reader process)
+
+    Args:
+      :param int counter: telegram counter, assigned by reader
+      :param str prefix: MQTT topic prefix
+
+    Returns:
+      None
+    """
+    self.__diagnostics.count("telegrams")
+    last = self.__counters.get(prefix)
+    self.__counters[prefix] = counter
+
+    # Counter restarts when reader restarts
+    if last is not None and counter > last + 1:
+      self.__diagnostics.count("gaps", counter - last - 1)
 
-        self.__decode_telegrams(telegram)
+  def __publish_diagnostics(self):
+    topic = sinks.mqtt_topic(cfg.MQTT_TOPIC_PREFIX, "diagnostics")
+    self.__mqtt.do_publish(topic, self.__diagnostics.encode(int(self.__clock.time())), retain=False)
+
+  def run(self):
+    logger.debug(">>")
+
+    latency_log = time.monotonic() + cfg.LATENCY_LOG_INTERVAL
+    diagnostics_ts = time.monotonic() + cfg.DIAGNOSTICS_INTERVAL
+    self.__sinks.start()
+    if self.__batch_sinks is not None:
+      self.__batch_sinks.start()
+
+    try:
+      # At stop, parse telegrams which are still queued
+      while not self.__stopper.is_set() or len(self.__telegrams):
+        # block till telegram is available, but implement timeout to allow stopper
+        telegram = self.__telegrams.get(timeout=1)
+        if telegram is not None:
+          prefix = telegram.prefix or cfg.MQTT_TOPIC_PREFIX
+          self.__count_gaps(telegram.counter, prefix)
+          self.__decode_telegrams(telegram.lines, prefix, telegram.received, int(telegram.ts))
+
+        if self.__batches:
+          if telegram is not None:
+            # Batches follow the timestamps of the telegrams (in simulation: replayed timestamps)
+            self.__flush_batches(int(telegram.ts))
+          elif cfg.PRODUCTION:
+            # No telegrams, eg meter disconnected
+            self.__flush_batches(int(time.time()))
+
+        if time.monotonic() >= latency_log:
+          latency_log += cfg.LATENCY_LOG_INTERVAL
+          self.__latency.log()
+
+        if cfg.DIAGNOSTICS_INTERVAL and time.monotonic() >= diagnostics_ts:
+          diagnostics_ts += cfg.DIAGNOSTICS_INTERVAL
+          self.__publish_diagnostics()
+
+    finally:
+      # Publish incomplete batches & write queued messages of all sinks
+      if self.__batch_sinks is not None:
+        self.__flush_batches()
+        self.__batch_sinks.stop()
+      self.__sinks.stop()
+
+    self.__latency.log()
+    logger.info(f"Diagnostics: {self.__diagnostics.encode()}")
+
+    if self.__deltas:
+      for prefix, delta_filter in self.__deltas.items():
+        logger.info(f"Delta {prefix}: keyframes = {delta_filter.keyframes}; "
+                    f"fields suppressed = {delta_filter.suppressed}/{delta_filter.fields}")
 
     logger.debug("<<")
@@ -0,0 +1,333 @@
+"""
+Compiled parse plan of dsmr telegrams
+
+The dsmr definition (dsmr50.py) is compiled once at startup into a plan:
+  - per OBIS reference an extractor; plain substring extraction when the regex
+    is trivial ("^.*\\((.*)\\)" or "^.*\\((.*)\\*kWh\\)"), otherwise a precompiled regex
+  - the datatype as callable (int, float, str); no eval
+  - the multiplication factor, cast once to the datatype
+  - MQTT topic & tag
+  - derived entries (dsmr.derived) with their operation
+
+Parsing a telegram is then a dict lookup per line (OBIS reference is the text before
+the first "("), an extraction, a cast and a multiplication. The parsed values are
+collected per MQTT topic, in a dictionary topic:{tag:value}.
+
+Lines with several values in parenthesised groups (eg power failure event log,
+monthly & historical peaks) are split once by tokenize(), in linear time. Their
+definition selects groups by position ("groups:2;3") and has semicolon separated
+tags, datatypes and multiplication factors, one per selected group.
+
+The plan does not depend on config.py and can be used outside dsmr-mqtt.py.
+
+Measure the parse cost per telegram:
+  python3 P1_plan.py test/dsmr.raw
+
+        This program is free software: you can redistribute it and/or modify
+        it under the terms of the GNU General Public License as published by
+        the Free Software Foundation, either version 3 of the License, or
+        (at your option) any later version.
+
+        This program is distributed in the hope that it will be useful,
+        but WITHOUT ANY WARRANTY; without even the implied warranty of
+        MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+        GNU General Public License for more details.
+
+        You should have received a copy of the GNU General Public License
+        along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import sys
+import time
+import re
+
+import dsmr50 as dsmr
+import P1_framer as framer
+
+# Logging
+import __main__
+import logging
+import os
+script = os.path.basename(__main__.__file__)
+script = os.path.splitext(script)[0]
+logger = logging.getLogger(script + "." + __name__)
+
+# Allowed datatypes in dsmr definition; "timestamp" converts YYMMDDhhmmssX to epoch
+CASTS = {"int": int, "float": float, "str": str, "timestamp": framer.dsmr_timestamp}
+
+# Gas consumption; M-Bus value with capture time, eg "0-1:24.2.1(211205210500W)(10142.194*m3)"
+GAS = "0-1:24.2.1"
+
+# Regex field of multi-value entries: selected groups, eg "groups:2;3"; negative counts from the end
+GROUPS = "groups:"
+
+# Regex which can be replaced by substring extraction: "^.*\((.*)\)" and "^.*\((.*)\*<unit>\)"
+TRIVIAL_REGEX = re.compile(r"\^\.\*\\\(\(\.\*\)(?:\\\*(\w+))?\\\)")
+
+
+def _diff(operands):
+  return operands[0] - sum(operands[1:])
+
+
+# Operations of derived entries
+OPERATIONS = {"sum": sum, "diff": _diff}
+
+
+def tokenize(line):
+  """
+    Split COSEM line in OBIS reference and the values of its parenthesised groups; single pass, no regex
+    "0-1:24.2.1(211205210500W)(10142.194*m3)" -> "0-1:24.2.1", ["211205210500W", "10142.194*m3"]
+
+  Args:
+    :param str line: telegram line
+
+  Returns:
+    :rtype: str, list
+  """
+  parts = line.split("(")
+  return parts[0], [part[:-1] if part.endswith(")") else part for part in parts[1:]]
+
+
+def nrof_values(regex):
+  """
+  Args:
+    :param str regex: regex or group selection ("groups:...") from dsmr definition
+
+  Returns:
+    :rtype: int: number of values of a dsmr definition entry
+  """
+  if regex.startswith(GROUPS):
+    return len(regex[len(GROUPS):].split(";"))
+  return re.compile(regex).groups
+
+
+def compile_extract(regex):
+  """
+    Compile dsmr regex to an extractor; returns first group of regex or None
+
+  Args:
+    :param str regex: regex from dsmr definition
+
+  Returns:
+    function(line) -> str or None
+  """
+  match = TRIVIAL_REGEX.fullmatch(regex)
+  if match is None:
+    pattern = re.compile(regex)
+
+    def extract(line):
+      m = pattern.match(line)
+      return m.group(1) if m else None
+
+    return extract
+
+  # Same result as regex: up to the last suffix, from the last "(" before the suffix
+  suffix = f"*{match.group(1)})" if match.group(1) else ")"
+
+  def extract(line):
+    end = line.rfind(suffix)
+    if end < 0:
+      return None
+    start = line.rfind("(", 0, end)
+    if start < 0:
+      return None
+    return line[start + 1:end]
+
+  return extract
+
+
+def _cast(index, datatype):
+  try:
+    return CASTS[datatype]
+  except KeyError:
+    raise ValueError(f"{index}: datatype {datatype} is not one of {list(CASTS)}") from None
+
+
+def _factor(cast, multiplication):
+  # If type is string, there is no multiplication factor; skip multiplication by 1
+  if cast in (str, framer.dsmr_timestamp):
+    return None
+  factor = cast(multiplication)
+  return factor if factor != 1 else None
+
+
+class _Element:
+  """
+    Compiled dsmr definition of one OBIS reference
+  """
+  __slots__ = ("topic", "tag", "extract", "cast", "factor", "groups")
+
+  def __init__(self, index, entry):
+    self.topic = str(entry[dsmr.MQTT_TOPIC])
+    regex = entry[dsmr.REGEX]
+
+    if regex.startswith(GROUPS):
+      # Multi-value entry: (group, tag, cast, factor) per value
+      positions = [int(position) for position in regex[len(GROUPS):].split(";")]
+      tags = str(entry[dsmr.MQTT_TAG]).split(";")
+      datatypes = entry[dsmr.DATATYPE].split(";")
+      factors = str(entry[dsmr.MULTIPLICATION]).split(";")
+      if len(factors) == 1:
+        factors = factors * len(positions)
+      if not len(positions) == len(tags) == len(datatypes) == len(factors):
+        raise ValueError(f"{index}: number of groups, tags, datatypes and multiplication factors differ")
+
+      casts = [_cast(index, datatype) for datatype in datatypes]
+      self.groups = tuple((position, tag, cast, _factor(cast, factor))
+                          for position, tag, cast, factor in zip(positions, tags, casts, factors))
+      self.tag = None
+      self.extract = None
+      self.cast = None
+      self.factor = None
+      return
+
+    self.groups = None
+    self.tag = str(entry[dsmr.MQTT_TAG])
+    self.extract = compile_extract(regex)
+    self.cast = _cast(index, entry[dsmr.DATATYPE])
+    self.factor = _factor(self.cast, entry[dsmr.MULTIPLICATION])
+
+  def values(self, line):
+    """
+      Values of multi-value entry; groups which are missing or cannot be cast are skipped
+
+    Args:
+      :param str line: telegram line
+
+    Returns:
+      list of (tag, value)
+    """
+    _index, groups = tokenize(line)
+    values = []
+    for position, tag, cast, factor in self.groups:
+      try:
+        raw = groups[position]
+        if cast is not str:
+          # Strip unit, eg "04.329*kW"
+          raw = raw.partition("*")[0]
+        data = cast(raw)
+      except (IndexError, ValueError) as e:
+        logger.debug(f"Exception {e}")
+        continue
+
+      if factor is not None:
+        data *= factor
+      values.append((tag, data))
+    return values
+
+
+class ParsePlan:
+  """
+    dsmr definition & derived entries, compiled for parsing
+  """
+
+  def __init__(self, definition=dsmr.definition, derived=dsmr.derived):
+    """
+    Args:
+      :param dict definition: OBIS reference:[dsmr definition]; see dsmr50.py
+      :param dict derived: OBIS reference:[operation, [OBIS references]]; see dsmr50.py
+    """
+    self.elements = {index: _Element(index, entry) for index, entry in definition.items()}
+
+    # Derived entries: (index, operation, sources, element)
+    self.derived = []
+    for index, (operation, sources) in derived.items():
+      if operation not in OPERATIONS:
+        logger.warning(f"Unknown operation {operation} for derived entry {index}")
+      elif index not in self.elements:
+        logger.warning(f"Derived entry {index} is not in dsmr definition")
+      elif self.elements[index].groups is not None:
+        logger.warning(f"Derived entry {index} has multiple values")
+      else:
+        self.derived.append((index, OPERATIONS[operation], tuple(sources), self.elements[index]))
+
+  def parse(self, lines, ts):
+    """
+    Args:
+      :param list lines: telegram lines
+      :param int ts: epoch; added as "timestamp" to every topic
+
+    Returns:
+      :rtype: dict, dict: topic:{tag:value}, OBIS reference:value
+    """
+    messages = {}
+    values = {}
+    elements = self.elements
+
+    for line in lines:
+      index = line.partition("(")[0]
+      element = elements.get(index)
+      if element is None:
+        # Header, checksum, empty line or not in dsmr definition
+        continue
+
+      if element.groups is not None:
+        message = messages.get(element.topic)
+        if message is None:
+          message = messages[element.topic] = {"timestamp": ts}
+        message.update(element.values(line))
+        continue
+
+      raw = element.extract(line)
+      if raw is None:
+        continue
+
+      try:
+        data = element.cast(raw)
+      except ValueError as e:
+        logger.debug(f"Exception {e}")
+        continue
+
+      if element.factor is not None:
+        data *= element.factor
+
+      message = messages.get(element.topic)
+      if message is None:
+        message = messages[element.topic] = {"timestamp": ts}
+      message[element.tag] = data
+      values[index] = data
+
+    for index, operation, sources, element in self.derived:
+      operands = [values[source] for source in sources if source in values]
+      if not operands:
+        continue
+
+      data = element.cast(operation(operands))
+      message = messages.get(element.topic)
+      if message is None:
+        message = messages[element.topic] = {"timestamp": ts}
+      message[element.tag] = data
+      values[index] = data
+
+    return messages, values
+
+
+def main(filename, repeat=200):
+  """
+    Measure cost of parsing per telegram (framing excluded)
+
+  Args:
+    :param str filename: raw dsmr file (eg test/dsmr.raw)
+    :param int repeat: number of passes over file
+
+  Returns:
+    None
+  """
+  with open(filename, 'rb') as f:
+    telegrams = [framer.telegram_lines(frame) for frame in framer.TelegramFramer().feed(f.read())]
+
+  plan = ParsePlan()
+
+  t_start = time.perf_counter()
+  for _i in range(repeat):
+    for lines in telegrams:
+      plan.parse(lines, 0)
+  t_elapsed = time.perf_counter() - t_start
+
+  nroftelegrams = repeat * len(telegrams)
+  print(f"{t_elapsed * 1e6 / max(nroftelegrams, 1):.1f} us per telegram "
+        f"({nroftelegrams / t_elapsed:.0f} telegrams/s)")
+
+
+if __name__ == '__main__':
+  main(sys.argv[1] if len(sys.argv) > 1 else "test/dsmr.raw")
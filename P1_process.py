@@ -0,0 +1,284 @@
+"""
+  Read P1 serial port in a separate process (SERIAL_PROCESS = True)
+
+  In the main process, the paho network loop, JSON encoding and logging share the GIL
+  with the serial reader. Under load (eg broker reconnect storms) serial reads are delayed,
+  the serial buffer overflows and telegrams get corrupted.
+
+  ProcessReadSerial reads & frames (CRC) telegrams in its own process (and core) and writes
+  complete telegrams in a ring buffer in shared memory (multiprocessing.shared_memory).
+  TaskReadProcess consumes the ring in the main process and hands over telegrams to the parser.
+
+  Shared memory layout:
+    header: write sequence, read sequence, dropped telegrams (3 x uint64)
+    slots:  SLOT_SIZE bytes each; telegram counter (uint32), length (uint32), receive time (double), raw telegram
+
+  The ring is single producer, single consumer. Header updates are protected by a
+  multiprocessing.Lock; a Semaphore counts filled slots to wake up the consumer.
+  When the ring is full, the newest telegram is dropped (and counted); the reader never waits.
+
+        This program is free software: you can redistribute it and/or modify
+        it under the terms of the GNU General Public License as published by
+        the Free Software Foundation, either version 3 of the License, or
+        (at your option) any later version.
+
+        This program is distributed in the hope that it will be useful,
+        but WITHOUT ANY WARRANTY; without even the implied warranty of
+        MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+        GNU General Public License for more details.
+
+        You should have received a copy of the GNU General Public License
+        along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import threading
+import multiprocessing
+import multiprocessing.shared_memory
+import signal
+import struct
+import time
+
+import config as cfg
+import P1_framer as framer
+import P1_channel as channel
+import P1_serial as p1
+
+# Logging
+import __main__
+import logging
+import os
+script = os.path.basename(__main__.__file__)
+script = os.path.splitext(script)[0]
+logger = logging.getLogger(script + "." + __name__)
+
+SLOT_SIZE = 8192
+NROF_SLOTS = 32
+
+# The reader process is forked before other threads are started; dsmr-mqtt.py cannot be re-imported (spawn)
+_fork = multiprocessing.get_context("fork")
+
+HEADER = struct.Struct("<QQQ")
+SLOT_HEADER = struct.Struct("<IId")
+
+
+class SharedTelegramRing:
+  """
+    Ring of telegram slots in shared memory; create before forking the reader process
+  """
+
+  def __init__(self, nrof_slots=NROF_SLOTS, slot_size=SLOT_SIZE):
+    """
+    Args:
+      :param int nrof_slots:
+      :param int slot_size: max size of a telegram + SLOT_HEADER
+    """
+    self.__nrof_slots = nrof_slots
+    self.__slot_size = slot_size
+    self.__shm = multiprocessing.shared_memory.SharedMemory(create=True,
+                                                            size=HEADER.size + nrof_slots * slot_size)
+    self.__buf = self.__shm.buf
+    HEADER.pack_into(self.__buf, 0, 0, 0, 0)
+
+    self.__lock = _fork.Lock()
+    self.__filled = _fork.Semaphore(0)
+
+  def put(self, counter, frame, received):
+    """
+      Producer (reader process); never blocks
+
+    Args:
+      :param int counter: telegram counter
+      :param bytes frame: raw telegram
+      :param float received: epoch; telegram complete
+
+    Returns:
+      :rtype: bool: False if telegram is dropped (ring full or telegram too large)
+    """
+    with self.__lock:
+      write_seq, read_seq, dropped = HEADER.unpack_from(self.__buf, 0)
+      if write_seq - read_seq >= self.__nrof_slots or len(frame) > self.__slot_size - SLOT_HEADER.size:
+        HEADER.pack_into(self.__buf, 0, write_seq, read_seq, dropped + 1)
+        return False
+
+      offset = HEADER.size + (write_seq % self.__nrof_slots) * self.__slot_size
+      SLOT_HEADER.pack_into(self.__buf, offset, counter, len(frame), received)
+      offset += SLOT_HEADER.size
+      self.__buf[offset:offset + len(frame)] = frame
+      HEADER.pack_into(self.__buf, 0, write_seq + 1, read_seq, dropped)
+
+    self.__filled.release()
+    return True
+
+  def get(self, timeout=None):
+    """
+      Consumer (main process)
+
+    Args:
+      :param float timeout: max time to wait for a telegram
+
+    Returns:
+      (counter, raw telegram, receive time) or None after timeout
+    """
+    if not self.__filled.acquire(timeout=timeout):
+      return None
+
+    with self.__lock:
+      write_seq, read_seq, dropped = HEADER.unpack_from(self.__buf, 0)
+      offset = HEADER.size + (read_seq % self.__nrof_slots) * self.__slot_size
+      counter, length, received = SLOT_HEADER.unpack_from(self.__buf, offset)
+      offset += SLOT_HEADER.size
+      frame = bytes(self.__buf[offset:offset + length])
+      HEADER.pack_into(self.__buf, 0, write_seq, read_seq + 1, dropped)
+
+    return counter, frame, received
+
+  def dropped(self):
+    """
+    Returns:
+      :rtype: int: number of telegrams dropped by producer
+    """
+    return HEADER.unpack_from(self.__buf, 0)[2]
+
+  def close(self, unlink=False):
+    """
+    Args:
+      :param bool unlink: release shared memory (owner, main process)
+
+    Returns:
+      None
+    """
+    self.__buf = None
+    self.__shm.close()
+    if unlink:
+      self.__shm.unlink()
+
+
+class ProcessReadSerial(_fork.Process):
+  """
+    Serial reader & framer; runs in separate process
+  """
+
+  def __init__(self, ring, stopper, port, baudrate):
+    """
+    Args:
+      :param SharedTelegramRing ring:
+      :param multiprocessing.Event() stopper: stops process
+      :param str port: serial port
+      :param int baudrate:
+    """
+    super().__init__(daemon=True)
+    self.__ring = ring
+    self.__stopper = stopper
+    self.__port = port
+    self.__baudrate = baudrate
+
+  def run(self):
+    # Main process controls shutdown via stopper
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    logger.debug(f">> pid = {os.getpid()}")
+
+    telegram_framer = framer.TelegramFramer()
+    counter = 0
+
+    try:
+      # Short timeout, to check stopper regularly
+      tty = p1.serial_port(self.__port, self.__baudrate, timeout=1)
+      tty.open()
+      logger.info(f"Serial process: using USB device {self.__port} with baud {self.__baudrate}")
+
+      while not self.__stopper.is_set():
+        data = tty.read(tty.in_waiting or 1)
+        received = time.time()
+        for frame in telegram_framer.feed(data):
+          counter += 1
+          self.__ring.put(counter, frame, received)
+
+      tty.close()
+
+    except Exception as e:
+      logger.error(f"Serial process: {type(e).__name__}: {str(e)}")
+
+    finally:
+      logger.info(f"Serial process: {telegram_framer.statistics()}; ring dropped = {self.__ring.dropped()}")
+      self.__ring.close()
+      self.__stopper.set()
+
+    logger.debug("<<")
+
+
+class TaskReadProcess(threading.Thread):
+  """
+    Consume telegrams from serial reader process; same role as TaskReadSerial
+  """
+
+  def __init__(self, telegrams, stopper, capture=None):
+    """
+      The serial process is started here (fork), before other threads are started
+
+    Args:
+      :param P1_channel.TelegramChannel() telegrams: hands over telegrams to parser
+      :param threading.Event() stopper: stops thread
+      :param P1_capture.CaptureRecorder() capture: OPTIONAL; records raw telegrams
+    """
+    logger.debug(">>")
+    super().__init__()
+    self.__telegrams = telegrams
+    self.__stopper = stopper
+    self.__capture = capture
+
+    self.__ring = SharedTelegramRing()
+    self.__process_stopper = _fork.Event()
+    self.__process = ProcessReadSerial(self.__ring, self.__process_stopper, cfg.ser_port, cfg.ser_baudrate)
+    self.__process.start()
+
+  def __del__(self):
+    logger.debug(">>")
+
+  def __handover(self, counter, frame, received):
+    """
+      Hand over a telegram from the ring to the parser
+
+    Args:
+      :param int counter: telegram counter
+      :param bytes frame: raw telegram
+      :param float received: epoch; telegram complete
+
+    Returns:
+      None
+    """
+    lines = framer.telegram_lines(frame)
+    if self.__capture is not None:
+      self.__capture.record(frame, framer.meter_time(lines))
+    self.__telegrams.put(channel.Telegram(counter, lines, received=received))
+
+  def run(self):
+    logger.debug(">>")
+    try:
+      # Serial process stops on fatal errors (eg port cannot be opened)
+      while not (self.__stopper.is_set() or self.__process_stopper.is_set()):
+        item = self.__ring.get(timeout=1)
+        if item is not None:
+          self.__handover(*item)
+
+    except Exception as e:
+      logger.error(f"Exception: {e}")
+
+    finally:
+      self.__process_stopper.set()
+      self.__process.join(timeout=5)
+
+      # Serial process has stopped writing; hand over telegrams left in the ring
+      try:
+        item = self.__ring.get(timeout=0)
+        while item is not None:
+          self.__handover(*item)
+          item = self.__ring.get(timeout=0)
+      except Exception as e:
+        logger.error(f"Exception: {e}")
+
+      self.__ring.close(unlink=True)
+      logger.info(f"Channel: {self.__telegrams.statistics()}")
+      self.__stopper.set()
+
+    logger.debug("<<")
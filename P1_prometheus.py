@@ -0,0 +1,349 @@
+"""
+  Prometheus/OpenMetrics exporter (PROMETHEUS = True)
+
+  Serves the latest parsed values of all meters and the health of dsmr-mqtt on
+  http://<PROMETHEUS_ADDRESS>:<PROMETHEUS_PORT>/metrics, eg
+    # HELP dsmr_p_consumed Total power usage [W]
+    # TYPE dsmr_p_consumed gauge
+    dsmr_p_consumed{meter="dsmr",serial="33363137",obis="1-0:1.7.0",unit="W"} 866.0
+
+  Every numeric field of dsmr50.py is a gauge, labelled with the MQTT topic prefix (meter),
+  the serial of its topic (when in the telegram), its OBIS reference and unit.
+
+  The exposition is rendered by the parser, once per telegram; a scrape only writes the
+  pre-rendered buffer, whatever the scrape frequency. Health metrics (latency histograms,
+  memory, MQTT connects) change slowly and are rendered every HEALTH_INTERVAL seconds;
+  also when no telegrams are parsed (eg meter disconnected), by the MetricsServer loop.
+
+        This program is free software: you can redistribute it and/or modify
+        it under the terms of the GNU General Public License as published by
+        the Free Software Foundation, either version 3 of the License, or
+        (at your option) any later version.
+
+        This program is distributed in the hope that it will be useful,
+        but WITHOUT ANY WARRANTY; without even the implied warranty of
+        MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+        GNU General Public License for more details.
+
+        You should have received a copy of the GNU General Public License
+        along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import threading
+import http.server
+import resource
+import time
+import re
+
+import dsmr50 as dsmr
+
+# Logging
+import __main__
+import logging
+import os
+script = os.path.basename(__main__.__file__)
+script = os.path.splitext(script)[0]
+logger = logging.getLogger(script + "." + __name__)
+
+# Metric name prefix
+NAMESPACE = "dsmr"
+
+# Seconds between renders of health metrics
+HEALTH_INTERVAL = 10
+
+TEXT_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+OPENMETRICS_CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+
+def metric_name(tag):
+  """
+  Args:
+    :param str tag: MQTT tag, eg "p_consumed"
+
+  Returns:
+    :rtype: str: metric name, eg "dsmr_p_consumed"
+  """
+  return NAMESPACE + "_" + re.sub(r"[^a-zA-Z0-9_]", "_", tag)
+
+
+def label_value(value):
+  """
+  Returns:
+    :rtype: str: escaped label value
+  """
+  return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _family(name, kind, text, openmetrics):
+  # OpenMetrics: counter family is named without _total suffix
+  if openmetrics and kind == "counter":
+    name = name[:-len("_total")]
+  return f"# HELP {name} {text}\n# TYPE {name} {kind}\n"
+
+
+def _rss():
+  """
+  Returns:
+    :rtype: int: resident memory of this process [bytes]
+  """
+  try:
+    with open("/proc/self/statm") as f:
+      return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+  except (OSError, ValueError, IndexError):
+    # Max resident memory [kB] on other platforms
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class MetricsExporter:
+  """
+    Pre-rendered exposition of latest values & health
+  """
+
+  def __init__(self, plan, definition=dsmr.definition, latency=None, connect_count=None):
+    """
+    Args:
+      :param P1_plan.ParsePlan plan: compiled dsmr definition; provides topic, tag & datatype
+      :param dict definition: OBIS reference:[dsmr definition]; provides description & unit
+      :param P1_latency.LatencyTracer latency: latency histograms; None if not exported
+      :param connect_count: returns number of connects to MQTT broker; None if not exported
+    """
+    self.__latency = latency
+    self.__connect_count = connect_count
+
+    # [(metric name, help, [(topic, tag, obis, unit)])], in order of definition
+    self.__families = []
+    families = {}
+    for index, element in plan.elements.items():
+      entry = definition[index]
+      if element.groups is None:
+        fields = [(element.tag, element.cast, entry[dsmr.DESCRIPTION])]
+      else:
+        descriptions = entry[dsmr.DESCRIPTION].split(";")
+        fields = [(tag, cast, descriptions[i] if i < len(descriptions) else tag)
+                  for i, (_position, tag, cast, _factor) in enumerate(element.groups)]
+
+      unit = entry[dsmr.UNIT]
+      for tag, cast, description in fields:
+        if cast is str:
+          continue
+
+        name = metric_name(tag)
+        if name not in families:
+          families[name] = []
+          text = f"{description} [{unit}]" if unit else description
+          self.__families.append((name, text, families[name]))
+        families[name].append((element.topic, tag, index, unit))
+
+    # MQTT topic prefix:{(topic, tag):value}
+    self.__values = {}
+
+    # (prefix, topic):serial
+    self.__serials = {}
+
+    # [(text before value, values of meter, (topic, tag))]; rebuilt when fields or serials change
+    self.__layout = None
+
+    # MQTT topic prefix:[number of telegrams, epoch of last telegram]
+    self.__telegrams = {}
+
+    self.__start = time.time()
+    self.__health = (b"", b"")
+    self.__health_ts = 0.0
+
+    # update() by parser and refresh() by MetricsServer render from different threads
+    self.__lock = threading.Lock()
+
+    # Rendered exposition; replaced (not modified) at every update, read by MetricsServer
+    self.text = b""
+    self.openmetrics = b"# EOF\n"
+
+  def __sample(self, prefix, topic, obis, unit, name):
+    labels = f'meter="{label_value(prefix)}"'
+    serial = self.__serials.get((prefix, topic))
+    if serial is not None:
+      labels += f',serial="{label_value(serial)}"'
+    labels += f',obis="{obis}",unit="{label_value(unit)}"'
+    return f"{name}{{{labels}}} "
+
+  def __build_layout(self):
+    layout = []
+    for name, text, fields in self.__families:
+      header = f"# HELP {name} {text}\n# TYPE {name} gauge\n"
+      for prefix, values in self.__values.items():
+        for topic, tag, obis, unit in fields:
+          if (topic, tag) in values:
+            layout.append((header + self.__sample(prefix, topic, obis, unit, name), values, (topic, tag)))
+            header = ""
+    return layout
+
+  def update(self, prefix, messages, ts=None):
+    """
+      Store values of a parsed telegram & render exposition; called by parser
+
+    Args:
+      :param str prefix: MQTT topic prefix (meter)
+      :param dict messages: topic:{tag:value}; not modified
+      :param float ts: epoch of telegram; None is now
+
+    Returns:
+      None
+    """
+    with self.__lock:
+      values = self.__values.setdefault(prefix, {})
+      for topic, message in messages.items():
+        serial = message.get("serial")
+        if serial is not None and serial != self.__serials.get((prefix, topic)):
+          self.__serials[(prefix, topic)] = serial
+          self.__layout = None
+        for tag, value in message.items():
+          if tag != "timestamp" and not isinstance(value, str):
+            if (topic, tag) not in values:
+              self.__layout = None
+            values[(topic, tag)] = value
+
+      telegrams = self.__telegrams.setdefault(prefix, [0, 0.0])
+      telegrams[0] += 1
+      telegrams[1] = time.time() if ts is None else ts
+
+      self.__render()
+
+  def refresh(self):
+    """
+      Render exposition again when health metrics are older than HEALTH_INTERVAL;
+      called by MetricsServer, as update() is not called when no telegrams are parsed
+
+    Returns:
+      None
+    """
+    with self.__lock:
+      if time.monotonic() >= self.__health_ts:
+        self.__render()
+
+  def __render(self):
+    if self.__layout is None:
+      self.__layout = self.__build_layout()
+
+    parts = [f"{text}{values[key]!r}\n" for text, values, key in self.__layout]
+
+    name = NAMESPACE + "_last_telegram_timestamp_seconds"
+    parts.append(f"# HELP {name} Time of last parsed telegram\n# TYPE {name} gauge\n" +
+                 "".join(f'{name}{{meter="{label_value(prefix)}"}} {telegrams[1]!r}\n'
+                         for prefix, telegrams in self.__telegrams.items()))
+
+    if time.monotonic() >= self.__health_ts:
+      self.__health_ts = time.monotonic() + HEALTH_INTERVAL
+      self.__health = (self.__render_health(False).encode(), self.__render_health(True).encode())
+
+    name = NAMESPACE + "_telegrams_total"
+    counters = "".join(f'{name}{{meter="{label_value(prefix)}"}} {telegrams[0]}\n'
+                       for prefix, telegrams in self.__telegrams.items())
+
+    values = "".join(parts).encode()
+    counters = counters.encode()
+    self.text = b"".join((values, _family(name, "counter", "Parsed telegrams", False).encode(), counters,
+                          self.__health[0]))
+    self.openmetrics = b"".join((values, _family(name, "counter", "Parsed telegrams", True).encode(), counters,
+                                 self.__health[1], b"# EOF\n"))
+
+  def __render_health(self, openmetrics):
+    """
+    Args:
+      :param bool openmetrics: OpenMetrics (True) or Prometheus text format
+
+    Returns:
+      :rtype: str
+    """
+    parts = []
+
+    name = NAMESPACE + "_start_time_seconds"
+    parts.append(_family(name, "gauge", "Start time of dsmr-mqtt", openmetrics) + f"{name} {self.__start!r}\n")
+
+    name = NAMESPACE + "_resident_memory_bytes"
+    parts.append(_family(name, "gauge", "Resident memory of dsmr-mqtt", openmetrics) + f"{name} {_rss()}\n")
+
+    if self.__connect_count is not None:
+      name = NAMESPACE + "_mqtt_connects_total"
+      parts.append(_family(name, "counter", "Connects to MQTT broker", openmetrics) +
+                   f"{name} {self.__connect_count()}\n")
+
+    if self.__latency is not None:
+      name = NAMESPACE + "_latency_seconds"
+      samples = []
+      for stage, histogram in self.__latency.histograms.items():
+        counts = list(histogram.counts)
+        cumulative = 0
+        for bucket, count in zip(histogram.buckets, counts):
+          cumulative += count
+          samples.append(f'{name}_bucket{{stage="{stage}",le="{bucket / 1000}"}} {cumulative}\n')
+        samples.append(f'{name}_bucket{{stage="{stage}",le="+Inf"}} {cumulative + counts[-1]}\n')
+        samples.append(f'{name}_count{{stage="{stage}"}} {cumulative + counts[-1]}\n')
+        samples.append(f'{name}_sum{{stage="{stage}"}} {histogram.sum / 1000!r}\n')
+      parts.append(_family(name, "histogram", "Latency of telegrams from meter to MQTT broker, per stage",
+                           openmetrics) + "".join(samples))
+
+    return "".join(parts)
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+  """
+    Serves the pre-rendered exposition of a MetricsExporter
+  """
+
+  # Set by MetricsServer
+  exporter = None
+
+  def log_message(self, format, *args):
+    logger.debug(f"{self.address_string()}: {format % args}")
+
+  def do_GET(self):
+    if self.path.split("?")[0] != "/metrics":
+      self.send_error(404)
+      return
+
+    if "application/openmetrics-text" in self.headers.get("Accept", ""):
+      body, content_type = self.exporter.openmetrics, OPENMETRICS_CONTENT_TYPE
+    else:
+      body, content_type = self.exporter.text, TEXT_CONTENT_TYPE
+
+    self.send_response(200)
+    self.send_header("Content-Type", content_type)
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+
+class MetricsServer(threading.Thread):
+  """
+    HTTP server for Prometheus scrapes; one request at a time
+  """
+
+  def __init__(self, stopper, exporter, address="0.0.0.0", port=9340):
+    """
+    Args:
+      :param threading.Event() stopper: stops thread
+      :param MetricsExporter exporter:
+      :param str address: listen address
+      :param int port:
+    """
+    logger.debug(">>")
+    super().__init__()
+    self.__stopper = stopper
+    self.__exporter = exporter
+
+    handler = type("MetricsHandler", (_MetricsHandler,), {"exporter": exporter})
+    self.__server = http.server.HTTPServer((address, port), handler)
+    self.__server.timeout = 1
+
+  def __del__(self):
+    logger.debug(">>")
+
+  def run(self):
+    logger.debug(">>")
+    try:
+      while not self.__stopper.is_set():
+        # Returns after a request or server.timeout
+        self.__server.handle_request()
+        self.__exporter.refresh()
+    finally:
+      self.__server.server_close()
+    logger.debug("<<")
@@ -0,0 +1,169 @@
+"""
+  Replay a raw dsmr file (simulation mode, PRODUCTION = False)
+
+  Telegrams are paced by the meter timestamp (0-0:1.0.0) and a speed factor:
+  - SIMULATOR_SPEED = 1: real time; same pace as the meter
+  - SIMULATOR_SPEED = N: N times faster than the meter
+  - SIMULATOR_SPEED = 0: as fast as possible
+
+  Every telegram carries its replayed timestamp (P1_channel.Telegram.ts); the parser uses it
+  for the rate limiter & MQTT timestamp, so that a day of telegrams runs through the complete
+  pipeline in seconds, with the same MQTT output as in real time, whatever the speed.
+  A virtual clock follows the replayed timestamps; it replaces time.time() in HA discovery
+  (discovery interval). As the reader runs ahead of the parser (queued telegrams), the
+  virtual clock is not used for the MQTT messages.
+
+  The file can be replayed multiple times (SIMULATOR_REPEAT); the virtual clock
+  continues after the last telegram of the previous pass.
+
+        This program is free software: you can redistribute it and/or modify
+        it under the terms of the GNU General Public License as published by
+        the Free Software Foundation, either version 3 of the License, or
+        (at your option) any later version.
+
+        This program is distributed in the hope that it will be useful,
+        but WITHOUT ANY WARRANTY; without even the implied warranty of
+        MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+        GNU General Public License for more details.
+
+        You should have received a copy of the GNU General Public License
+        along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import time
+
+# Logging
+import __main__
+import logging
+import os
+script = os.path.basename(__main__.__file__)
+script = os.path.splitext(script)[0]
+logger = logging.getLogger(script + "." + __name__)
+
+
+class VirtualClock:
+  """
+    Drop-in for the time module (time(), sleep()); time is set by the replay
+  """
+
+  def __init__(self):
+    self.__now = None
+
+  def set(self, now):
+    """
+    Args:
+      :param float now: epoch
+
+    Returns:
+      None
+    """
+    self.__now = now
+
+  def time(self):
+    """
+    Returns:
+      :rtype: float: virtual epoch; wall clock as long as no telegram has been replayed
+    """
+    if self.__now is None:
+      return time.time()
+    return self.__now
+
+  @staticmethod
+  def sleep(seconds):
+    time.sleep(seconds)
+
+
+class ReplayFile:
+  """
+    File object (read(), close()) for TaskReadSerial in simulation mode
+
+    Reading stops at the literal "EOF" marker or end of file;
+    after the last pass, read() returns b''
+  """
+
+  def __init__(self, filename, clock, speed=1.0, repeat=1):
+    """
+    Args:
+      :param str filename: raw dsmr file
+      :param VirtualClock clock: virtual clock, set for every replayed telegram
+      :param float speed: 0 is as fast as possible, otherwise speed factor relative to meter timestamps
+      :param int repeat: number of passes through the file
+    """
+    self.__file = open(filename, 'rb')
+    self.__filename = filename
+    self.__clock = clock
+    self.__speed = speed
+    self.__passes = repeat
+
+    # Anchor pacing to first telegram, to prevent drift
+    self.__t_start = None
+    self.__meter_start = None
+
+    # Meter timestamp of previous telegram, as read from file and as replayed
+    self.__prev_meter = None
+    self.__prev_replay = None
+
+    logger.info(f"Replay {filename}; speed = {speed or 'max'}; repeat = {repeat}")
+
+  def read(self, size):
+    """
+    Args:
+      :param int size: max number of bytes
+
+    Returns:
+      :rtype: bytes: b'' at end of last pass
+    """
+    while self.__passes > 0:
+      data = self.__file.read(size)
+      eof = data.find(b'EOF')
+      if eof >= 0:
+        data = data[:eof]
+        self.__file.seek(0, os.SEEK_END)
+
+      if data:
+        return data
+
+      self.__passes -= 1
+      logger.debug(f"EOF Detected in {self.__filename}; {self.__passes} passes left")
+      self.__file.seek(0)
+
+    return b''
+
+  def pace(self, meter_ts):
+    """
+      Wait till telegram is due and set virtual clock
+
+    Args:
+      :param int meter_ts: meter timestamp of telegram (epoch); None if not available
+
+    Returns:
+      :rtype: float: replayed (virtual) timestamp of telegram
+    """
+    if self.__prev_replay is None:
+      replay_ts = meter_ts if meter_ts is not None else time.time()
+    elif meter_ts is None or self.__prev_meter is None or meter_ts <= self.__prev_meter:
+      # No timestamp, or next pass through file: continue 1 second after previous telegram
+      replay_ts = self.__prev_replay + 1
+    else:
+      replay_ts = self.__prev_replay + (meter_ts - self.__prev_meter)
+
+    if meter_ts is not None:
+      self.__prev_meter = meter_ts
+    elif self.__prev_meter is not None:
+      self.__prev_meter += 1
+    self.__prev_replay = replay_ts
+
+    if self.__speed > 0:
+      if self.__t_start is None:
+        self.__t_start = time.monotonic()
+        self.__meter_start = replay_ts
+
+      delay = self.__t_start + (replay_ts - self.__meter_start) / self.__speed - time.monotonic()
+      if delay > 0:
+        time.sleep(delay)
+
+    self.__clock.set(replay_ts)
+    return replay_ts
+
+  def close(self):
+    self.__file.close()
@@ -0,0 +1,127 @@
+"""
+Publish schedules per MQTT topic and per field
+
+MQTT_MAXRATE is the default rate of all topics. A topic can have its own rate
+(MQTT_TOPIC_RATE in config.py) and a field can have its own rate (dsmr.schedule),
+eg power at 3600 (every second), gas at 12 (every 5 minutes) and system at 1 (every hour).
+
+Every schedule has its own due time. A field is published when its schedule is due;
+fields without own schedule follow the schedule of their topic. The due time of a
+schedule moves on when one or more of its fields are published.
+
+Rates are messages per hour [1..3600], as MQTT_MAXRATE.
+
+        This program is free software: you can redistribute it and/or modify
+        it under the terms of the GNU General Public License as published by
+        the Free Software Foundation, either version 3 of the License, or
+        (at your option) any later version.
+
+        This program is distributed in the hope that it will be useful,
+        but WITHOUT ANY WARRANTY; without even the implied warranty of
+        MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+        GNU General Public License for more details.
+
+        You should have received a copy of the GNU General Public License
+        along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import dsmr50 as dsmr
+
+# Logging
+import __main__
+import logging
+import os
+script = os.path.basename(__main__.__file__)
+script = os.path.splitext(script)[0]
+logger = logging.getLogger(script + "." + __name__)
+
+# Schedule of topics without own rate
+DEFAULT = None
+
+
+def interval(rate):
+  """
+  Args:
+    :param int rate: messages per hour [1..3600]
+
+  Returns:
+    :rtype: int: minimum number of seconds between messages
+  """
+  assert 0 < rate <= 3600, f"Rate {rate} outside range 1.3600"
+  return int(3600 / rate)
+
+
+class PublishSchedule:
+  """
+    Due times of topics & fields of one meter
+  """
+
+  def __init__(self, plan, default_rate, topic_rate=None, schedule=dsmr.schedule):
+    """
+    Args:
+      :param P1_plan.ParsePlan plan: compiled dsmr definition; provides topic & tag
+      :param int default_rate: messages per hour of topics without own rate (MQTT_MAXRATE)
+      :param dict topic_rate: topic:messages per hour
+      :param dict schedule: OBIS reference:messages per hour; see dsmr50.py
+    """
+    # schedule key:interval; key is DEFAULT, topic or (topic, tag)
+    self.__intervals = {DEFAULT: interval(default_rate)}
+    for topic, rate in (topic_rate or {}).items():
+      self.__intervals[topic] = interval(rate)
+
+    self.__fields = set()
+    for index, rate in schedule.items():
+      element = plan.elements.get(index)
+      if element is None:
+        logger.warning(f"Schedule entry {index} is not in dsmr definition")
+      elif element.groups is not None:
+        for _position, tag, _cast, _factor in element.groups:
+          self.__fields.add((element.topic, tag))
+          self.__intervals[(element.topic, tag)] = interval(rate)
+      else:
+        self.__fields.add((element.topic, element.tag))
+        self.__intervals[(element.topic, element.tag)] = interval(rate)
+
+    # schedule key:timestamp of last publish; None if not published yet
+    self.__last = dict.fromkeys(self.__intervals)
+
+  def __is_due(self, key, ts):
+    last = self.__last[key]
+    return last is None or ts - last > self.__intervals[key]
+
+  def due(self, ts):
+    """
+    Args:
+      :param int ts: epoch
+
+    Returns:
+      :rtype: bool: True if at least one schedule is due; telegram has to be parsed
+    """
+    return any(self.__is_due(key, ts) for key in self.__intervals)
+
+  def select(self, messages, ts):
+    """
+      Remove fields which are not due; restart schedules of published fields
+
+    Args:
+      :param dict messages: topic:{tag:value}; modified in place
+      :param int ts: epoch
+
+    Returns:
+      None
+    """
+    due = {key for key in self.__intervals if self.__is_due(key, ts)}
+    published = set()
+
+    for topic, message in messages.items():
+      topic_key = topic if topic in self.__intervals else DEFAULT
+
+      for tag in [tag for tag in message if tag != "timestamp"]:
+        key = (topic, tag) if (topic, tag) in self.__fields else topic_key
+        if key in due:
+          published.add(key)
+        else:
+          del message[tag]
+
+    for key in published:
+      self.__last[key] = ts
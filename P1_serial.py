@@ -1,6 +1,9 @@
 """
 Read dsmr telgrams from P1 USB serial.
 
+TaskReadSerial: reads a single P1 port (or simulation file)
+TaskReadSerialPorts: reads several P1 ports (SERIAL_PORTS) from one thread, multiplexed with selectors
+
 
 To test in bash the P1 usb connector:
 raw -echo < /dev/ttyUSB0; cat -vt /dev/ttyUSB0
@@ -28,10 +31,14 @@ python3 -m serial.tools.miniterm /dev/ttyUSB0 115200 --xonxoff
 
 import serial
 import threading
+import selectors
 import time
-import re
 
 import config as cfg
+import P1_framer as framer
+import P1_channel as channel
+import P1_replay as replay
+import P1_diagnostics as diagnostics
 
 # Logging
 import __main__
@@ -42,35 +49,64 @@ script = os.path.splitext(script)[0]
 logger = logging.getLogger(script + "." + __name__)
 
 
+def serial_port(port, baudrate, timeout):
+  """
+    Serial port configured for P1 (7E1); not yet opened
+
+  Args:
+    :param str port: eg /dev/ttyUSB0
+    :param int baudrate:
+    :param float timeout: read timeout in seconds; 0 is non-blocking
+
+  Returns:
+    :rtype: serial.Serial
+  """
+  tty = serial.Serial()
+  tty.port = port
+  tty.baudrate = baudrate
+  tty.bytesize = serial.SEVENBITS
+  tty.parity = serial.PARITY_EVEN
+  tty.stopbits = serial.STOPBITS_ONE
+  tty.xonxoff = 0
+  tty.rtscts = 0
+  tty.timeout = timeout
+  return tty
+
+
 class TaskReadSerial(threading.Thread):
 
-  def __init__(self, trigger, stopper, telegram):
+  def __init__(self, telegrams, stopper, clock=None, capture=None):
     """
 
     Args:
-      :param threading.Event() trigger: signals that new telegram is available
+      :param P1_channel.TelegramChannel() telegrams: hands over telegrams to parser
       :param threading.Event() stopper: stops thread
-      :param list() telegram: dsmr telegram
+      :param P1_replay.VirtualClock() clock: only in simulation; follows replayed meter timestamps
+      :param P1_capture.CaptureRecorder() capture: OPTIONAL; records raw telegrams
     """
 
     logger.debug(">>")
     super().__init__()
-    self.__trigger = trigger
+    self.__telegrams = telegrams
     self.__stopper = stopper
-    self.__telegram = telegram
+    self.__capture = capture
     self.__counter = 0
+    self.__framer = diagnostics.TimedFramer("serial")
+
+    # Capture telegrams rejected by framer too; meter timestamp of last valid telegram
+    self.__meter_ts = None
+    if capture is not None:
+      self.__framer.rejected = lambda data: capture.record(data, self.__meter_ts, rejected=True)
+
+    # Telegrams which have been read, but not yet passed on to the parser
+    self.__frames = []
+
+    # Only in simulator mode; set when "EOF" or end of file has been read
+    self.__eof = False
 
     # [ Serial parameters ]
     if cfg.PRODUCTION:
-      self.__tty = serial.Serial()
-      self.__tty.port = cfg.ser_port
-      self.__tty.baudrate = cfg.ser_baudrate
-      self.__tty.bytesize = serial.SEVENBITS
-      self.__tty.parity = serial.PARITY_EVEN
-      self.__tty.stopbits = serial.STOPBITS_ONE
-      self.__tty.xonxoff = 0
-      self.__tty.rtscts = 0
-      self.__tty.timeout = 20
+      self.__tty = serial_port(cfg.ser_port, cfg.ser_baudrate, timeout=20)
       logger.info(f"Using USB device {self.__tty.port} with baud {self.__tty.baudrate}")
 
     try:
@@ -78,7 +114,7 @@ class TaskReadSerial(threading.Thread):
         self.__tty.open()
         logger.debug(f"serial {self.__tty.port} opened")
       else:
-        self.__tty = open(cfg.SIMULATORFILE, 'rb')
+        self.__tty = replay.ReplayFile(cfg.SIMULATORFILE, clock, cfg.SIMULATOR_SPEED, cfg.SIMULATOR_REPEAT)
 
     except Exception as e:
       logger.error(f"ReadSerial: {type(e).__name__}: {str(e)}")
@@ -88,126 +124,240 @@ class TaskReadSerial(threading.Thread):
   def __del__(self):
     logger.debug(">>")
 
-  def __preprocess(self):
+  def __read_frames(self):
+    """
+      Read all available bytes from serial port in bulk and feed them to the framer.
+      Blocks till at least one byte is available (or serial timeout).
+      In non-production mode, reads from replay file
+
+    Returns:
+      list of complete, CRC validated telegrams (bytes)
     """
-      Add a virtual dsmr entry, which is sum of tariff 1 and tariff 2
+    if cfg.PRODUCTION:
+      data = self.__tty.read(self.__tty.in_waiting or 1)
+    else:
+      data = self.__tty.read(4096)
+      if not data:
+        self.__eof = True
 
-      "1-0:1.8.1" + "1-0:1.8.2" --> "1-0:1.8.3"
-      "1-0:2.8.1" + "1-0:2.8.2" --> "1-0:2.8.3"
+    return self.__framer.feed(data)
 
-      1-0:1.8.1(016230.132*kWh)
-      1-0:1.8.2(007449.542*kWh)
-      1-0:2.8.1(005998.736*kWh)
-      1-0:2.8.2(015098.938*kWh)
+  def __read_serial(self):
+    """
+      Opens & Closes serial port
+      Reads dsmr telegrams and hands them over to the parser via the telegram channel.
+      Never waits for the parser; when the channel is full, the channel overflow policy applies.
+      In non-production mode, reads telegrams from file
 
     Returns:
       None
     """
+    logger.debug(">>")
 
-    e_consumed = 0.0
-    e_returned = 0.0
+    while not self.__stopper.is_set():
 
-    for element in self.__telegram:
-      try:
-        value = re.match(r"1-0:1\.8\.1\((\d{6}\.\d{3})\*kWh\)", element).group(1)
-        e_consumed = e_consumed + float(value)
-      except AttributeError:
-        pass
+      # Read till at least one complete telegram is available
+      while not (self.__frames or self.__stopper.is_set()):
+        if self.__eof:
+          self.__stopper.set()
+          break
+        self.__frames = self.__read_frames()
 
-      try:
-        value = re.match(r"1-0:1\.8\.2\((\d{6}\.\d{3})\*kWh\)", element).group(1)
-        e_consumed = e_consumed + float(value)
-      except AttributeError:
-        pass
+      if not self.__frames:
+        break
 
-      try:
-        value = re.match(r"1-0:2\.8\.1\((\d{6}\.\d{3})\*kWh\)", element).group(1)
-        e_returned = e_returned + float(value)
-      except AttributeError:
-        pass
+      # Number telegrams, to detect gaps
+      self.__counter += 1
+      frame = self.__frames.pop(0)
+      lines = framer.telegram_lines(frame)
+      meter_ts = framer.meter_time(lines)
+
+      # In simulation mode, wait till telegram is due according to meter timestamp
+      if not cfg.PRODUCTION:
+        meter_ts = int(self.__tty.pace(meter_ts))
 
-      try:
-        value = re.match(r"1-0:2\.8\.2\((\d{6}\.\d{3})\*kWh\)", element).group(1)
-        e_returned = e_returned + float(value)
-      except AttributeError:
+      if self.__capture is not None:
+        self.__capture.record(frame, meter_ts)
+        self.__meter_ts = meter_ts
+
+      # New telegram is available for parser
+      # In simulation mode, channel might block; retry till parser has a free slot
+      # The parser uses the replayed timestamp; the virtual clock runs ahead by the queued telegrams
+      telegram = channel.Telegram(self.__counter, lines, ts=None if cfg.PRODUCTION else meter_ts)
+      while not self.__telegrams.put(telegram, timeout=1) and not self.__stopper.is_set():
         pass
 
-    # Insert the virtual entries in the dsmr telegram
-    e_consumed = "{0:10.3f}".format(e_consumed)
-    line = f"1-0:1.8.3({e_consumed}*kWh)"
-    self.__telegram.append(line)
+    logger.info(f"Serial: {self.__framer.statistics()}")
+    logger.info(f"Channel: {self.__telegrams.statistics()}")
+    logger.debug("<<")
 
-    e_returned = "{0:10.3f}".format(e_returned)
-    line = f"1-0:2.8.3({e_returned}*kWh)"
-    self.__telegram.append(line)
+  def run(self):
+    logger.debug(">>")
+    try:
+      # In production, ReadSerial has infinite loop
+      # In simulation, ReadSerial will return @ EOF
+      self.__read_serial()
 
-  def __read_serial(self):
+    except Exception as e:
+      logger.error(f"Exception: {e}")
+
+    finally:
+      self.__tty.close()
+      self.__stopper.set()
+
+    logger.debug("<<")
+
+
+class _SerialPort:
+  """
+    State per P1 port of TaskReadSerialPorts
+  """
+
+  def __init__(self, port, baudrate, prefix):
+    self.port = port
+    self.baudrate = baudrate
+    self.prefix = prefix
+    self.tty = None
+    self.framer = diagnostics.TimedFramer(f"serial:{port}")
+    self.counter = 0
+
+    # Reopen port after failure; backoff in seconds
+    self.retry_at = 0
+    self.backoff = 1
+
+  def open(self):
     """
-      Opens & Closes serial port
-      Reads dsmr telegrams; stores in global variable (self.__telegram)
-      Sets threading event to signal other clients (parser) that
-      new telegram is available.
-      In non-production mode, reads telegrams from file
+      Open port non-blocking (timeout = 0)
 
     Returns:
       None
     """
+    tty = serial_port(self.port, self.baudrate, timeout=0)
+    tty.open()
+    self.tty = tty
+    self.framer.reset()
+
+  def close(self):
+    try:
+      self.tty.close()
+    except Exception as e:
+      logger.debug(f"Exception {e}")
+    self.tty = None
+
+
+class TaskReadSerialPorts(threading.Thread):
+  """
+    Read multiple P1 ports in one thread; ports are multiplexed with selectors (epoll)
+    Every port has its own framer, counter and MQTT topic prefix
+  """
+
+  def __init__(self, telegrams, stopper, ports):
+    """
+
+    Args:
+      :param P1_channel.TelegramChannel() telegrams: hands over telegrams to parser
+      :param threading.Event() stopper: stops thread
+      :param list ports: list of (serial port, baudrate, MQTT topic prefix)
+    """
     logger.debug(">>")
+    super().__init__()
+    self.__telegrams = telegrams
+    self.__stopper = stopper
+    self.__selector = selectors.DefaultSelector()
+    self.__ports = [_SerialPort(port, baudrate, prefix) for port, baudrate, prefix in ports]
 
-    while not self.__stopper.is_set():
+    for p in self.__ports:
+      logger.info(f"Using USB device {p.port} with baud {p.baudrate}; MQTT topic prefix {p.prefix}")
 
-      # wait till parser has copied telegram content
-      # ...we need the opposite of trigger.wait()...block when set; not available
-      while self.__trigger.is_set():
-        time.sleep(0.1)
+  def __del__(self):
+    logger.debug(">>")
 
-      # add a counter as first field to the list
-      self.__counter += 1
-      self.__telegram.append(f"{self.__counter}")
-
-      # Decode from binary to ascii
-      # Remove CR LF
-      line = self.__tty.readline().decode('utf-8').rstrip()
-
-      # First element in telegram starts with "!"
-      nrof_elements = 0
-      while (not self.__stopper.is_set()) and (not line.startswith('!')):
-        self.__telegram.append(line)
-        line = self.__tty.readline().decode('utf-8').rstrip()
-        nrof_elements += 1
-#        logger.debug(f"TELEGRAM Element = {line}")
-
-        # Only in simulator mode; detect EOF in file
-        if (not cfg.PRODUCTION) and line.startswith('EOF'):
-          self.__stopper.set()
-          logger.debug(f"EOF Detected in {cfg.SIMULATORFILE}")
-          break
+  def __open(self, p):
+    """
+      (Re)open port and register at selector; on failure, retry with exponential backoff
 
-      # do some magic on telegram
-      self.__preprocess()
+    Args:
+      :param _SerialPort p:
 
-      # Trigger that new telegram is available for MQTT
-      self.__trigger.set()
+    Returns:
+      None
+    """
+    try:
+      p.open()
+      self.__selector.register(p.tty.fileno(), selectors.EVENT_READ, p)
+      p.backoff = 1
+      logger.debug(f"serial {p.port} opened")
+    except Exception as e:
+      logger.warning(f"Cannot open P1 serial port {p.port}; retry in {p.backoff}s; {type(e).__name__}: {str(e)}")
+      p.tty = None
+      p.retry_at = time.monotonic() + p.backoff
+      p.backoff = min(p.backoff * 2, 60)
 
-      # In simulation mode, insert a delay
-      if not cfg.PRODUCTION:
-        # 1sec delay mimics dsmr behaviour, which transmits every 1sec a telegram
-        time.sleep(1.0)
+  def __close(self, p):
+    self.__selector.unregister(p.tty.fileno())
+    p.close()
+    p.retry_at = time.monotonic() + p.backoff
+
+  def __read_port(self, p):
+    """
+      Read available bytes of port and hand over complete telegrams to parser
+
+    Args:
+      :param _SerialPort p:
+
+    Returns:
+      None
+    """
+    try:
+      data = p.tty.read(p.tty.in_waiting or 1)
+    except Exception as e:
+      logger.warning(f"P1 serial port {p.port} failed; {type(e).__name__}: {str(e)}")
+      self.__close(p)
+      return
+
+    for frame in p.framer.feed(data):
+      p.counter += 1
+      lines = framer.telegram_lines(frame)
+      self.__telegrams.put(channel.Telegram(p.counter, lines, p.prefix))
+
+  def __read_serial(self):
+    """
+      Wait for data on any of the ports; reopen failed ports
+
+    Returns:
+      None
+    """
+    logger.debug(">>")
+
+    for p in self.__ports:
+      self.__open(p)
+
+    while not self.__stopper.is_set():
+      for key, _mask in self.__selector.select(timeout=1):
+        self.__read_port(key.data)
+
+      now = time.monotonic()
+      for p in self.__ports:
+        if p.tty is None and now >= p.retry_at:
+          self.__open(p)
 
     logger.debug("<<")
 
   def run(self):
     logger.debug(">>")
     try:
-      # In production, ReadSerial has infinite loop
-      # In simulation, ReadSerial will return @ EOF
       self.__read_serial()
 
     except Exception as e:
       logger.error(f"Exception: {e}")
 
     finally:
-      self.__tty.close()
+      for p in self.__ports:
+        logger.info(f"Serial {p.port}: {p.framer.statistics()}")
+        if p.tty is not None:
+          p.close()
+      self.__selector.close()
+      logger.info(f"Channel: {self.__telegrams.statistics()}")
       self.__stopper.set()
 
     logger.debug("<<")
@@ -0,0 +1,457 @@
+"""
+  Sinks of parsed telegrams: MQTT, file, stdout, UDP, HTTP (and InfluxDB, P1_influx.py)
+
+  The parser hands the MQTT messages of a telegram to the fan-out, which encodes them
+  once per format (P1_encode.py) and puts the encoded record in the queue of every sink
+  of that format. Every sink has its own worker thread, bounded queue and rate:
+    - the parser never blocks; when a queue is full, the oldest record is dropped
+    - a slow or failing sink (eg HTTP server down) does not delay the other sinks
+    - exceptions of a sink are counted & logged; the sink continues with the next record
+    - rate: max records per hour [1..3600] (as MQTT_MAXRATE); None is every record
+
+  Text sinks (file, stdout, UDP) write a line per MQTT message:
+    json  "<prefix>/<topic> <json>", as mosquitto_sub -v
+    lp    line protocol, eg to telegraf socket_listener (UDP)
+  The HTTP sink posts every json message to <url>/<prefix>/<topic>, or all lines of
+  a telegram (lp) to <url>.
+
+        This program is free software: you can redistribute it and/or modify
+        it under the terms of the GNU General Public License as published by
+        the Free Software Foundation, either version 3 of the License, or
+        (at your option) any later version.
+
+        This program is distributed in the hope that it will be useful,
+        but WITHOUT ANY WARRANTY; without even the implied warranty of
+        MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+        GNU General Public License for more details.
+
+        You should have received a copy of the GNU General Public License
+        along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import threading
+import collections
+import urllib.request
+import socket
+import time
+import sys
+
+import P1_encode as encode
+import P1_schedule as schedule
+import P1_diagnostics as diagnostics
+
+# Logging
+import __main__
+import logging
+import os
+script = os.path.basename(__main__.__file__)
+script = os.path.splitext(script)[0]
+logger = logging.getLogger(script + "." + __name__)
+
+# Default max number of records waiting for a sink
+QUEUE_SIZE = 1000
+
+# Max seconds to write queued records at stop; remaining records are dropped
+STOP_TIMEOUT = 10
+
+# HTTP timeout [s]
+TIMEOUT = 5
+
+# Max size of UDP datagram
+DATAGRAM_SIZE = 65000
+
+# Statistics of a sink, in diagnostics message (P1_diagnostics.py)
+SINK_COUNTERS = ("records", "skipped", "dropped", "failures")
+
+# Encoded MQTT messages of a telegram
+#   prefix    MQTT topic prefix (meter)
+#   ts        epoch; timestamp of messages
+#   received  epoch; telegram complete
+#   parsed    epoch; telegram parsed
+#   payload   list of (topic, data); topic without prefix; shared by all sinks, do not modify
+Record = collections.namedtuple("Record", ["prefix", "ts", "received", "parsed", "payload"])
+
+
+# (prefix, topic):MQTT topic; resolved once per meter & topic
+_topics = {}
+
+
+def mqtt_topic(prefix, topic):
+  """
+  Returns:
+    :rtype: str: prefix/topic; resilient against double forward slashes
+  """
+  mqtt = _topics.get((prefix, topic))
+  if mqtt is None:
+    mqtt = _topics[(prefix, topic)] = (prefix + "/" + topic).replace('//', '/')
+  return mqtt
+
+
+class Sink(threading.Thread):
+  """
+    Worker thread with bounded queue & rate; subclasses implement send()
+  """
+
+  def __init__(self, name, format=encode.JSON, rate=None, queue_size=QUEUE_SIZE):
+    """
+    Args:
+      :param str name: used in logging
+      :param str format: encoded format of records; see P1_encode.py
+      :param int rate: max records per hour [1..3600]; None is every record
+      :param int queue_size: max number of queued records; oldest is dropped
+    """
+    super().__init__()
+    self.sink_name = name
+    self.format = format
+    self.__interval = None if rate is None else schedule.interval(rate)
+    self.__last = None
+    self.__queue_size = queue_size
+
+    self.__queue = collections.deque()
+    self.__trigger = threading.Event()
+    self.__stopper = threading.Event()
+
+    # Statistics
+    self.records = 0
+    self.skipped = 0
+    self.dropped = 0
+    self.failures = 0
+
+  def put(self, record):
+    """
+      Queue record; called by parser, never blocks
+
+    Args:
+      :param Record record:
+
+    Returns:
+      None
+    """
+    if self.__interval is not None:
+      if self.__last is not None and record.ts - self.__last < self.__interval:
+        self.skipped += 1
+        return
+      self.__last = record.ts
+
+    if len(self.__queue) >= self.__queue_size:
+      self.__queue.popleft()
+      self.dropped += 1
+
+    self.__queue.append(record)
+    self.__trigger.set()
+
+  def stop(self):
+    """
+      Write queued records (max STOP_TIMEOUT seconds) and stop
+
+    Returns:
+      None
+    """
+    self.__stopper.set()
+    self.__trigger.set()
+
+  def send(self, record):
+    """
+      Write record; an exception counts as failure
+
+    Args:
+      :param Record record:
+
+    Returns:
+      None
+    """
+    raise NotImplementedError
+
+  def idle(self):
+    """
+      Called at least every second, eg to flush batches
+
+    Returns:
+      None
+    """
+    pass
+
+  def close(self):
+    """
+      Called at stop, after the last record
+
+    Returns:
+      None
+    """
+    pass
+
+  def __failed(self, e):
+    self.failures += 1
+    # Do not flood the log when a sink is down
+    if self.failures == 1 or self.failures % 100 == 0:
+      logger.warning(f"Sink {self.sink_name}: failures = {self.failures}; {e}")
+
+  def run(self):
+    logger.debug(">>")
+    deadline = None
+    try:
+      while True:
+        if self.__stopper.is_set():
+          if deadline is None:
+            deadline = time.monotonic() + STOP_TIMEOUT
+          if not self.__queue or time.monotonic() >= deadline:
+            break
+
+        self.__trigger.wait(timeout=1)
+        self.__trigger.clear()
+
+        while self.__queue and (deadline is None or time.monotonic() < deadline):
+          record = self.__queue.popleft()
+          try:
+            self.send(record)
+            self.records += 1
+          except Exception as e:
+            self.__failed(e)
+
+        try:
+          self.idle()
+        except Exception as e:
+          self.__failed(e)
+
+    finally:
+      self.dropped += len(self.__queue)
+      self.__queue.clear()
+      try:
+        self.close()
+      except Exception as e:
+        logger.error(f"Sink {self.sink_name}: exception at close; {e}")
+
+    logger.info(f"Sink {self.sink_name}: records = {self.records}; skipped (rate) = {self.skipped}; "
+                f"dropped = {self.dropped}; failures = {self.failures}")
+    logger.debug("<<")
+
+
+class MqttSink(Sink):
+  """
+    Publish MQTT messages (json or binary, see P1_encode.py) to MQTT broker
+  """
+
+  def __init__(self, mqtt, published=None, rate=None, queue_size=QUEUE_SIZE, format=encode.JSON):
+    """
+    Args:
+      :param mqtt.mqttclient() mqtt: reference to mqtt worker
+      :param published: called with (mid, received, parsed) per published message, eg P1_latency.LatencyTracer.published
+      :param int rate: max records per hour; None is every record
+      :param int queue_size:
+      :param str format: JSON, MSGPACK, CBOR or PROTOBUF
+    """
+    assert format in encode.CONTENT_TYPES, f"Unknown MQTT format {format}"
+    super().__init__("mqtt", format, rate, queue_size)
+    self.__mqtt = mqtt
+    self.__published = published
+
+  def send(self, record):
+    started = time.perf_counter()
+    for topic, message in record.payload:
+      mid = self.__mqtt.do_publish(mqtt_topic(record.prefix, topic), message, retain=False)
+      if self.__published is not None:
+        self.__published(mid, record.received, record.parsed)
+    diagnostics.pipeline.add(diagnostics.PUBLISH, time.perf_counter() - started)
+
+
+def lines(record, format):
+  """
+  Returns:
+    :rtype: list: text lines of record, without newline
+  """
+  if format == encode.JSON:
+    return [f"{mqtt_topic(record.prefix, topic)} {data}" for topic, data in record.payload]
+  return [data for _topic, data in record.payload]
+
+
+class FileSink(Sink):
+  """
+    Append lines to a file; reopened after a write error or when the file is rotated (logrotate)
+  """
+
+  def __init__(self, path, format=encode.JSON, rate=None, queue_size=QUEUE_SIZE):
+    super().__init__(f"file:{path}", format, rate, queue_size)
+    self.__path = path
+    self.__file = None
+    self.__inode = None
+
+  def send(self, record):
+    if self.__file is not None:
+      try:
+        inode = os.stat(self.__path).st_ino
+      except OSError:
+        inode = None
+      if inode != self.__inode:
+        self.close()
+
+    if self.__file is None:
+      self.__file = open(self.__path, 'a')
+      self.__inode = os.fstat(self.__file.fileno()).st_ino
+
+    try:
+      self.__file.write("".join(line + "\n" for line in lines(record, self.format)))
+      self.__file.flush()
+    except OSError:
+      self.close()
+      raise
+
+  def close(self):
+    if self.__file is not None:
+      try:
+        self.__file.close()
+      finally:
+        self.__file = None
+
+
+class StdoutSink(Sink):
+  """
+    Print lines, eg to pipe into another program
+  """
+
+  def __init__(self, format=encode.JSON, rate=None, queue_size=QUEUE_SIZE):
+    super().__init__("stdout", format, rate, queue_size)
+
+  def send(self, record):
+    sys.stdout.write("".join(line + "\n" for line in lines(record, self.format)))
+    sys.stdout.flush()
+
+
+class UdpSink(Sink):
+  """
+    Send lines as UDP datagrams; lines of a record are combined up to DATAGRAM_SIZE
+  """
+
+  def __init__(self, address, format=encode.JSON, rate=None, queue_size=QUEUE_SIZE):
+    """
+    Args:
+      :param str address: "host:port"
+    """
+    super().__init__(f"udp:{address}", format, rate, queue_size)
+    host, _, port = address.rpartition(":")
+    self.__address = (host, int(port))
+    self.__socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+  def send(self, record):
+    datagram = b""
+    for line in lines(record, self.format):
+      data = line.encode() + b"\n"
+      if datagram and len(datagram) + len(data) > DATAGRAM_SIZE:
+        self.__socket.sendto(datagram, self.__address)
+        datagram = b""
+      datagram += data
+
+    if datagram:
+      self.__socket.sendto(datagram, self.__address)
+
+  def close(self):
+    self.__socket.close()
+
+
+class HttpSink(Sink):
+  """
+    POST json messages to <url>/<prefix>/<topic>, or line protocol of a record to <url>
+  """
+
+  def __init__(self, url, format=encode.JSON, rate=None, queue_size=QUEUE_SIZE):
+    super().__init__(f"http:{url}", format, rate, queue_size)
+    self.__url = url.rstrip("/")
+
+  def __post(self, url, body, content_type):
+    request = urllib.request.Request(url, data=body.encode(), headers={"Content-Type": content_type}, method="POST")
+    with urllib.request.urlopen(request, timeout=TIMEOUT) as response:
+      response.read()
+
+  def send(self, record):
+    if self.format == encode.JSON:
+      for topic, message in record.payload:
+        self.__post(f"{self.__url}/{mqtt_topic(record.prefix, topic)}", message, "application/json")
+    else:
+      self.__post(self.__url, "\n".join(lines(record, self.format)) + "\n", "text/plain; charset=utf-8")
+
+
+# Sink types in SINKS (config.py)
+SINK_TYPES = {
+  "file": FileSink,
+  "udp": UdpSink,
+  "http": HttpSink,
+}
+
+
+def create(kind, target="", format=encode.JSON, rate=None):
+  """
+  Args:
+    :param str kind: "file", "stdout", "udp", "http"
+    :param str target: file name, "host:port" or url; ignored for stdout
+    :param str format: JSON or LP
+    :param int rate: max records per hour; None is every record
+
+  Returns:
+    :rtype: Sink
+  """
+  assert format in (encode.JSON, encode.LP), f"Unknown sink format {format}"
+  if kind == "stdout":
+    return StdoutSink(format, rate)
+  assert kind in SINK_TYPES, f"Unknown sink type {kind}"
+  return SINK_TYPES[kind](target, format, rate)
+
+
+class FanOut:
+  """
+    Encode MQTT messages once per format & queue them at all sinks
+  """
+
+  def __init__(self, plan, sinks):
+    """
+    Args:
+      :param P1_plan.ParsePlan plan: compiled dsmr definition; provides datatypes
+      :param list sinks: [Sink]
+    """
+    self.sinks = list(sinks)
+
+    # format:(encoder, [Sink])
+    self.__formats = {}
+    for sink in self.sinks:
+      if sink.format not in self.__formats:
+        self.__formats[sink.format] = (encode.encoder(sink.format, plan), [])
+      self.__formats[sink.format][1].append(sink)
+      diagnostics.pipeline.register(f"sink:{sink.sink_name}", sink, SINK_COUNTERS)
+
+  def start(self):
+    for sink in self.sinks:
+      sink.start()
+
+  def stop(self):
+    """
+      Stop all sinks; returns when queued records are written (max STOP_TIMEOUT seconds)
+
+    Returns:
+      None
+    """
+    for sink in self.sinks:
+      sink.stop()
+    for sink in self.sinks:
+      sink.join()
+
+  def publish(self, prefix, messages, ts, received, parsed):
+    """
+    Args:
+      :param str prefix: MQTT topic prefix (meter)
+      :param dict messages: topic:{tag:value}; not modified after this call
+      :param int ts: epoch; timestamp of messages
+      :param float received: epoch; telegram complete
+      :param float parsed: epoch; telegram parsed
+
+    Returns:
+      None
+    """
+    started = time.perf_counter()
+    records = []
+    for encoder, sinks in self.__formats.values():
+      payload = encoder.encode(prefix, messages)
+      if payload:
+        records.append((Record(prefix, ts, received, parsed, payload), sinks))
+    diagnostics.pipeline.add(diagnostics.ENCODE, time.perf_counter() - started)
+
+    for record, sinks in records:
+      for sink in sinks:
+        sink.put(record)
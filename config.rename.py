@@ -27,6 +27,14 @@ PRODUCTION = True
 # Add string "EOF" (without quotes) as last line
 SIMULATORFILE = "test/dsmr.raw"
 
+# Replay speed of SIMULATORFILE, paced by the meter timestamps in the telegrams
+# 1: real time, N: N times faster, 0: as fast as possible
+# Rate limiting and HA discovery follow the (virtual) meter time
+SIMULATOR_SPEED = 1
+
+# Number of times SIMULATORFILE is replayed
+SIMULATOR_REPEAT = 1
+
 # [ MQTT Parameters ]
 # Using local dns names is not always reliable with PAHO
 MQTT_BROKER = "192.168.1.1"
@@ -43,6 +51,39 @@ MQTT_PASSWORD = "***********"
 # MQTT_MAXRATE = 720
 MQTT_MAXRATE = 60
 
+# MAX number of MQTT messages per hour, per MQTT topic (see dsmr50.py); MQTT_MAXRATE is used for other topics
+# Fields can have their own rate, see schedule in dsmr50.py
+# MQTT_TOPIC_RATE = {"el": 3600, "gas": 12, "system": 1}
+MQTT_TOPIC_RATE = {}
+
+# Aggregate all telegrams between MQTT messages, instead of skipping them
+# Statistics (eg p_consumed_avg, p_consumed_max) are added to every MQTT message;
+# the aggregated entries & statistics are defined in dsmr50.py (aggregate)
+MQTT_AGGREGATE = False
+
+# Publish only fields that changed (beyond deadband, see dsmr50.py) since last MQTT message
+# All fields are published every MQTT_KEYFRAME_INTERVAL seconds and after a reconnect to the broker
+MQTT_DELTA = False
+MQTT_KEYFRAME_INTERVAL = 300
+
+# The gas meter sends a new sample every 5 minutes; only publish gas when the sample is new
+# (based on capture time of 0-1:24.2.1)
+MQTT_GAS_NEW_SAMPLES_ONLY = False
+
+# Format of MQTT messages: "json", or a compact binary format: "msgpack", "cbor", "protobuf"
+# Format (and protobuf schema) is published (retained) on MQTT_TOPIC_PREFIX/metadata; not for json,
+# unless batched (MQTT_BATCH_SIZE, MQTT_BATCH_SECONDS)
+# Home Assistant discovery (HA_DISCOVERY) requires "json"
+MQTT_FORMAT = "json"
+
+# Publish the MQTT messages of MQTT_BATCH_SIZE telegrams, or of MQTT_BATCH_SECONDS, as one message per topic
+# in a columnar layout: {"p_consumed":[866.0,900.0],...,"timestamp":[1638734941,1638734942]}
+# 0 is no limit; both 0 is a message per telegram. Use MQTT_MAXRATE = 3600 to batch every telegram
+# Only MQTT messages are batched (not SINKS, INFLUX); MQTT_FORMAT "json", "msgpack" or "cbor";
+# not with Home Assistant discovery
+MQTT_BATCH_SIZE = 0
+MQTT_BATCH_SECONDS = 0
+
 if PRODUCTION:
   MQTT_TOPIC_PREFIX = "dsmr"
   MQTT_CLIENT_UNIQ = MQTT_CLIENT_UNIQ_ID
@@ -52,6 +93,84 @@ else:
   MQTT_CLIENT_UNIQ = 'mqtt-dsmr-test'
   HA_ID = "TEST"
 
+# [ Telegram queue ]
+# Number of telegrams that can be queued between serial reader and parser
+# Serial reader never waits for the parser; when queue is full a telegram is dropped:
+# "drop_oldest": drop oldest queued telegram (default)
+# "drop_newest": drop newly received telegram
+TELEGRAM_QUEUE_SIZE = 8
+TELEGRAM_QUEUE_OVERFLOW = "drop_oldest"
+
+# [ Raw telegram capture ]
+# Record all raw telegrams in compressed segment files, with an index per segment
+# Single P1 port (ser_port) only: not supported with SERIAL_PORTS, and NETWORK_P1 meters are not captured
+# Extract a time range, eg to replay as SIMULATORFILE:
+# python3 P1_capture.py capture "2024-02-04 17:00:00" "2024-02-04 17:05:00" > dsmr.raw
+# Telegrams rejected by the framer (CRC error, truncated) are captured too, flagged in the index;
+# extract them with --rejected (not with SERIAL_PROCESS = True: the framer runs in the reader process)
+CAPTURE = False
+CAPTURE_DIR = "capture"
+
+# Start a new segment file every CAPTURE_SEGMENT_SECONDS
+CAPTURE_SEGMENT_SECONDS = 3600
+
+# Max disk usage; oldest segments are deleted
+CAPTURE_MAX_BYTES = 500 * 1024 * 1024
+
+# [ Diagnostics ]
+# Log latency histograms (meter -> telegram received -> parsed -> MQTT acknowledged) every LATENCY_LOG_INTERVAL seconds
+LATENCY_LOG_INTERVAL = 3600
+
+# Publish pipeline metrics (stage durations, counters, MQTT queue depth) on MQTT_TOPIC_PREFIX/diagnostics
+# every DIAGNOSTICS_INTERVAL seconds; 0 is not published
+DIAGNOSTICS_INTERVAL = 60
+
+# [ History ]
+# Keep recent readings (fields in dsmr50.py history) in memory & serve them over HTTP (json)
+# eg http://127.0.0.1:8081/stats?field=el/p_consumed&seconds=900
+# Memory: 8 bytes per field per sample; 24h at 1s resolution with 13 fields is ~9MB
+HISTORY = False
+HISTORY_SECONDS = 86400
+HISTORY_RESOLUTION = 1
+
+# Listen address of the query server; "0.0.0.0" to allow queries from other hosts
+HISTORY_ADDRESS = "127.0.0.1"
+HISTORY_PORT = 8081
+
+# [ Prometheus ]
+# Serve latest values of all meters & health on http://<PROMETHEUS_ADDRESS>:<PROMETHEUS_PORT>/metrics
+PROMETHEUS = False
+PROMETHEUS_ADDRESS = "0.0.0.0"
+PROMETHEUS_PORT = 9340
+
+# [ Sinks ]
+# Besides the MQTT broker, MQTT messages can be written to other sinks; every sink has its own
+# queue & thread, so a slow or unavailable sink does not delay MQTT or the other sinks
+# List of (type, target, format, rate)
+#   type:   "file" (target: file name), "udp" (target: "host:port"), "http" (target: url), "stdout" (target: "")
+#   format: "json" (line "<topic> <json>"; http: POST json to <url>/<topic>) or "lp" (InfluxDB line protocol)
+#   rate:   max telegrams per hour [1..3600]; None is every published telegram
+# SINKS = [("file", "/var/log/dsmr.log", "json", None), ("udp", "192.168.1.10:8094", "lp", 360)]
+SINKS = []
+
+# [ InfluxDB ]
+# Write published MQTT messages directly to InfluxDB (a sink), without telegraf (telegraf-dsmr.conf)
+# Points as written by telegraf: measurement "dsmr", tag "serial", timestamp in seconds (precision=s)
+# InfluxDB v1: "http://influxdb:8086/write?db=dsmr&precision=s" (user/password: add &u=<user>&p=<password>)
+# InfluxDB v2: "http://influxdb2:8086/api/v2/write?org=Home&bucket=dsmr&precision=s" and INFLUX_TOKEN
+INFLUX = False
+INFLUX_URL = "http://influxdb:8086/write?db=dsmr&precision=s"
+INFLUX_TOKEN = ""
+INFLUX_TOPICS = ["el", "gas"]
+
+# A batch is written when it has INFLUX_BATCH_SIZE points or after INFLUX_FLUSH_INTERVAL seconds
+INFLUX_BATCH_SIZE = 5000
+INFLUX_FLUSH_INTERVAL = 10
+
+# Batches which cannot be written are stored in INFLUX_SPILL_DIR and retried; oldest are deleted above max
+INFLUX_SPILL_DIR = "influx-spill"
+INFLUX_SPILL_MAX_BYTES = 100 * 1024 * 1024
+
 # [ Home Assistant ]
 HA_DISCOVERY = True
 
@@ -65,6 +184,31 @@ HA_DELETECONFIG = True
 HA_DISCOVERY_RATE = 12
 
 # [ P1 USB serial ]
+# Set ser_port = None if only network P1 (NETWORK_P1) is used
 # ser_port = "/dev/ttyUSB0"
 ser_port = "/dev/tty-dsmr"
 ser_baudrate = 115200
+
+# Read & check telegrams of ser_port in a separate process (uses a second core)
+# Serial timing is not affected by MQTT, parsing and logging in the main process
+SERIAL_PROCESS = False
+
+# [ Multiple P1 USB serial ports ]
+# Read several meters (eg main meter and sub meters) from one process & thread
+# Every meter is published under its own MQTT topic prefix
+# and is discovered by Home Assistant as its own device
+# List of (serial port, baudrate, MQTT topic prefix); when empty, ser_port is used
+# SERIAL_PORTS = [("/dev/ttyUSB0", 115200, "dsmr/main"), ("/dev/ttyUSB1", 115200, "dsmr/sub1")]
+SERIAL_PORTS = []
+
+# [ Network P1 ]
+# P1 Wi-Fi/Ethernet dongles or ser2net, which expose the raw telegram stream over TCP
+# All endpoints are read from one thread; each meter is published under
+# MQTT_TOPIC_PREFIX/<serial>, eg dsmr/33363137/el
+# and discovered by Home Assistant as its own device once its serial is known
+# List of (host, port)
+# NETWORK_P1 = [("192.168.1.50", 2001), ("192.168.1.51", 2001)]
+NETWORK_P1 = []
+
+# Reconnect when no data is received for NETWORK_TIMEOUT seconds
+NETWORK_TIMEOUT = 30
@@ -6,7 +6,7 @@
    Tested on raspberry pi4
 
 4 Worker threads:
-  - P1 USB serial port reader
+  - P1 USB serial port reader (and/or network P1 reader)
   - DSMR telegram parser to MQTT messages
   - MQTT client
   - HA Discovery
@@ -43,6 +43,15 @@ import threading
 import config as cfg
 import P1_serial as p1
 import P1_parser as convert
+import P1_channel as channel
+import P1_replay as replay
+import P1_network as network
+import P1_capture as capture
+import P1_process as process
+import P1_history as history
+import P1_influx as influx
+import P1_sinks as sinks
+import P1_prometheus as prometheus
 import hadiscovery as ha
 import mqtt as mqtt
 
@@ -60,9 +69,10 @@ import os
 script=os.path.basename(__file__)
 script=os.path.splitext(script)[0]
 
-# Ensure that only one instance is started
+# Ensure that only one instance per MQTT client id is started
+# Several P1 ports can be read by one instance (SERIAL_PORTS)
 if sys.platform == "linux":
-  lockfile = "\0" + script + "_lockfile"
+  lockfile = "\0" + script + "_" + cfg.MQTT_CLIENT_UNIQ + "_lockfile"
   try:
     s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
     # Create an abstract socket, by prefixing it with null.
@@ -88,7 +98,6 @@ def close():
 # ------------------------------------------------------------------------------------
 # LATE GLOBALS
 # ------------------------------------------------------------------------------------
-trigger = threading.Event()
 t_threads_stopper = threading.Event()
 t_mqtt_stopper = threading.Event()
 
@@ -104,15 +113,81 @@ t_mqtt = mqtt.MQTTClient(mqtt_broker=cfg.MQTT_BROKER,
                          mqtt_stopper=t_mqtt_stopper,
                          worker_threads_stopper=t_threads_stopper)
 
-# SerialPort thread
-telegram = list()
-t_serial = p1.TaskReadSerial(trigger, t_threads_stopper, telegram)
+# In simulation, time follows the meter timestamps of the replayed telegrams
+# and the parser does not drop telegrams
+if cfg.PRODUCTION:
+  clock = time
+  telegrams = channel.TelegramChannel(cfg.TELEGRAM_QUEUE_SIZE, cfg.TELEGRAM_QUEUE_OVERFLOW)
+else:
+  clock = replay.VirtualClock()
+  telegrams = channel.TelegramChannel(cfg.TELEGRAM_QUEUE_SIZE, channel.BLOCK)
+
+# Send Home Assistant auto discovery MQTT's; one HA device per meter
+# Network P1 meters are announced when their serial is known
+if not cfg.PRODUCTION:
+  ha_prefixes = [cfg.MQTT_TOPIC_PREFIX]
+elif cfg.SERIAL_PORTS:
+  ha_prefixes = [prefix for _port, _baudrate, prefix in cfg.SERIAL_PORTS]
+elif cfg.ser_port:
+  ha_prefixes = [cfg.MQTT_TOPIC_PREFIX]
+else:
+  ha_prefixes = []
+t_discovery = ha.Discovery(t_threads_stopper, t_mqtt, __version__, clock, ha_prefixes)
+
+# Raw telegram capture thread; single P1 port (ser_port) only
+t_capture = None
+if cfg.CAPTURE:
+  if cfg.PRODUCTION and (cfg.SERIAL_PORTS or not cfg.ser_port):
+    logger.error("CAPTURE is supported for a single P1 port (ser_port) only; capture disabled")
+  else:
+    if cfg.PRODUCTION and cfg.NETWORK_P1:
+      logger.warning("CAPTURE records ser_port only; NETWORK_P1 meters are not captured")
+    t_capture = capture.CaptureRecorder(t_threads_stopper, cfg.CAPTURE_DIR,
+                                        cfg.CAPTURE_SEGMENT_SECONDS, cfg.CAPTURE_MAX_BYTES)
+
+# Telegram reader threads
+t_readers = []
+
+# SerialPort thread; one thread for one or multiple P1 ports
+if not cfg.PRODUCTION:
+  t_readers.append(p1.TaskReadSerial(telegrams, t_threads_stopper, clock, t_capture))
+elif cfg.SERIAL_PORTS:
+  t_readers.append(p1.TaskReadSerialPorts(telegrams, t_threads_stopper, cfg.SERIAL_PORTS))
+elif cfg.ser_port and cfg.SERIAL_PROCESS:
+  t_readers.append(process.TaskReadProcess(telegrams, t_threads_stopper, t_capture))
+elif cfg.ser_port:
+  t_readers.append(p1.TaskReadSerial(telegrams, t_threads_stopper, clock, t_capture))
+
+# Network P1 thread; one thread for all network P1 dongles
+if cfg.PRODUCTION and cfg.NETWORK_P1:
+  t_readers.append(network.TaskReadNetwork(telegrams, t_threads_stopper, cfg.NETWORK_P1, t_discovery.add_prefix))
+
+# Sinks next to MQTT; started & stopped by the parser
+extra_sinks = [sinks.create(*sink) for sink in cfg.SINKS]
+
+if cfg.INFLUX:
+  extra_sinks.append(influx.InfluxWriter(cfg.INFLUX_URL, cfg.INFLUX_TOKEN,
+                                         topics=cfg.INFLUX_TOPICS,
+                                         batch_size=cfg.INFLUX_BATCH_SIZE,
+                                         flush_interval=cfg.INFLUX_FLUSH_INTERVAL,
+                                         spill_dir=cfg.INFLUX_SPILL_DIR,
+                                         spill_max_bytes=cfg.INFLUX_SPILL_MAX_BYTES))
 
 # Telegram parser thread
-t_parse = convert.ParseTelegrams(trigger, t_threads_stopper, t_mqtt, telegram)
+t_parse = convert.ParseTelegrams(telegrams, t_threads_stopper, t_mqtt, clock, extra_sinks)
 
-# Send Home Assistant auto discovery MQTT's
-t_discovery = ha.Discovery(t_threads_stopper, t_mqtt, __version__)
+# History query server
+if t_parse.history is not None:
+  t_history = history.HistoryServer(t_threads_stopper, t_parse.history, cfg.HISTORY_ADDRESS, cfg.HISTORY_PORT,
+                                    cfg.MQTT_TOPIC_PREFIX)
+else:
+  t_history = None
+
+# Prometheus scrape server
+if t_parse.metrics is not None:
+  t_metrics = prometheus.MetricsServer(t_threads_stopper, t_parse.metrics, cfg.PROMETHEUS_ADDRESS, cfg.PROMETHEUS_PORT)
+else:
+  t_metrics = None
 
 
 def exit_gracefully(signal, stackframe):
@@ -149,18 +224,36 @@ def main():
   time.sleep(1)
   t_parse.start()
   t_discovery.start()
-  t_serial.start()
+
+  if t_history is not None:
+    t_history.start()
+
+  if t_metrics is not None:
+    t_metrics.start()
+
+  if t_capture is not None:
+    t_capture.start()
+  for t_reader in t_readers:
+    t_reader.start()
 
   # Set status to online
   t_mqtt.set_status(cfg.MQTT_TOPIC_PREFIX + "/status", "online", retain=True)
   logger.debug(f'Meter status set to online')
   t_mqtt.do_publish(cfg.MQTT_TOPIC_PREFIX + "/sw-version", f"main={__version__}; mqtt={mqtt.__version__}", retain=True)
 
-  # block till t_serial stops receiving telegrams/exits
-  t_serial.join()
-  logger.debug("t_serial.join exited; set stopper for other threats")
+  # block till readers stop receiving telegrams/exit
+  for t_reader in t_readers:
+    t_reader.join()
+  logger.debug("t_readers.join exited; set stopper for other threats")
   t_threads_stopper.set()
 
+  # Write remaining captured telegrams
+  if t_capture is not None:
+    t_capture.join()
+
+  # Parser publishes remaining telegrams & stops the sinks
+  t_parse.join()
+
   # Set status to offline
   t_mqtt.set_status(cfg.MQTT_TOPIC_PREFIX + "/status", "offline", retain=True)
   logger.debug(f'Meter status set to offline')
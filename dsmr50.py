@@ -50,6 +50,8 @@ MQTT_TAG = 2
 
 # Python regex to filter extract data from dsmr telegram
 # Test with: https://regex101.com/
+# Lines with several values in parenthesised groups: select groups by position, eg "groups:0;2;3"
+# (0 is the first group, -1 the last) with semicolon separated tags, datatypes & multiplication factors
 REGEX = 3
 
 # Unit of the measurement according to what HA expects
@@ -57,7 +59,8 @@ REGEX = 3
 UNIT = 4
 
 # data type of data
-# Allowed values: <int, float, str>
+# Allowed values: <int, float, str, timestamp>
+# timestamp: dsmr timestamp (YYMMDDhhmmssX) converted to epoch
 # Keep in mind that only measurements should have value datatype int or float
 # Other info should be parsed as str
 DATATYPE = 5
@@ -116,6 +119,13 @@ definition = {
   ["Number long power failures", "el", "long_power_failures", "^.*\((.*)\)",
    "", "int", "1", "1", "mdi:transmission-tower-off"],
 
+# Power failure event log: number of events, end & duration [s] of most recent power failure
+# Not published by default: adds fields to the el topic (and InfluxDB); uncomment to use
+#"1-0:99.97.0":
+#  ["Power failure events;Last power failure;Last power failure duration", "el",
+#   "power_failure_events;power_failure_ts;power_failure_duration", "groups:0;2;3",
+#   "", "int;timestamp;int", "1", "0", "mdi:transmission-tower-off"],
+
 "0-0:96.14.0":
   ["Tariff indicator electricity", "el", "tariff_indicator", "^.*\((.*)\)",
   "", "int", "1", "1", "mdi:weather-night"],
@@ -179,6 +189,7 @@ definition = {
    "Wh", "float", "1000", "1", "mdi:counter"],
 
 # Virtual, not existing in dsmr telegram & specification, to sum tarif 1 & 2 to a single message
+# Calculated after parsing; see derived below
 "1-0:1.8.3":
   ["EL consumed", "el", "el_consumed", "^.*\((.*)\*kWh\)",
    "Wh", "float", "1000", "1", "mdi:counter"],
@@ -253,26 +264,111 @@ definition = {
 #  ["Text message", "el", "text", "^.*\((.*)\)",
 #  "", "str", "1", "1", "mdi:text"],
 
+# Belgian meters
+#"1-0:1.6.0":
+#  ["Monthly peak timestamp;Monthly peak", "el", "m_peak_ts;m_peak", "groups:0;1",
+#  "", "timestamp;float", "1;1000", "0", "mdi:chart-bar"],
+
+# Historical (monthly) peaks: number of months, timestamp & value of peak of last month in list
+#"0-0:98.1.0":
+#  ["Historical peaks;Historical peak timestamp;Historical peak", "el", "h_peaks;h_peak_ts;h_peak", "groups:0;-2;-1",
+#  "", "int;timestamp;float", "1;1;1000", "0", "mdi:chart-bar"],
+
 #"1-0:1.4.0":
 #  ["Current average demand", "el", "avg_dem", "^.*\((.*)\*kW\)",
 #  "W", "float", "1000", "1", "mdi:gauge"]
 
 }
 
-# Not supported:
-#"0-1:24.1.0": ["Device-Type", "device_type", "^.*\((.*)\)", "int, ""1"],
+# Derived (virtual) entries, not existing in dsmr telegram & specification
+# Calculated after parsing, from the parsed values (after cast & multiplication) of other OBIS entries
+# Topic, tag, datatype, unit, HA settings of a derived entry are taken from definition above
+# Only OBIS entries present in the telegram (and in definition) are used
+#
+# "OBIS Reference" : [OPERATION, [OBIS references]]
+# OPERATION: "sum" (sum of all), "diff" (first minus the others)
+derived = {
+"1-0:1.8.3": ["sum", ["1-0:1.8.1", "1-0:1.8.2"]],
+"1-0:2.8.3": ["sum", ["1-0:2.8.1", "1-0:2.8.2"]],
+
+# Net power (consumed - generated)
+#"1-0:16.7.0": ["diff", ["1-0:1.7.0", "1-0:2.7.0"]],
+}
 
-#"1-0:99.97.0": ["Power Failure Event Log (long power failures)", "power_failure_event_log", "^.*\((.*)\)", "string"],
-#"0-0:96.13.0": ["Text message max 1024 characters.", "text_message", "^.*\((.*)\)"],
+# Aggregated entries; only used when MQTT_AGGREGATE = True (config.py)
+# Every telegram (also the ones not published because of MQTT_MAXRATE) is added to a window;
+# at every MQTT message the statistics of the window are added as <tag>_<statistic>, eg p_consumed_max
+# Only numeric (int, float) entries of definition above, including derived entries
+#
+# "OBIS Reference" : [STATISTICS]
+# STATISTICS: "min", "max", "avg"
+aggregate = {
+"1-0:1.7.0": ["avg", "max"],
+"1-0:2.7.0": ["avg", "max"],
+"1-0:21.7.0": ["avg", "max"],
+"1-0:41.7.0": ["avg", "max"],
+"1-0:61.7.0": ["avg", "max"],
+"1-0:22.7.0": ["avg", "max"],
+"1-0:42.7.0": ["avg", "max"],
+"1-0:62.7.0": ["avg", "max"],
+"1-0:32.7.0": ["min", "max"],
+"1-0:52.7.0": ["min", "max"],
+"1-0:72.7.0": ["min", "max"],
+}
 
-#"1-0:1.6.0":
-#  ["Monthly peak timestamp;Monthly peak DST;Monthly peak value", "el", "m_peak_ts;m_peak_dst;m_peak_val", "^.*\((\d{12})(S|W)\)\((.*)\*kW\)",
-#  "", "int;str;float", "0", "1", "1", "mdi:chart-bar"],
+# Deadbands for change-only publishing; only used when MQTT_DELTA = True (config.py)
+# A field is published when it differs more than its deadband from the last published value
+# Fields without deadband are published when they change; all fields are published in a keyframe
+# Deadband is in the unit of the MQTT message (after multiplication), eg W
+#
+# "OBIS Reference" : DEADBAND
+deadband = {
+"1-0:1.7.0": 10,
+"1-0:2.7.0": 10,
+"1-0:21.7.0": 10,
+"1-0:41.7.0": 10,
+"1-0:61.7.0": 10,
+"1-0:22.7.0": 10,
+"1-0:42.7.0": 10,
+"1-0:62.7.0": 10,
+"1-0:32.7.0": 1.0,
+"1-0:52.7.0": 1.0,
+"1-0:72.7.0": 1.0,
+}
 
-#"0-0:98.1.0":
-#  ["Historical peaks", "el", "h_peak", "^.*\((\d{12})(S|W)\)\((\d{12})(S|W)\)\((.*)\*kW\)\((\d{12})(S|W)\)\((\d{12})(S|W)\)\((.*)\*kW\)\((\d{12})(S|W)\)\((\d{12})(S|W)\)\((.*)\*kW\)\((\d{12})(S|W)\)\((\d{12})(S|W)\)\((.*)\*kW\)\((\d{12})(S|W)\)\((\d{12})(S|W)\)\((.*)\*kW\)\((\d{12})(S|W)\)\((\d{12})(S|W)\)\((.*)\*kW\)\((\d{12})(S|W)\)\((\d{12})(S|W)\)\((.*)\*kW\)\((\d{12})(S|W)\)\((\d{12})(S|W)\)\((.*)\*kW\)\((\d{12})(S|W)\)\((\d{12})(S|W)\)\((.*)\*kW\)",
-#  "", "int", "1", "1", "mdi:chart-bar"],
+# Publish schedules per field; MAX number of MQTT messages per hour [1..3600], as MQTT_MAXRATE (config.py)
+# Fields without schedule are published at the rate of their topic (MQTT_TOPIC_RATE or MQTT_MAXRATE)
+#
+# "OBIS Reference" : RATE
+schedule = {
+# Counters once per minute, while power is published at the rate of topic el
+#"1-0:1.8.1": 60,
+#"1-0:1.8.2": 60,
+}
+
+# Fields kept in the in-memory history; only used when HISTORY = True (config.py)
+# Every telegram is stored (at most one per HISTORY_RESOLUTION); 8 bytes per field per sample
+# Only numeric (int, float) entries of definition above, including derived entries
+#
+# "OBIS Reference"
+history = [
+"1-0:1.7.0",
+"1-0:2.7.0",
+"1-0:21.7.0",
+"1-0:41.7.0",
+"1-0:61.7.0",
+"1-0:22.7.0",
+"1-0:42.7.0",
+"1-0:62.7.0",
+"1-0:32.7.0",
+"1-0:52.7.0",
+"1-0:72.7.0",
+"1-0:1.8.3",
+"1-0:2.8.3",
+]
 
+# Not supported:
+#"0-1:24.1.0": ["Device-Type", "device_type", "^.*\((.*)\)", "int, ""1"],
 
 # NOT USED; An EPOCH timestamp is added every MQTT message
 # ["Timestamp [s]", "el", "timestamp", "^.*\((\d{12})(S|W)\)", "",
@@ -24,6 +24,7 @@ import re
 # Local imports
 import config as cfg
 import dsmr50 as dsmr
+import P1_plan as plan
 
 # Logging
 import __main__
@@ -37,7 +38,7 @@ logger = logging.getLogger(script + "." + __name__)
 
 class Discovery(threading.Thread):
 
-  def __init__(self, stopper, mqtt, version):
+  def __init__(self, stopper, mqtt, version, clock=time, prefixes=None):
     """
     class init
 
@@ -45,6 +46,9 @@ class Discovery(threading.Thread):
     :param threading.Event()    stopper:
     :param mqtt.mqttclient()    mqtt: reference to mqtt client
     :param str                  version: version of the program
+    :param                      clock: provides time(); time module or P1_replay.VirtualClock() in simulation
+    :param list                 prefixes: MQTT topic prefix of every meter; one HA device per meter
+                                          default [MQTT_TOPIC_PREFIX]; more can be added with add_prefix()
     """
 
     logger.debug(f'LOGGER: init class Discovery >>')
@@ -52,36 +56,78 @@ class Discovery(threading.Thread):
     self.__stopper = stopper
     self.__mqtt = mqtt
     self.__version = version
+    self.__clock = clock
     self.__interval = 3600 / cfg.HA_DISCOVERY_RATE
     self.__lastmqtt = 0
+    self.__prefixes = list(prefixes) if prefixes is not None else [cfg.MQTT_TOPIC_PREFIX]
+
+    # Meters found at runtime (NETWORK_P1), not yet announced
+    self.__lock = threading.Lock()
+    self.__newprefixes = list()
+
+    # list of (config topic, config dict)
     self.__listofjsondicts = list()
 
   def __del__(self):
     logger.debug(">>")
 
-  def __create_discovery_JSON(self):
+  def add_prefix(self, prefix):
     """
-      Create the HA/MQTT Autodiscovery messages
+      Announce a meter that is found at runtime; eg a NETWORK_P1 meter once its serial is known
+      Called from the reader thread
+
+    Keyword arguments:
+    :param str prefix: MQTT topic prefix of the meter
 
     Returns:
       None
     """
+    with self.__lock:
+      if prefix not in self.__prefixes:
+        self.__prefixes.append(prefix)
+        self.__newprefixes.append(prefix)
+
+  def __create_discovery_JSON(self, prefix):
+    """
+      Create the HA/MQTT Autodiscovery messages for the meter published under prefix
+
+    The meter under MQTT_TOPIC_PREFIX keeps the original ids; for other meters
+    (eg SERIAL_PORTS) the prefix is appended to unique_id and device identifier
+
+    Keyword arguments:
+    :param str prefix: MQTT topic prefix of the meter
+
+    Returns:
+      list of (config topic, config dict)
+    """
+    configs = []
+    if prefix == cfg.MQTT_TOPIC_PREFIX:
+      node = prefix
+      suffix = ""
+      device_name = "DSMR P1" + cfg.HA_ID
+    else:
+      # node_id in the config topic cannot contain "/"
+      node = prefix.replace("/", "_")
+      suffix = "_" + node
+      device_name = "DSMR P1" + cfg.HA_ID + " " + prefix
+
     d = {}  # d = dict() does not work....
 
     # create device JSON
     logger.debug(f'LOGGER: create device JSON')
     d["name"] = "status"
-    d["unique_id"] = "dsmr-device" + cfg.HA_ID
+    d["unique_id"] = "dsmr-device" + cfg.HA_ID + suffix
+    # status (online/offline) is of the program, for all meters
     d["state_topic"] = cfg.MQTT_TOPIC_PREFIX + "/status"
     d["icon"] = "mdi:home-automation"
-    d["device"] = {"name": "DSMR P1" + cfg.HA_ID,
+    d["device"] = {"name": device_name,
                    "sw_version": self.__version,
                    "model": "P1 USB/dsmr-mqtt" + cfg.HA_ID,
                    "manufacturer": "https://github.com/hansij66/dsmr2mqtt",
-                   "identifiers": ["dsmr" + cfg.HA_ID]
+                   "identifiers": ["dsmr" + cfg.HA_ID + suffix]
                    }
 
-    self.__listofjsondicts.append(d)
+    configs.append(("homeassistant/sensor/" + node + "/" + d["unique_id"] + "/config", d))
 
     # iterate through all dsmr.defintions
     logger.debug(f'LOGGER: iterate through all dsmr.defintions')
@@ -99,11 +145,11 @@ class Discovery(threading.Thread):
         i = 0
 
         # Check if tag, description and regex contain equal amount of elements
-        if len(tag_matches) == len(description_matches) == re.compile(regex).groups:
-          while i < re.compile(regex).groups:
+        if len(tag_matches) == len(description_matches) == plan.nrof_values(regex):
+          while i < plan.nrof_values(regex):
             d = {}
-            d["unique_id"] = tag_matches[i]
-            d["state_topic"] = cfg.MQTT_TOPIC_PREFIX + "/" + dsmr.definition[index][dsmr.MQTT_TOPIC]
+            d["unique_id"] = tag_matches[i] + suffix
+            d["state_topic"] = prefix + "/" + dsmr.definition[index][dsmr.MQTT_TOPIC]
             d["name"] = description_matches[i]
 
             if dsmr.definition[index][dsmr.UNIT] != "":
@@ -142,16 +188,18 @@ class Discovery(threading.Thread):
             i += 1
 
             d["icon"] = dsmr.definition[index][dsmr.HA_ICON]
-            d["device"] = {"identifiers": ["dsmr" + cfg.HA_ID]}
+            d["device"] = {"identifiers": ["dsmr" + cfg.HA_ID + suffix]}
 
             # logger.debug(f'LOGGER: %s', d)
             logger.debug(
               f'LOGGER: sensor config created with unique_id = {d["unique_id"]} and description = {d["name"]}')
 
-            self.__listofjsondicts.append(d)
+            configs.append(("homeassistant/sensor/" + node + "/" + d["unique_id"] + "/config", d))
         else:
           logger.warning(f'WARNING: entries in the DSMR50.py file do not contain equal amounts for tag = {tag}, regex = {regex} and description = {description}')
 
+    return configs
+
   def run(self):
     """
 
@@ -160,20 +208,37 @@ class Discovery(threading.Thread):
     """
     logger.debug(">>")
 
-    self.__create_discovery_JSON()
+    with self.__lock:
+      prefixes = list(self.__prefixes)
+      self.__newprefixes.clear()
+
+    for prefix in prefixes:
+      self.__listofjsondicts += self.__create_discovery_JSON(prefix)
 
     # infinite loop
     if cfg.HA_DISCOVERY:
       logger.info(f'Home Assistant config discovery is enabled')
       while not self.__stopper.is_set():
         # calculate time elapsed since last MQTT
-        t_elapsed = int(time.time()) - self.__lastmqtt
+        t_elapsed = int(self.__clock.time()) - self.__lastmqtt
+
+        # Announce meters found since last loop, without waiting for the interval
+        with self.__lock:
+          newprefixes = self.__newprefixes
+          self.__newprefixes = list()
+
+        for prefix in newprefixes:
+          logger.info(f"Home Assistant discovery for meter {prefix}")
+          configs = self.__create_discovery_JSON(prefix)
+          self.__listofjsondicts += configs
+          for topic, _dict in configs:
+            self.__mqtt.do_publish(topic, json.dumps(_dict, separators=(',', ':')), retain=True)
 
         if t_elapsed > self.__interval:
-          for _dict in self.__listofjsondicts:
-            topic = "homeassistant/sensor/" + cfg.MQTT_TOPIC_PREFIX + "/" + _dict["unique_id"] + "/config"
+          for topic, _dict in self.__listofjsondicts:
             self.__mqtt.do_publish(topic, json.dumps(_dict, separators=(',', ':')), retain=True)
-            self.__lastmqtt = int(time.time())
+          # also when no meter is known yet (NETWORK_P1 only)
+          self.__lastmqtt = int(self.__clock.time())
         else:
           # wait...
           time.sleep(0.5)
@@ -182,6 +247,5 @@ class Discovery(threading.Thread):
 
     # If configured, remove MQTT Auto Discovery configuration
     if cfg.HA_DELETECONFIG:
-      for _dict in self.__listofjsondicts:
-        topic = "homeassistant/sensor/" + cfg.MQTT_TOPIC_PREFIX + "/" + _dict["unique_id"] + "/config"
+      for topic, _dict in self.__listofjsondicts:
         self.__mqtt.do_publish(topic, "")
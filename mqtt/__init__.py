@@ -3,6 +3,6 @@ from paho.mqtt.client import MQTTv31
 from paho.mqtt.client import MQTTv311
 from paho.mqtt.client import MQTTv5
 
-__version__ = "2.0.0"
+__version__ = "2.2.0"
 __author__ = "Hans IJntema"
 __license__ = "GPLv3"
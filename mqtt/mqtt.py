@@ -17,6 +17,8 @@
   V1.1.5: Fix MQTT_ERR_NOMEM
   v1.1.6: Add clean session
   v2.0.0: Parameterize clean session; remove mqtt-rate
+  v2.1.0: Add connect_count(), to detect reconnects; do_publish() returns mid; add set_publish_callback()
+  v2.2.0: Add published_count() & queue_depth(), for diagnostics
 
   LIMITATIONS
   * Only transport = TCP supported; websockets is not supported
@@ -161,9 +163,9 @@ class MQTTClient(threading.Thread):
     self.__mqtt.on_connect = self.__on_connect
     self.__mqtt.on_disconnect = self.__on_disconnect
     self.__mqtt.on_message = self.__on_message
+    self.__mqtt.on_publish = self.__on_publish
 
     # Uncomment if needed for debugging
-#    self.__mqtt.on_publish = self.__on_publish
 #    self.__mqtt.on_log = self.__on_log
 
     if self.__mqtt_protocol == mqtt_client.MQTTv311 or self.__mqtt_protocol == mqtt_client.MQTTv31:
@@ -182,6 +184,12 @@ class MQTTClient(threading.Thread):
     # Keeps track of connected status
     self.__connected_flag = False
 
+    # Called with mid when a published message is acknowledged (qos > 0) or sent (qos = 0)
+    self.__publish_callback = None
+
+    # Number of successful connects; increments at every reconnect
+    self.__connect_count = 0
+
     # Keep track how long client is disconnected
     # When threshold is exceeded, try to recover
     # In some cases, a MQTT_ERR_NOMEM is not recovered automatically
@@ -263,6 +271,7 @@ class MQTTClient(threading.Thread):
     if rc == mqtt_client.CONNACK_ACCEPTED:
       logger.debug(f"Connected: userdata={userdata}; flags={flags}; rc={rc}: {mqtt_client.connack_string(rc)}")
       self.__set_connected_flag(True)
+      self.__connect_count += 1
       self.__set_status()
 
       # Re-subscribe, in case connection was lost
@@ -324,6 +333,8 @@ class MQTTClient(threading.Thread):
       None
     """
     logger.debug(f"userdata={userdata}; mid={mid}")
+    if self.__publish_callback is not None:
+      self.__publish_callback(mid)
     return None
 
   def __on_subscribe_v5(self, _client, _userdata, mid, reasoncodes, _properties=None):
@@ -411,6 +422,43 @@ class MQTTClient(threading.Thread):
     self.__status_retain = retain
     self.__set_status()
 
+  def set_publish_callback(self, callback):
+    """
+    Set callback for published messages; eg to measure latency
+    Callback is called from MQTT network thread with the mid returned by do_publish()
+
+    :param callback: function(mid)
+    :return: None
+    """
+    self.__publish_callback = callback
+
+  def connect_count(self):
+    """
+    Number of successful connects to broker
+    Changes after a reconnect; eg to republish full state
+
+    :return: int
+    """
+    return self.__connect_count
+
+  def published_count(self):
+    """
+    Number of messages handed over to paho client since start
+
+    :return: int
+    """
+    return self.__mqtt_counter
+
+  def queue_depth(self):
+    """
+    Number of messages in paho client which are not yet sent (qos=0) or acknowledged (qos>0)
+
+    :return: int; None if not available in this paho version
+    """
+    # Not a public paho interface
+    out_messages = getattr(self.__mqtt, "_out_messages", None)
+    return None if out_messages is None else len(out_messages)
+
   def will_set(self, topic, payload=None, qos=1, retain=False):
     """
     Set last will/testament
@@ -439,7 +487,7 @@ class MQTTClient(threading.Thread):
       :param bool retain: retained flag MQTT message
 
     Returns:
-      None
+      :rtype: int: mid of message; None if publish failed
     """
     logger.debug(f">> TOPIC={topic}; MESSAGE={message}")
 
@@ -450,8 +498,11 @@ class MQTTClient(threading.Thread):
       if mqttmessageinfo.rc != mqtt_client.MQTT_ERR_SUCCESS:
         logger.warning(f"MQTT publish was not successfull, rc = {mqttmessageinfo.rc}: "
                        f"{mqtt_client.error_string(mqttmessageinfo.rc)}")
+        return None
+      return mqttmessageinfo.mid
     except ValueError:
       logger.warning("")
+      return None
 
   def set_message_trigger(self, subscribed_queue, trigger=None):
     """
@@ -0,0 +1,458 @@
+#!/usr/bin/python3
+
+"""
+ DESCRIPTION
+   Offline throughput & latency benchmark of the dsmr-mqtt pipeline, fed from a raw dsmr file
+   (default test/dsmr.raw). Synthetic scale-ups repeat the telegrams (--scale) and spread them
+   over multiple meters / MQTT topic prefixes (--meters).
+
+   Stages:
+     frame      TaskReadSerial: framing & CRC check (P1_diagnostics.TimedFramer), telegram lines, meter time
+     decode     ParseTelegrams: parse, select, encode & queue at sinks (MQTT sink is not started)
+     encode     P1_encode.JsonEncoder, of parsed MQTT messages; compared with json.dumps (byte-identical & time)
+                payload bytes & us per telegram of every MQTT_FORMAT (json, msgpack, cbor, protobuf)
+     discovery  hadiscovery.Discovery: create & json encode Home Assistant discovery messages
+     publish    mqtt.MQTTClient.do_publish of encoded messages to a MQTT broker stand-in (test/mqtt_broker.py),
+                qos 1, till all messages are acknowledged; --puback-delay emulates a remote broker
+     reconnect  time till mqtt.MQTTClient is connected again after the broker stand-in closed the connection;
+                messages published meanwhile are counted as lost when the broker never receives them
+
+   Per stage: units/s, us per unit, Python memory allocated per unit (tracemalloc; peak while a
+   unit is processed, in a separate pass) and peak RSS of the process after the stage.
+   The configuration is config.rename.py (defaults); every telegram is published (MQTT_MAXRATE = 3600).
+
+ USAGE
+   python3 test/benchmark.py --output before.json
+   python3 test/benchmark.py --scale 10 --meters 4 --output after.json --compare before.json
+   python3 test/benchmark.py --stages frame,decode
+
+
+        This program is free software: you can redistribute it and/or modify
+        it under the terms of the GNU General Public License as published by
+        the Free Software Foundation, either version 3 of the License, or
+        (at your option) any later version.
+
+        This program is distributed in the hope that it will be useful,
+        but WITHOUT ANY WARRANTY; without even the implied warranty of
+        MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+        GNU General Public License for more details.
+
+        You should have received a copy of the GNU General Public License
+        along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import importlib.util
+import subprocess
+import tracemalloc
+import threading
+import argparse
+import platform
+import resource
+import logging
+import json
+import time
+import sys
+import os
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+# Benchmark with default configuration, also when config.py has been customized
+_spec = importlib.util.spec_from_file_location("config", os.path.join(ROOT, "config.rename.py"))
+cfg = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(cfg)
+sys.modules["config"] = cfg
+
+cfg.PRODUCTION = False
+cfg.MQTT_MAXRATE = 3600
+cfg.DIAGNOSTICS_INTERVAL = 0
+
+import P1_diagnostics as diagnostics
+import P1_framer as framer
+import P1_channel as channel
+import P1_parser as convert
+import P1_encode as encode
+import P1_plan as plan
+import dsmr50 as dsmr
+import hadiscovery as ha
+import mqtt as mqtt
+
+import mqtt_broker
+from mqtt_broker import StandInBroker
+
+STAGES = ("frame", "decode", "encode", "discovery", "publish", "reconnect")
+
+# Bytes per read of serial port in frame stage; about one USB transfer
+READ_SIZE = 1024
+
+# Max seconds to wait for connect & acknowledges of broker stand-in
+BROKER_TIMEOUT = 60
+
+
+class _Clock:
+  """
+    Every telegram is one second later; every telegram is due to be published
+  """
+
+  def __init__(self):
+    self.ts = 1600000000
+
+  def time(self):
+    self.ts += 1
+    return self.ts
+
+
+class _NoMQTT:
+  """
+    MQTT client of parser in decode stage; MQTT sink is not started, so nothing is published
+  """
+
+  def do_publish(self, topic, message, retain=False):
+    return None
+
+  def set_publish_callback(self, callback):
+    pass
+
+  def connect_count(self):
+    return 1
+
+  def published_count(self):
+    return 0
+
+  def queue_depth(self):
+    return 0
+
+
+def _peak_rss():
+  # Linux: kB
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _git_commit():
+  try:
+    return subprocess.run(["git", "-C", ROOT, "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                          timeout=10).stdout.strip() or None
+  except (OSError, subprocess.SubprocessError):
+    return None
+
+
+def measure(items, step, units, unit="telegram", repeat=3, allocations=True):
+  """
+    Run step for all items; best of repeat runs
+
+  Args:
+    :param list items: input of step
+    :param step: function(item)
+    :param int units: number of units (eg telegrams) in items
+    :param str unit: name of unit
+    :param int repeat: number of timed runs
+    :param bool allocations: measure allocations in an extra run
+
+  Returns:
+    :rtype: dict: results of stage
+  """
+  best = None
+  for _ in range(repeat):
+    started = time.perf_counter()
+    for item in items:
+      step(item)
+    elapsed = time.perf_counter() - started
+    best = elapsed if best is None else min(best, elapsed)
+
+  result = {"unit": unit,
+            "units": units,
+            "seconds": round(best, 6),
+            "per_s": round(units / best, 1) if best else None,
+            "us_per_unit": round(best * 1e6 / units, 3)}
+
+  if allocations:
+    tracemalloc.start()
+    allocated = 0
+    for item in items:
+      current = tracemalloc.get_traced_memory()[0]
+      tracemalloc.reset_peak()
+      step(item)
+      allocated += tracemalloc.get_traced_memory()[1] - current
+    tracemalloc.stop()
+    result["alloc_bytes_per_unit"] = round(allocated / units, 1)
+
+  result["peak_rss_bytes"] = _peak_rss()
+  return result
+
+
+def bench_frame(raw, repeat):
+  chunks = [raw[i:i + READ_SIZE] for i in range(0, len(raw), READ_SIZE)]
+  telegram_framer = diagnostics.TimedFramer("benchmark")
+
+  def step(chunk):
+    for frame in telegram_framer.feed(chunk):
+      framer.meter_time(framer.telegram_lines(frame))
+
+  units = len(framer.TelegramFramer().feed(raw))
+  return measure(chunks, step, units, repeat=repeat)
+
+
+def bench_decode(telegrams, repeat):
+  clock = _Clock()
+  parser = convert.ParseTelegrams(channel.TelegramChannel(), threading.Event(), _NoMQTT(), clock)
+  decode = parser._ParseTelegrams__decode_telegrams
+
+  def step(item):
+    lines, prefix = item
+    decode(lines, prefix, time.time(), clock.time())
+
+  return measure(telegrams, step, len(telegrams), repeat=repeat)
+
+
+def bench_encode(telegrams, repeat):
+  parse_plan = plan.ParsePlan(dsmr.definition, dsmr.derived)
+  clock = _Clock()
+  messages = [(prefix, parse_plan.parse(lines, clock.time())[0]) for lines, prefix in telegrams]
+  encoder = encode.JsonEncoder()
+  compiled = encode.JsonEncoder(fast=False)
+
+  def reference(prefix, message):
+    return [(topic, json.dumps(m, sort_keys=True, separators=(',', ':'))) for topic, m in message.items() if len(m) > 1]
+
+  def step(item):
+    encoder.encode(*item)
+
+  result = measure(messages, step, len(messages), repeat=repeat)
+  result["backend"] = "orjson" if encode.orjson is not None else "json"
+  result["identical"] = all(encoder.encode(*item) == compiled.encode(*item) == reference(*item) for item in messages)
+
+  # Compiled formats without orjson & json.dumps per message (as before compiled formats)
+  result["compiled_us_per_unit"] = measure(messages, lambda item: compiled.encode(*item), len(messages), repeat=repeat,
+                                           allocations=False)["us_per_unit"]
+  result["json_dumps_us_per_unit"] = measure(messages, lambda item: reference(*item), len(messages), repeat=repeat,
+                                             allocations=False)["us_per_unit"]
+  result["formats"] = bench_formats(parse_plan, messages, repeat)
+  return result
+
+
+def bench_formats(parse_plan, messages, repeat):
+  """
+    Payload size & encode time of MQTT formats
+
+  Returns:
+    :rtype: dict: format:{"bytes_per_unit", "us_per_unit"}
+  """
+  formats = {}
+  for format in (encode.JSON, encode.MSGPACK, encode.CBOR, encode.PROTOBUF):
+    encoder = encode.encoder(format, parse_plan)
+    size = sum(len(data) for item in messages for _topic, data in encoder.encode(*item))
+    timed = measure(messages, lambda item: encoder.encode(*item), len(messages), repeat=repeat, allocations=False)
+    formats[format] = {"bytes_per_unit": round(size / len(messages), 1), "us_per_unit": timed["us_per_unit"]}
+  return formats
+
+
+def bench_discovery(count, repeat):
+  discovery = ha.Discovery(threading.Event(), _NoMQTT(), "benchmark")
+  create = discovery._Discovery__create_discovery_JSON
+
+  def step(_item):
+    for _topic, d in create(cfg.MQTT_TOPIC_PREFIX):
+      json.dumps(d, separators=(',', ':'))
+
+  return measure(range(count), step, count, unit="discovery", repeat=repeat)
+
+
+def _connect(broker):
+  """
+    Start MQTT client, as in dsmr-mqtt.py (qos 1, MQTT v5), and wait till it is connected to the broker stand-in
+
+  Returns:
+    :rtype: tuple: (mqtt.MQTTClient, stopper, semaphore released per acknowledged message)
+  """
+  stopper = threading.Event()
+  client = mqtt.MQTTClient(mqtt_broker=broker.address, mqtt_port=broker.port, mqtt_stopper=stopper,
+                           mqtt_qos=1, mqtt_protocol=mqtt.MQTTv5)
+
+  acked = threading.Semaphore(0)
+  client.set_publish_callback(lambda mid: acked.release())
+  client.start()
+
+  deadline = time.monotonic() + BROKER_TIMEOUT
+  while client.connect_count() == 0:
+    if time.monotonic() > deadline:
+      stopper.set()
+      raise TimeoutError("No connection to MQTT broker stand-in")
+    time.sleep(0.01)
+  return client, stopper, acked
+
+
+def _wait_acked(acked, messages):
+  for _ in range(messages):
+    if not acked.acquire(timeout=BROKER_TIMEOUT):
+      raise TimeoutError("MQTT broker stand-in did not acknowledge all messages")
+
+
+def bench_publish(telegrams, puback_delay):
+  """
+    Publish all MQTT messages of the telegrams to a broker stand-in & wait for acknowledges
+    Not repeated; allocations are not measured (paho network thread)
+  """
+  parse_plan = plan.ParsePlan(dsmr.definition, dsmr.derived)
+  clock = _Clock()
+  encoder = encode.JsonEncoder()
+  payloads = [[(f"{prefix}/{topic}", data)
+               for topic, data in encoder.encode(prefix, parse_plan.parse(lines, clock.time())[0])]
+              for lines, prefix in telegrams]
+  messages = sum(len(payload) for payload in payloads)
+
+  broker = StandInBroker(puback_delay=puback_delay, record=False)
+  broker.start()
+  client, stopper, acked = _connect(broker)
+
+  try:
+    def step(payload):
+      for topic, data in payload:
+        client.do_publish(topic, data)
+
+    result = measure(payloads, step, len(payloads), repeat=1, allocations=False)
+
+    started = time.perf_counter() - result["seconds"]
+    _wait_acked(acked, messages)
+    elapsed = time.perf_counter() - started
+
+    result["messages"] = messages
+    result["acked_seconds"] = round(elapsed, 6)
+    result["acked_per_s"] = round(len(payloads) / elapsed, 1)
+    result["broker_messages"] = broker.published_count
+    result["max_inflight"] = broker.max_inflight
+    result["peak_rss_bytes"] = _peak_rss()
+    return result
+
+  finally:
+    stopper.set()
+    client.join()
+    broker.stop()
+
+
+def bench_reconnect(repeat, messages=100):
+  """
+    Time from connection loss till MQTT client is connected again; alternately a broker restart
+    and an abrupt close (FAIL_NOMEM). Messages published while disconnected have to be delivered.
+  """
+  broker = StandInBroker()
+  broker.start()
+  client, stopper, acked = _connect(broker)
+
+  try:
+    recoveries = []
+    for i in range(repeat):
+      connect_count = client.connect_count()
+      started = time.perf_counter()
+      broker.fail(mqtt_broker.FAIL_NOMEM if i % 2 else mqtt_broker.FAIL_DISCONNECT)
+
+      for n in range(messages):
+        client.do_publish("bench/reconnect", f"{i}-{n}")
+
+      deadline = time.monotonic() + BROKER_TIMEOUT
+      while client.connect_count() == connect_count:
+        if time.monotonic() > deadline:
+          raise TimeoutError("MQTT client did not reconnect")
+        time.sleep(0.001)
+      recoveries.append(time.perf_counter() - started)
+
+      _wait_acked(acked, messages)
+
+    delivered = {m.payload for m in broker.messages if m.topic == "bench/reconnect"}
+    total = sum(recoveries)
+    return {"unit": "reconnect",
+            "units": repeat,
+            "seconds": round(total, 6),
+            "per_s": round(repeat / total, 3),
+            "us_per_unit": round(total * 1e6 / repeat, 3),
+            "max_seconds": round(max(recoveries), 6),
+            "messages": repeat * messages,
+            "lost": repeat * messages - len(delivered),
+            "duplicates": sum(1 for m in broker.messages if m.topic == "bench/reconnect") - len(delivered),
+            "peak_rss_bytes": _peak_rss()}
+
+  finally:
+    stopper.set()
+    client.join()
+    broker.stop()
+
+
+def compare(results, previous):
+  """
+    Print us per unit of both runs and the change
+
+  Returns:
+    None
+  """
+  print(f"\n{'stage':<10} {'before':>12} {'after':>12} {'change':>8}")
+  for name, result in results["stages"].items():
+    before = previous.get("stages", {}).get(name)
+    if before is None:
+      continue
+    change = (result["us_per_unit"] - before["us_per_unit"]) / before["us_per_unit"] * 100
+    print(f"{name:<10} {before['us_per_unit']:>10.1f}us {result['us_per_unit']:>10.1f}us {change:>+7.1f}%")
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Throughput & latency benchmark of the dsmr-mqtt pipeline")
+  parser.add_argument("--file", default=os.path.join(ROOT, "test", "dsmr.raw"), help="raw dsmr file")
+  parser.add_argument("--scale", type=int, default=20, help="repeat telegrams of file N times")
+  parser.add_argument("--meters", type=int, default=1, help="spread telegrams over N meters (MQTT topic prefixes)")
+  parser.add_argument("--repeat", type=int, default=3, help="timed runs per stage; best run is reported")
+  parser.add_argument("--puback-delay", type=float, default=0.0, help="seconds till broker stand-in acknowledges")
+  parser.add_argument("--stages", default=",".join(STAGES), help="comma separated stages")
+  parser.add_argument("--output", help="write results as json; - is stdout")
+  parser.add_argument("--compare", help="json results of previous run")
+  args = parser.parse_args()
+
+  logging.basicConfig(level=logging.WARNING)
+
+  with open(args.file, 'rb') as f:
+    raw = f.read()
+  lines = [framer.telegram_lines(frame) for frame in framer.TelegramFramer().feed(raw)]
+  telegrams = [(telegram, f"bench{i % args.meters}" if args.meters > 1 else "bench")
+               for i, telegram in enumerate(lines * args.scale)]
+
+  results = {"meta": {"timestamp": int(time.time()),
+                      "commit": _git_commit(),
+                      "python": platform.python_version(),
+                      "platform": platform.platform(),
+                      "file": os.path.basename(args.file),
+                      "scale": args.scale,
+                      "meters": args.meters,
+                      "telegrams": len(telegrams)},
+             "stages": {}}
+
+  benchmarks = {"frame": lambda: bench_frame(raw * args.scale, args.repeat),
+                "decode": lambda: bench_decode(telegrams, args.repeat),
+                "encode": lambda: bench_encode(telegrams, args.repeat),
+                "discovery": lambda: bench_discovery(100, args.repeat),
+                "publish": lambda: bench_publish(telegrams, args.puback_delay),
+                "reconnect": lambda: bench_reconnect(args.repeat)}
+
+  print(f"{'stage':<10} {'units':>8} {'units/s':>12} {'us/unit':>10} {'alloc B/unit':>13} {'peak RSS':>10}")
+  for name in args.stages.split(","):
+    result = benchmarks[name]()
+    results["stages"][name] = result
+    alloc = result.get("alloc_bytes_per_unit")
+    print(f"{name:<10} {result['units']:>8} {result['per_s']:>12.1f} {result['us_per_unit']:>10.1f} "
+          f"{'-' if alloc is None else f'{alloc:.0f}':>13} {result['peak_rss_bytes'] // 1024 // 1024:>8}MB")
+
+  formats = results["stages"].get("encode", {}).get("formats")
+  if formats:
+    print(f"\n{'format':<10} {'B/telegram':>12} {'us/telegram':>12}")
+    for format, result in formats.items():
+      print(f"{format:<10} {result['bytes_per_unit']:>12.1f} {result['us_per_unit']:>12.1f}")
+
+  if args.compare:
+    with open(args.compare) as f:
+      compare(results, json.load(f))
+
+  if args.output == "-":
+    print(json.dumps(results, indent=2))
+  elif args.output:
+    with open(args.output, 'w') as f:
+      json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,75 @@
+#!/usr/bin/python3
+
+"""
+ DESCRIPTION
+   InfluxDB write stand-in, to test P1_influx.py without InfluxDB; no network access required.
+   Accepts InfluxDB (v1 & v2) writes, gzip compressed or not, and prints the received points
+   on stdout. The first N writes can be answered with 503, to test spilling & retry.
+
+ USAGE
+   python3 test/influx_server.py --port 8086 --fail 3
+   Configure in config.py: INFLUX_URL = "http://127.0.0.1:8086/write?db=dsmr&precision=s"
+
+
+        This program is free software: you can redistribute it and/or modify
+        it under the terms of the GNU General Public License as published by
+        the Free Software Foundation, either version 3 of the License, or
+        (at your option) any later version.
+
+        This program is distributed in the hope that it will be useful,
+        but WITHOUT ANY WARRANTY; without even the implied warranty of
+        MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+        GNU General Public License for more details.
+
+        You should have received a copy of the GNU General Public License
+        along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import http.server
+import argparse
+import gzip
+import sys
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+  """
+    Accepts InfluxDB writes & prints the points; the first "fail" writes return 503
+  """
+  fail = 0
+  writes = 0
+
+  def log_message(self, format, *args):
+    pass
+
+  def do_POST(self):
+    body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+    if self.headers.get("Content-Encoding") == "gzip":
+      body = gzip.decompress(body)
+
+    StandInHandler.writes += 1
+    if StandInHandler.writes <= self.fail:
+      print(f"write {self.writes}: {len(body)} bytes; fail", file=sys.stderr)
+      self.send_response(503)
+    else:
+      lines = body.decode().splitlines()
+      print(f"write {self.writes}: {len(body)} bytes; {len(lines)} points", file=sys.stderr)
+      for line in lines:
+        print(line)
+      self.send_response(204)
+    self.end_headers()
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="InfluxDB write stand-in; prints received points")
+  parser.add_argument("--address", default="127.0.0.1", help="listen address")
+  parser.add_argument("--port", type=int, default=8086)
+  parser.add_argument("--fail", type=int, default=0, help="number of writes answered with 503")
+  args = parser.parse_args()
+
+  StandInHandler.fail = args.fail
+  server = http.server.HTTPServer((args.address, args.port), StandInHandler)
+  print(f"InfluxDB stand-in on {args.address} port {args.port}; failing {args.fail} writes", file=sys.stderr)
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    server.server_close()
@@ -0,0 +1,502 @@
+#!/usr/bin/python3
+
+"""
+ DESCRIPTION
+   MQTT broker stand-in (MQTT 3.1.1 and 5) for benchmarks and tests; no network access required.
+   Accepts every client on localhost, acknowledges every PUBLISH (qos 0, 1 and 2) and records
+   the received messages with their arrival time. Subscriptions are acknowledged; messages are
+   not forwarded.
+
+   Failures can be injected, to test inflight behaviour & reconnect recovery of mqtt.MQTTClient:
+     puback_delay       seconds between receiving a PUBLISH and sending PUBACK (PUBREC for qos 2)
+     disconnect_after   close the connection after every N received PUBLISH packets
+     fail(FAIL_DISCONNECT)  close all connections, as a broker restart
+     fail(FAIL_NOMEM)       close all connections in the middle of a packet; paho-mqtt < 1.6 reports
+                            MQTT_ERR_NOMEM, later versions MQTT_ERR_CONN_LOST
+     fail(FAIL_STALL)       keep connections open, but stop reading & answering till recover()
+
+ USAGE
+   In process:
+     broker = StandInBroker()
+     broker.start()
+     ... mqtt.MQTTClient(mqtt_broker="127.0.0.1", mqtt_port=broker.port, ...)
+     broker.puback_delay = 0.05
+     broker.fail(FAIL_DISCONNECT)
+     broker.stop()
+     broker.messages, broker.events, broker.max_inflight
+
+   Standalone:
+     python3 test/mqtt_broker.py --port 1883 --puback-delay 0.1 --disconnect-after 1000 --verbose
+
+
+        This program is free software: you can redistribute it and/or modify
+        it under the terms of the GNU General Public License as published by
+        the Free Software Foundation, either version 3 of the License, or
+        (at your option) any later version.
+
+        This program is distributed in the hope that it will be useful,
+        but WITHOUT ANY WARRANTY; without even the implied warranty of
+        MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+        GNU General Public License for more details.
+
+        You should have received a copy of the GNU General Public License
+        along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import collections
+import socketserver
+import threading
+import socket
+import struct
+import queue
+import time
+
+# Control packet types
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+PUBREC = 5
+PUBREL = 6
+PUBCOMP = 7
+SUBSCRIBE = 8
+SUBACK = 9
+UNSUBSCRIBE = 10
+UNSUBACK = 11
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+# Protocol level in CONNECT
+MQTT_V311 = 4
+MQTT_V5 = 5
+
+# Injected failures; see fail()
+FAIL_DISCONNECT = "disconnect"
+FAIL_NOMEM = "nomem"
+FAIL_STALL = "stall"
+
+# Received PUBLISH
+#   received   epoch; arrival time
+#   client_id  MQTT client id of publisher
+#   topic
+#   payload    bytes
+#   qos
+#   retain     bool
+#   dup        bool; redelivery after reconnect
+Message = collections.namedtuple("Message", ["received", "client_id", "topic", "payload", "qos", "retain", "dup"])
+
+# Connection events
+#   ts         epoch
+#   event      "connect", "disconnect" (by client), "closed" (connection lost), "fail:<mode>" (injected)
+#   client_id
+Event = collections.namedtuple("Event", ["ts", "event", "client_id"])
+
+
+def encode_length(length):
+  """
+  Returns:
+    :rtype: bytes: MQTT variable byte integer
+  """
+  encoded = bytearray()
+  while True:
+    byte, length = length % 128, length // 128
+    encoded.append(byte | 0x80 if length else byte)
+    if not length:
+      return bytes(encoded)
+
+
+def decode_length(data, offset):
+  """
+  Returns:
+    :rtype: tuple: (value, offset after variable byte integer)
+  """
+  value = 0
+  shift = 0
+  while True:
+    byte = data[offset]
+    offset += 1
+    value |= (byte & 0x7f) << shift
+    shift += 7
+    if not byte & 0x80:
+      return value, offset
+
+
+def packet(kind, body=b"", flags=0):
+  """
+  Returns:
+    :rtype: bytes: control packet with fixed header
+  """
+  return bytes((kind << 4 | flags,)) + encode_length(len(body)) + body
+
+
+def _string(data, offset):
+  # Length prefixed UTF-8 string
+  length = struct.unpack_from("!H", data, offset)[0]
+  return data[offset + 2:offset + 2 + length].decode(), offset + 2 + length
+
+
+class _ClientHandler(socketserver.BaseRequestHandler):
+  """
+    One connected MQTT client; acknowledges are sent by a separate thread, after puback_delay
+  """
+
+  # Set by StandInBroker
+  broker = None
+
+  def setup(self):
+    self.protocol = MQTT_V311
+    self.client_id = None
+    self.publishes = 0
+    self.closed = False
+    self.__send_lock = threading.Lock()
+
+    # (monotonic time when due, packet)
+    self.__acks = queue.Queue()
+    self.__ack_thread = threading.Thread(target=self.__send_acks, daemon=True)
+    self.__ack_thread.start()
+
+  def send(self, data):
+    with self.__send_lock:
+      self.request.sendall(data)
+
+  def close(self, partial=b""):
+    """
+      Close connection without DISCONNECT; partial is sent first, eg the start of a packet
+
+    Returns:
+      None
+    """
+    self.closed = True
+    try:
+      if partial:
+        self.send(partial)
+      self.request.shutdown(socket.SHUT_RDWR)
+    except OSError:
+      pass
+
+  def __send_acks(self):
+    while True:
+      item = self.__acks.get()
+      if item is None:
+        return
+
+      due, data = item
+      wait = due - time.monotonic()
+      if wait > 0:
+        time.sleep(wait)
+      while self.broker.stalled and not self.closed:
+        time.sleep(0.01)
+
+      if not self.closed:
+        try:
+          self.send(data)
+        except OSError:
+          pass
+      self.broker.acked()
+
+  def __recv_exactly(self, n):
+    data = bytearray()
+    while len(data) < n:
+      chunk = self.request.recv(n - len(data))
+      if not chunk:
+        raise ConnectionError("client closed connection")
+      data += chunk
+    return bytes(data)
+
+  def __recv_packet(self):
+    """
+    Returns:
+      :rtype: tuple: (packet type, flags, body)
+    """
+    header = self.__recv_exactly(1)[0]
+    length = 0
+    shift = 0
+    while True:
+      byte = self.__recv_exactly(1)[0]
+      length |= (byte & 0x7f) << shift
+      shift += 7
+      if not byte & 0x80:
+        break
+    return header >> 4, header & 0x0f, self.__recv_exactly(length)
+
+  def __connect(self, body):
+    # Protocol name, protocol level, connect flags, keep alive, [properties], client id
+    _name, offset = _string(body, 0)
+    self.protocol = body[offset]
+    offset += 4
+    if self.protocol == MQTT_V5:
+      properties, offset = decode_length(body, offset)
+      offset += properties
+    self.client_id, offset = _string(body, offset)
+
+    self.broker.connected(self)
+    if self.protocol == MQTT_V5:
+      self.send(packet(CONNACK, b"\x00\x00\x00"))
+    else:
+      self.send(packet(CONNACK, b"\x00\x00"))
+
+  def __publish(self, flags, body):
+    received = time.time()
+    qos = (flags >> 1) & 0x03
+    topic, offset = _string(body, 0)
+
+    mid = None
+    if qos:
+      mid = body[offset:offset + 2]
+      offset += 2
+
+    if self.protocol == MQTT_V5:
+      properties, offset = decode_length(body, offset)
+      offset += properties
+
+    self.broker.published(Message(received, self.client_id, topic, body[offset:], qos, bool(flags & 0x01),
+                                  bool(flags & 0x08)))
+
+    if qos:
+      self.__acks.put((time.monotonic() + self.broker.puback_delay, packet(PUBACK if qos == 1 else PUBREC, mid)))
+
+    self.publishes += 1
+    if self.broker.disconnect_after and self.publishes % self.broker.disconnect_after == 0:
+      self.broker.event("fail:" + FAIL_DISCONNECT, self.client_id)
+      self.close()
+
+  def __subscribe(self, body):
+    # Grant qos 0 to every topic filter
+    mid = body[:2]
+    offset = 2
+    if self.protocol == MQTT_V5:
+      properties, offset = decode_length(body, offset)
+      offset += properties
+    granted = bytearray()
+    while offset < len(body):
+      _filter, offset = _string(body, offset)
+      offset += 1
+      granted.append(0)
+    properties = b"\x00" if self.protocol == MQTT_V5 else b""
+    self.send(packet(SUBACK, mid + properties + bytes(granted)))
+
+  def handle(self):
+    try:
+      while not self.closed:
+        kind, flags, body = self.__recv_packet()
+
+        # Frozen broker; packet is never answered
+        while self.broker.stalled and not self.closed:
+          time.sleep(0.01)
+        if self.closed:
+          break
+
+        if kind == CONNECT:
+          self.__connect(body)
+
+        elif kind == PUBLISH:
+          self.__publish(flags, body)
+
+        elif kind == PUBREL:
+          self.send(packet(PUBCOMP, body[:2]))
+
+        elif kind == SUBSCRIBE:
+          self.__subscribe(body)
+
+        elif kind == UNSUBSCRIBE:
+          properties = b"\x00" if self.protocol == MQTT_V5 else b""
+          self.send(packet(UNSUBACK, body[:2] + properties))
+
+        elif kind == PINGREQ:
+          self.send(packet(PINGRESP))
+
+        elif kind == DISCONNECT:
+          self.broker.event("disconnect", self.client_id)
+          self.closed = True
+
+    except (ConnectionError, OSError):
+      if self.client_id is not None and not self.closed:
+        self.broker.event("closed", self.client_id)
+
+  def finish(self):
+    self.closed = True
+    self.__acks.put(None)
+    self.broker.disconnected(self)
+
+
+class _Server(socketserver.ThreadingTCPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+
+class StandInBroker:
+  """
+    MQTT broker stand-in on localhost; every client has its own thread
+  """
+
+  def __init__(self, address="127.0.0.1", port=0, puback_delay=0.0, disconnect_after=None, record=True):
+    """
+    Args:
+      :param str address: listen address
+      :param int port: 0 is any free port; see port
+      :param float puback_delay: seconds till PUBACK/PUBREC is sent
+      :param int disconnect_after: close connection after every N PUBLISH packets; None is never
+      :param bool record: keep received messages in messages; otherwise only counted
+    """
+    handler = type("ClientHandler", (_ClientHandler,), {"broker": self})
+    self.__server = _Server((address, port), handler)
+    self.__thread = None
+    self.__lock = threading.Lock()
+    self.__record = record
+
+    self.address, self.port = self.__server.server_address
+
+    # Injected failures; can be changed while running
+    self.puback_delay = puback_delay
+    self.disconnect_after = disconnect_after
+    self.stalled = False
+
+    # Connected clients
+    self.__clients = set()
+
+    # [Message], [Event]
+    self.messages = []
+    self.events = []
+
+    # Statistics
+    self.connects = 0
+    self.published_count = 0
+    self.bytes = 0
+
+    # Received qos > 0 messages which have not been acknowledged
+    self.inflight = 0
+    self.max_inflight = 0
+
+  def event(self, event, client_id):
+    with self.__lock:
+      self.events.append(Event(time.time(), event, client_id))
+
+  def connected(self, client):
+    """
+      Called by client handler after CONNECT
+
+    Returns:
+      None
+    """
+    with self.__lock:
+      self.connects += 1
+      self.__clients.add(client)
+      self.events.append(Event(time.time(), "connect", client.client_id))
+
+  def disconnected(self, client):
+    with self.__lock:
+      self.__clients.discard(client)
+
+  def published(self, message):
+    """
+      Called by client handler for every PUBLISH
+
+    Args:
+      :param Message message:
+
+    Returns:
+      None
+    """
+    with self.__lock:
+      self.published_count += 1
+      self.bytes += len(message.payload)
+      if self.__record:
+        self.messages.append(message)
+      if message.qos:
+        self.inflight += 1
+        self.max_inflight = max(self.max_inflight, self.inflight)
+
+  def acked(self):
+    """
+      Called by client handler after PUBACK/PUBREC
+
+    Returns:
+      None
+    """
+    with self.__lock:
+      self.inflight -= 1
+
+  def fail(self, mode):
+    """
+      Inject failure in all connections
+
+    Args:
+      :param str mode: FAIL_DISCONNECT, FAIL_NOMEM or FAIL_STALL
+
+    Returns:
+      None
+    """
+    assert mode in (FAIL_DISCONNECT, FAIL_NOMEM, FAIL_STALL), f"Unknown failure {mode}"
+    with self.__lock:
+      clients = list(self.__clients)
+
+    if mode == FAIL_STALL:
+      self.stalled = True
+
+    for client in clients:
+      self.event("fail:" + mode, client.client_id)
+      if mode == FAIL_DISCONNECT:
+        client.close()
+      elif mode == FAIL_NOMEM:
+        # First byte & length of a PUBACK, without packet id
+        client.close(partial=bytes((PUBACK << 4, 2)))
+
+  def recover(self):
+    """
+      End FAIL_STALL
+
+    Returns:
+      None
+    """
+    self.stalled = False
+
+  def start(self):
+    self.__thread = threading.Thread(target=self.__server.serve_forever, kwargs={"poll_interval": 0.1}, daemon=True)
+    self.__thread.start()
+
+  def stop(self):
+    self.stalled = False
+    with self.__lock:
+      clients = list(self.__clients)
+    for client in clients:
+      client.close()
+
+    self.__server.shutdown()
+    self.__server.server_close()
+    self.__thread.join()
+
+
+def main():
+  parser = argparse.ArgumentParser(description="MQTT broker stand-in; acknowledges & records published messages")
+  parser.add_argument("--port", type=int, default=1883)
+  parser.add_argument("--puback-delay", type=float, default=0.0, help="seconds till PUBACK is sent")
+  parser.add_argument("--disconnect-after", type=int, help="close connection after every N PUBLISH packets")
+  parser.add_argument("--verbose", action="store_true", help="print every received message")
+  args = parser.parse_args()
+
+  broker = StandInBroker("127.0.0.1", args.port, args.puback_delay, args.disconnect_after)
+  broker.start()
+  print(f"MQTT broker stand-in on 127.0.0.1:{broker.port}")
+
+  printed = 0
+  try:
+    while True:
+      time.sleep(10)
+      messages = broker.messages[printed:]
+      printed += len(messages)
+      if args.verbose:
+        for m in messages:
+          print(f"{m.received:.3f} {m.client_id} {m.topic} {m.payload.decode(errors='replace')}")
+      # Messages are printed; do not keep them
+      del broker.messages[:printed]
+      printed = 0
+      print(f"connects = {broker.connects}; messages = {broker.published_count}; bytes = {broker.bytes}; "
+            f"inflight = {broker.inflight}; max inflight = {broker.max_inflight}")
+  except KeyboardInterrupt:
+    broker.stop()
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,104 @@
+#!/usr/bin/python3
+
+"""
+ DESCRIPTION
+   Network P1 stand-in (like a P1 Wi-Fi dongle or ser2net)
+   Serves a raw dsmr file (default test/dsmr.raw) on one or more TCP ports.
+   Every client receives the telegrams of the file, one telegram per interval, in an endless loop.
+
+   Every port can pretend to be a different meter (--unique): the equipment identifier
+   is replaced by a per port identifier and the CRC is recalculated.
+
+ USAGE
+   python3 test/p1-server.py --ports 2001-2100 --unique
+   Configure in config.py: NETWORK_P1 = [("127.0.0.1", port) for port in range(2001, 2101)]
+
+
+        This program is free software: you can redistribute it and/or modify
+        it under the terms of the GNU General Public License as published by
+        the Free Software Foundation, either version 3 of the License, or
+        (at your option) any later version.
+
+        This program is distributed in the hope that it will be useful,
+        but WITHOUT ANY WARRANTY; without even the implied warranty of
+        MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+        GNU General Public License for more details.
+
+        You should have received a copy of the GNU General Public License
+        along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import P1_framer as framer
+
+
+def load_telegrams(filename, meter_id=None):
+  """
+  Args:
+    :param str filename: raw dsmr file
+    :param str meter_id: replace equipment identifier (0-0:96.1.1) by this value and recalculate CRC
+
+  Returns:
+    list of bytes (telegrams)
+  """
+  with open(filename, 'rb') as f:
+    frames = framer.TelegramFramer().feed(f.read())
+
+  if meter_id is None:
+    return frames
+
+  telegrams = []
+  for frame in frames:
+    start = frame.index(b'0-0:96.1.1(') + 11
+    end = frame.index(b')', start)
+    body = frame[:start] + meter_id.encode() + frame[end:frame.rindex(b'!') + 1]
+    telegrams.append(body + b'%04X\r\n' % framer.crc16(body))
+  return telegrams
+
+
+async def serve(address, port, telegrams, interval):
+  async def client(_reader, writer):
+    try:
+      while True:
+        for telegram in telegrams:
+          writer.write(telegram)
+          await writer.drain()
+          await asyncio.sleep(interval)
+    except (ConnectionError, OSError):
+      pass
+    finally:
+      writer.close()
+
+  return await asyncio.start_server(client, address, port)
+
+
+async def main(args):
+  first, _sep, last = args.ports.partition("-")
+  ports = range(int(first), int(last or first) + 1)
+
+  servers = []
+  for port in ports:
+    meter_id = f"{port:034d}" if args.unique else None
+    servers.append(await serve(args.address, port, load_telegrams(args.file, meter_id), args.interval))
+
+  print(f"Serving {args.file} on {args.address} ports {args.ports}; interval = {args.interval}s")
+  await asyncio.gather(*(s.serve_forever() for s in servers))
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="Serve raw dsmr telegrams over TCP")
+  parser.add_argument("--file", default="test/dsmr.raw", help="raw dsmr file")
+  parser.add_argument("--address", default="127.0.0.1", help="listen address, eg ::1 to test IPv6")
+  parser.add_argument("--ports", default="2001", help="port or range of ports, eg 2001-2100")
+  parser.add_argument("--interval", type=float, default=1.0, help="seconds between telegrams")
+  parser.add_argument("--unique", action="store_true", help="unique equipment identifier per port")
+
+  try:
+    asyncio.run(main(parser.parse_args()))
+  except KeyboardInterrupt:
+    pass